@@ -0,0 +1,1010 @@
+"""
+Offline benchmarks for the agent in litellm/agent.py.
+
+``agent`` starts mock_llm.py as a local stand-in model server and drives
+MyCustomLLM.completion / acompletion / astreaming against it, reporting
+throughput, TTFT, latency percentiles and CPU per request for each
+concurrency level. ``batch`` drives acompletion with a burst of requests
+with and without ``share_decisions`` and also reports upstream calls per
+request.
+``triage`` replays recorded turns (``AGENT_TRIAGE_LOG``) through the local
+triage and reports precision/recall for each ``triage_answer_below``.
+``coldstart`` measures a fresh worker: ``python -X importtime`` of agent.py
+and the latency of its first and second request, with and without
+``AGENT_PREWARM``. ``replay`` re-drives a traffic capture
+(``AGENT_CAPTURE_PATH``) at its recorded arrival times, or scaled by
+``--speed``, against the agent with mock_llm.py serving the recorded
+upstream responses and timings and the tools returning the recorded results;
+each speed runs in a fresh worker. ``coalesce`` opens many concurrent
+astreaming requests against a mock model that streams one- or two-character
+deltas and compares ``coalesce_chars`` values: frames per second and per
+request, TTFT, latency and CPU per request, going through litellm's stream
+wrapper and the proxy's SSE encoding as the proxy does. Nothing leaves the
+machine.
+
+Usage:
+    uv run python benchmark.py chunks [--chunks 200000]
+    uv run python benchmark.py agent [--concurrency 1 8 32] [--tool-format qwen3] [--json out.json]
+    uv run python benchmark.py batch [--concurrency 32] [--distinct 7]
+    uv run python benchmark.py triage --traffic triage.jsonl [--rules rules.json] [--answer-below 0 0.05 0.1]
+    uv run python benchmark.py coldstart [--runs 5] [--startup-gap 0.5] [--json out.json]
+    uv run python benchmark.py replay --traffic capture.jsonl [--speed 1 2 4] [--settings '{"speculation": "on"}']
+    uv run python benchmark.py coalesce [--streams 16 64] [--coalesce-chars 0 16 32 64] [--coalesce-wait 0.02]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm"))
+
+from agent_stream import ToolCallAssembler, finish_chunk, text_chunk, unpack_chunk  # noqa: E402
+from mock_llm import replay_key  # noqa: E402
+
+
+# ---------------------------------------------------------------------------
+# Synthetic streaming chunks
+# ---------------------------------------------------------------------------
+
+class _Usage:
+    def __init__(self, prompt_tokens, completion_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = prompt_tokens + completion_tokens
+
+    def model_dump(self):
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+        }
+
+
+class _Delta:
+    def __init__(self, content):
+        self.content = content
+        self.tool_calls = None
+
+
+class _Choice:
+    def __init__(self, content, finish_reason=None):
+        self.index = 0
+        self.delta = _Delta(content)
+        self.finish_reason = finish_reason
+
+
+class _Chunk:
+    def __init__(self, content, finish_reason=None, usage=None):
+        self.choices = [_Choice(content, finish_reason)]
+        if usage is not None:
+            self.usage = usage
+
+
+def make_chunks(n: int) -> list:
+    """``n`` small text deltas followed by a finish chunk carrying usage, as litellm would yield them."""
+    try:
+        from litellm.types.utils import Delta, ModelResponseStream, StreamingChoices, Usage
+
+        chunks = [
+            ModelResponseStream(choices=[StreamingChoices(index=0, delta=Delta(content="ab"))])
+            for _ in range(n)
+        ]
+        chunks.append(ModelResponseStream(
+            choices=[StreamingChoices(index=0, delta=Delta(content=""), finish_reason="stop")],
+            usage=Usage(prompt_tokens=10, completion_tokens=n, total_tokens=10 + n),
+        ))
+        return chunks
+    except ImportError:
+        chunks = [_Chunk("ab") for _ in range(n)]
+        chunks.append(_Chunk("", "stop", _Usage(10, n)))
+        return chunks
+
+
+# ---------------------------------------------------------------------------
+# Chunk adaptation: before (per-chunk code from the original astreaming) / after (agent_stream)
+# ---------------------------------------------------------------------------
+
+def adapt_legacy(chunks) -> int:
+    n = 0
+    for chunk in chunks:
+        if hasattr(chunk, "choices") and len(chunk.choices) > 0:
+            choice = chunk.choices[0]
+            delta = choice.delta if hasattr(choice, "delta") else None
+
+            usage_dict = {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0}
+            if hasattr(chunk, "usage") and chunk.usage:
+                if hasattr(chunk.usage, "model_dump"):
+                    usage_dict = chunk.usage.model_dump()
+                elif hasattr(chunk.usage, "dict"):
+                    usage_dict = chunk.usage.dict()
+                elif isinstance(chunk.usage, dict):
+                    usage_dict = chunk.usage
+
+            generic_streaming_chunk = {
+                "finish_reason": choice.finish_reason if hasattr(choice, "finish_reason") else None,
+                "index": choice.index if hasattr(choice, "index") else 0,
+                "is_finished": choice.finish_reason is not None if hasattr(choice, "finish_reason") else False,
+                "text": delta.content if delta and hasattr(delta, "content") and delta.content else "",
+                "tool_use": None,
+                "usage": usage_dict,
+            }
+            n += generic_streaming_chunk is not None
+    return n
+
+
+def adapt_current(chunks) -> int:
+    n = 0
+    assembler = ToolCallAssembler()
+    finish_reason = None
+    finish_index = 0
+    usage = None
+    for chunk in chunks:
+        index, content, tool_call_deltas, chunk_finish_reason, chunk_usage = unpack_chunk(chunk)
+        if chunk_usage:
+            usage = chunk_usage
+        if index is None:
+            continue
+        if tool_call_deltas:
+            assembler.add(tool_call_deltas)
+        text = assembler.feed_text(content)
+        if chunk_finish_reason:
+            finish_reason = chunk_finish_reason
+            finish_index = index
+        if text:
+            n += text_chunk(text, index) is not None
+    n += finish_chunk(assembler.flush_text(), finish_index, finish_reason, usage) is not None
+    return n
+
+
+def bench_chunks(args) -> None:
+    print("\n" + "=" * 60)
+    print(f"Chunk adaptation ({args.chunks} chunks, best of {args.repeat})")
+    print("=" * 60)
+    chunks = make_chunks(args.chunks)
+    print(f"chunk type: {type(chunks[0]).__module__}.{type(chunks[0]).__name__}")
+
+    results = {}
+    for name, adapt in (("before", adapt_legacy), ("after", adapt_current)):
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            adapt(chunks)
+            best = min(best, time.perf_counter() - start)
+        results[name] = len(chunks) / best
+        print(f"{name:>8s}: {results[name]:>14,.0f} chunks/sec")
+    print(f" speedup: {results['after'] / results['before']:.2f}x")
+
+
+# ---------------------------------------------------------------------------
+# Agent pipeline against the mock LLM server
+# ---------------------------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(args) -> tuple:
+    """Run mock_llm.py in a subprocess so its CPU time is not attributed to the agent."""
+    port = _free_port()
+    mock_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_llm.py")
+    process = subprocess.Popen(
+        [
+            sys.executable, mock_path,
+            "--port", str(port),
+            "--latency", str(args.latency),
+            "--tokens-per-sec", str(args.tokens_per_sec),
+            "--tokens", str(args.tokens),
+            "--tool-probability", str(args.tool_probability),
+            "--tool-format", args.tool_format,
+            *(["--replay", args.replay] if getattr(args, "replay", None) else []),
+            *(["--token-chars", str(args.token_chars)] if getattr(args, "token_chars", 0) else []),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}/v1"
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+            return process, base_url
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError("mock LLM server did not start")
+            time.sleep(0.05)
+
+
+def load_agent(base_url: str):
+    """Import agent.py pointed at the mock server, without network access or INFO logging."""
+    os.environ["LITELLM_LOCAL_MODEL_COST_MAP"] = "True"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_BASE"] = base_url
+    os.environ["OPENAI_API_KEY"] = "sk-mock"
+    os.environ.setdefault("AGENT_LOG_LEVEL", "WARNING")
+    import agent
+
+    logging.getLogger().setLevel(logging.WARNING)
+    return agent
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _request_kwargs(model: str, i: int, agent_settings: dict = None, distinct: int = 7) -> dict:
+    kwargs = {
+        "model": model,
+        "messages": [{"role": "user", "content": f"What's the weather in city {i % distinct}?"}],
+        "api_base": os.environ["OPENAI_BASE_URL"],
+        "api_key": os.environ["OPENAI_API_KEY"],
+    }
+    if agent_settings:
+        # config.yaml の model_info.agent_settings と同じ経路で設定を渡す
+        kwargs["litellm_params"] = {"model_info": {"agent_settings": agent_settings}}
+    return kwargs
+
+
+async def _one_request(llm, mode: str, model: str, i: int, agent_settings: dict = None, distinct: int = 7) -> tuple:
+    """Returns (latency, ttft) in seconds."""
+    return await _drive(llm, mode, _request_kwargs(model, i, agent_settings, distinct))
+
+
+async def _drive(llm, mode: str, kwargs: dict) -> tuple:
+    """Run one request through ``mode``; returns (latency, ttft) in seconds."""
+    start = time.perf_counter()
+    ttft = None
+    if mode == "astreaming":
+        async for chunk in llm.astreaming(**kwargs):
+            if ttft is None and chunk["text"]:
+                ttft = time.perf_counter() - start
+    elif mode == "acompletion":
+        await llm.acompletion(**kwargs)
+    else:
+        await asyncio.to_thread(llm.completion, **kwargs)
+    latency = time.perf_counter() - start
+    return latency, ttft if ttft is not None else latency
+
+
+async def run_level(
+    llm, mode: str, model: str, concurrency: int, requests: int, agent_settings: dict = None, distinct: int = 7
+) -> dict:
+    queue = iter(range(requests))
+    latencies, ttfts, errors = [], [], 0
+
+    async def worker():
+        nonlocal errors
+        for i in queue:
+            try:
+                latency, ttft = await _one_request(llm, mode, model, i, agent_settings, distinct)
+            except Exception as e:
+                errors += 1
+                logging.getLogger(__name__).warning(f"request failed: {e}")
+                continue
+            latencies.append(latency)
+            ttfts.append(ttft)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        "ttft_p50_ms": percentile(ttfts, 0.50) * 1000,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "cpu_ms_per_request": cpu / max(1, len(latencies)) * 1000,
+    }
+
+
+def print_results(results: list) -> None:
+    header = f"{'mode':<12s} {'conc':>5s} {'req/s':>8s} {'ttft p50':>9s} {'p50':>8s} {'p95':>8s} {'p99':>8s} {'cpu/req':>8s} {'err':>4s}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['mode']:<12s} {r['concurrency']:>5d} {r['throughput_rps']:>8.1f} {r['ttft_p50_ms']:>7.1f}ms "
+            f"{r['latency_p50_ms']:>6.1f}ms {r['latency_p95_ms']:>6.1f}ms {r['latency_p99_ms']:>6.1f}ms "
+            f"{r['cpu_ms_per_request']:>6.2f}ms {r['errors']:>4d}"
+        )
+
+
+def bench_agent(args) -> None:
+    print("\n" + "=" * 60)
+    print(f"Agent pipeline vs mock LLM (latency={args.latency}s, {args.tokens_per_sec} tok/s, "
+          f"tool p={args.tool_probability}, format={args.tool_format})")
+    print("=" * 60)
+    process, base_url = start_mock_server(args)
+    try:
+        agent = load_agent(base_url)
+        llm = agent.my_custom_llm
+
+        async def run_all() -> list:
+            # litellmのクライアントはイベントループに紐づくため、全レベルを1つのループで実行する
+            return [
+                await run_level(llm, mode, args.model, concurrency, max(args.requests, concurrency))
+                for mode in args.modes
+                for concurrency in args.concurrency
+            ]
+
+        results = asyncio.run(run_all())
+        print_results(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": {k: v for k, v in vars(args).items() if k != "func"}, "results": results}, f, indent=2)
+            print(f"\n📊 Results written to {args.json}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def upstream_requests(base_url: str) -> int:
+    """Chat completion requests the mock server has received so far."""
+    with urllib.request.urlopen(base_url.rsplit("/v1", 1)[0] + "/health", timeout=5) as response:
+        return json.loads(response.read())["requests"]
+
+
+def bench_batch(args) -> None:
+    print("\n" + "=" * 60)
+    print(f"Shared decision calls vs mock LLM (acompletion, concurrency={args.concurrency}, "
+          f"{args.distinct} distinct prompts)")
+    print("=" * 60)
+    process, base_url = start_mock_server(args)
+    try:
+        agent = load_agent(base_url)
+        llm = agent.my_custom_llm
+
+        async def run_all() -> list:
+            results = []
+            for share in (False, True):
+                settings = {"share_decisions": share}
+                before = await asyncio.to_thread(upstream_requests, base_url)
+                result = await run_level(
+                    llm, "acompletion", args.model, args.concurrency, args.requests, settings, args.distinct
+                )
+                sent = await asyncio.to_thread(upstream_requests, base_url) - before
+                result["share_decisions"] = share
+                result["upstream_per_request"] = sent / max(1, result["requests"])
+                results.append(result)
+            return results
+
+        results = asyncio.run(run_all())
+        header = f"{'share':>6s} {'req/s':>8s} {'p50':>8s} {'p95':>8s} {'upstream/req':>13s} {'err':>4s}"
+        print(header)
+        print("-" * len(header))
+        for r in results:
+            print(
+                f"{'on' if r['share_decisions'] else 'off':>6s} {r['throughput_rps']:>8.1f} {r['latency_p50_ms']:>6.1f}ms "
+                f"{r['latency_p95_ms']:>6.1f}ms {r['upstream_per_request']:>13.2f} {r['errors']:>4d}"
+            )
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": {k: v for k, v in vars(args).items() if k != "func"}, "results": results}, f, indent=2)
+            print(f"\n📊 Results written to {args.json}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+# ---------------------------------------------------------------------------
+# Local triage against recorded traffic
+# ---------------------------------------------------------------------------
+
+def load_traffic(path: str) -> list:
+    """Recorded turns: JSONL with ``text`` (or ``messages``) and ``tools``, the tools the model called."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def bench_triage(args) -> None:
+    os.environ["LITELLM_LOCAL_MODEL_COST_MAP"] = "True"
+    os.environ.setdefault("AGENT_LOG_LEVEL", "WARNING")
+    import agent
+    from agent_triage import Triage, evaluate
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if agent.mcp_tools is not None:
+        # MCP サーバーのツールも記録時と同じように登録する
+        asyncio.run(agent.mcp_tools.ensure_tools(agent.registry))
+    samples = load_traffic(args.traffic)
+    rules = []
+    if args.rules:
+        with open(args.rules, encoding="utf-8") as f:
+            rules = json.load(f)
+    needed = sum(1 for sample in samples if sample.get("tools"))
+    redacted = sum(1 for sample in samples if "features" in sample and "text" not in sample)
+
+    print("\n" + "=" * 60)
+    print(f"Local triage vs {len(samples)} recorded turns ({needed} called tools, "
+          f"{len(agent.registry)} tools, {len(rules)} rules, force_above={args.force_above})")
+    print("=" * 60)
+    header = (f"{'answer<':>8s} {'skip P':>7s} {'skip R':>7s} {'force P':>8s} {'force R':>8s} "
+              f"{'saved':>6s} {'p50':>8s} {'max':>8s}")
+    print(header)
+    print("-" * len(header))
+    results = []
+    for answer_below in args.answer_below:
+        result = evaluate(samples, agent.registry, rules, answer_below, args.force_above, Triage())
+        result["answer_below"] = answer_below
+        results.append(result)
+        print(
+            f"{answer_below:>8.3f} {result['skip_precision']:>7.1%} {result['skip_recall']:>7.1%} "
+            f"{result['force_precision']:>8.1%} {result['force_recall']:>8.1%} "
+            f"{result['decision_calls_saved']:>6.1%} {result['p50_us']:>6.1f}us {result['max_us']:>6.1f}us"
+        )
+    print("\nskip P: answered turns that needed no tool; skip R: no-tool turns that were answered directly")
+    if redacted and rules:
+        print(f"⚠️  {redacted} redacted turn(s) were classified without the rules (AGENT_TRIAGE_LOG_REDACT=0 keeps the text)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "func"}, "results": results}, f, indent=2)
+        print(f"\n📊 Results written to {args.json}")
+
+
+# ---------------------------------------------------------------------------
+# Cold start of a fresh worker
+# ---------------------------------------------------------------------------
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+_LITELLM_DIR = os.path.join(_ROOT, "litellm")
+
+# 新しいワーカーと同じく、何も import していないプロセスで計測する
+_COLD_START_SCRIPT = """
+import asyncio, json, sys, time
+start = time.perf_counter()
+import agent
+imported = time.perf_counter() - start
+time.sleep(float(sys.argv[3]))
+from benchmark import _one_request
+async def main():
+    return [await _one_request(agent.my_custom_llm, sys.argv[1], sys.argv[2], i) for i in range(2)]
+(first, first_ttft), (second, second_ttft) = asyncio.run(main())
+print(json.dumps({"import": imported, "first": first, "first_ttft": first_ttft, "second": second}))
+"""
+
+
+def _worker_env(base_url: str, prewarm: str = "") -> dict:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join([_LITELLM_DIR, _ROOT, env.get("PYTHONPATH", "")]),
+        "AGENT_CAPTURE_PATH": "",
+        "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_BASE": base_url,
+        "OPENAI_API_KEY": "sk-mock",
+        "AGENT_LOG_LEVEL": "WARNING",
+        "AGENT_PREWARM": prewarm,
+    })
+    return env
+
+
+def import_breakdown(env: dict, top: int) -> dict:
+    """``python -X importtime -c "import agent"``: total, litellm, and the slowest agent modules (ms)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import agent"],
+        env=env, cwd=_LITELLM_DIR, capture_output=True, text=True, check=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        # "import time: <self us> | <cumulative us> | <indented module name>"
+        parts = line[len("import time:"):].split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+            cumulative.setdefault(parts[2].strip(), int(parts[1]) / 1000)
+    own = sorted(
+        ((name, ms) for name, ms in cumulative.items() if name.startswith("agent")),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+    return {
+        "agent_ms": cumulative.get("agent", 0.0),
+        "litellm_ms": cumulative.get("litellm", 0.0),
+        "slowest": own[1:top + 1],
+    }
+
+
+def bench_coldstart(args) -> None:
+    print("\n" + "=" * 60)
+    print(f"Cold start of a fresh worker vs mock LLM ({args.mode}, {args.runs} runs, "
+          f"startup gap {args.startup_gap}s)")
+    print("=" * 60)
+    process, base_url = start_mock_server(args)
+    try:
+        breakdown = import_breakdown(_worker_env(base_url), args.top)
+        print(f"import agent (-X importtime): {breakdown['agent_ms']:.1f}ms, "
+              f"of which litellm {breakdown['litellm_ms']:.1f}ms")
+        for name, ms in breakdown["slowest"]:
+            print(f"  {name:<28s} {ms:>8.1f}ms")
+
+        results = []
+        for prewarm in ("", args.model):
+            runs = []
+            for _ in range(args.runs):
+                output = subprocess.run(
+                    [sys.executable, "-c", _COLD_START_SCRIPT, args.mode, args.model, str(args.startup_gap)],
+                    env=_worker_env(base_url, prewarm), cwd=_ROOT, capture_output=True, text=True, check=True,
+                ).stdout
+                runs.append(json.loads(output.strip().splitlines()[-1]))
+            results.append({
+                "prewarm": prewarm,
+                **{key: percentile([run[key] for run in runs], 0.5) * 1000 for key in runs[0]},
+            })
+
+        header = f"{'AGENT_PREWARM':<22s} {'import':>9s} {'1st req':>9s} {'1st ttft':>9s} {'2nd req':>9s}"
+        print("\n" + header)
+        print("-" * len(header))
+        for r in results:
+            print(
+                f"{r['prewarm'] or '(unset)':<22s} {r['import']:>7.1f}ms {r['first']:>7.1f}ms "
+                f"{r['first_ttft']:>7.1f}ms {r['second']:>7.1f}ms"
+            )
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({
+                    "args": {k: v for k, v in vars(args).items() if k != "func"},
+                    "imports": breakdown,
+                    "results": results,
+                }, f, indent=2)
+            print(f"\n📊 Results written to {args.json}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+# ---------------------------------------------------------------------------
+# Replay of captured traffic
+# ---------------------------------------------------------------------------
+
+def load_capture(path: str) -> tuple:
+    """Captured requests in arrival order and the captured ``tools`` payloads by digest."""
+    requests, tools = [], {}
+    for record in load_traffic(path):
+        if record.get("kind") == "tools":
+            tools[record["digest"]] = record["tools"]
+        elif record.get("kind") == "request":
+            requests.append(record)
+    requests.sort(key=lambda record: record["t"])
+    return requests, tools
+
+
+def recorded_ttft(record: dict) -> float:
+    """When the captured request received its first answer text, in seconds."""
+    for recorded in record["rounds"]:
+        if recorded.get("tool_calls"):
+            continue
+        offset = recorded["start"]
+        for gap_ms, size in recorded.get("chunks") or ():
+            offset += gap_ms / 1000
+            if size:
+                return offset
+    return record["seconds"]
+
+
+def _captured_results(requests: list) -> dict:
+    """``(tool, canonical arguments) -> (content, seconds)`` from the captured tool rounds."""
+    from agent_cache import canonical_arguments
+
+    results = {}
+    for record in requests:
+        pending = iter(record.get("results") or ())
+        for recorded in record["rounds"]:
+            for _ in recorded.get("tool_calls") or ():
+                result = next(pending, None)
+                if result is None:
+                    break
+                try:
+                    arguments = json.loads(result["arguments"] or "{}")
+                except ValueError:
+                    continue
+                results.setdefault(
+                    (result["name"], canonical_arguments(arguments)),
+                    (result["content"], recorded.get("tool_seconds", 0.0)),
+                )
+    return results
+
+
+def _replay_tool(name: str, results: dict, fallback: tuple):
+    from agent_cache import canonical_arguments
+
+    async def replay(**arguments) -> str:
+        # 記録に無い引数には、同じツールの別の記録を返す
+        content, seconds = results.get((name, canonical_arguments(arguments)), fallback)
+        await asyncio.sleep(seconds)
+        return content
+
+    return replay
+
+
+def install_replay_tools(registry, requests: list, tools: dict) -> None:
+    """Replace the registered tools by the captured ones, returning the captured results after the captured time."""
+    results = _captured_results(requests)
+    fallbacks = {}
+    for (name, _), result in results.items():
+        fallbacks.setdefault(name, result)
+    redacted = any(record.get("redacted") for record in requests)
+    schemas = {schema["function"]["name"]: schema["function"] for payload in tools.values() for schema in payload}
+
+    for name, function in schemas.items():
+        existing = registry.get(name)
+        registry.unregister(name)
+        registry.register_remote(
+            name,
+            function.get("description", ""),
+            function.get("parameters") or {"type": "object", "properties": {}},
+            _replay_tool(name, results, fallbacks.get(name, ("{}", 0.0))),
+            target=f"replay:{name}",
+            cacheable=existing.cacheable if existing is not None else False,
+        )
+        if redacted:
+            # マスクされた引数は enum などに合わないため検証しない
+            registry.get(name).validate = lambda arguments: None
+
+
+def replay_kwargs(record: dict, model: str = None, agent_settings: dict = None) -> dict:
+    """Request kwargs for a captured request, marked so that mock_llm.py answers from its capture."""
+    messages = json.loads(json.dumps(record["messages"]))
+    marker = f"[replay:{replay_key(record)}]"
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            if isinstance(message.get("content"), list):
+                message["content"].append({"type": "text", "text": marker})
+            else:
+                message["content"] = f"{message.get('content') or ''} {marker}"
+            break
+    litellm_params = {"model_info": {"agent_settings": {**record.get("settings", {}), **(agent_settings or {})}}}
+    if record.get("session"):
+        litellm_params["metadata"] = {"chat_id": record["session"]}
+    return {
+        "model": model or "openai/" + record["model"].split("/", 1)[-1],
+        "messages": messages,
+        "api_base": os.environ["OPENAI_BASE_URL"],
+        "api_key": os.environ["OPENAI_API_KEY"],
+        "litellm_params": litellm_params,
+    }
+
+
+async def replay_level(path: str, speed: float, options: dict) -> dict:
+    """Replay a capture in this process at ``speed`` times the recorded arrival rate (0: all at once)."""
+    import agent
+
+    requests, tools = load_capture(path)
+    requests = requests[:options.get("limit") or None]
+    install_replay_tools(agent.registry, requests, tools)
+    llm = agent.my_custom_llm
+    latencies, ttfts, lags, errors = [], [], [], 0
+
+    async def one(record: dict, start: float) -> None:
+        nonlocal errors
+        due = start + ((record["t"] - requests[0]["t"]) / speed if speed > 0 else 0.0)
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        lags.append(time.perf_counter() - due)
+        kwargs = replay_kwargs(record, options.get("model"), options.get("settings"))
+        try:
+            latency, ttft = await _drive(llm, options.get("mode") or record["mode"], kwargs)
+        except Exception as e:
+            errors += 1
+            logging.getLogger(__name__).warning(f"replayed request failed: {e}")
+            return
+        latencies.append(latency)
+        ttfts.append(ttft)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(one(record, wall_start) for record in requests))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {
+        "speed": speed,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        "ttft_p50_ms": percentile(ttfts, 0.50) * 1000,
+        "ttft_p95_ms": percentile(ttfts, 0.95) * 1000,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "lag_p95_ms": percentile(lags, 0.95) * 1000,
+        "cpu_ms_per_request": cpu / max(1, len(latencies)) * 1000,
+    }
+
+
+# 速度ごとに新しいワーカーで再生し、キャッシュやセッションを前の実行から持ち越さない
+_REPLAY_SCRIPT = """
+import asyncio, json, sys
+from benchmark import replay_level
+print(json.dumps(asyncio.run(replay_level(sys.argv[1], float(sys.argv[2]), json.loads(sys.argv[3])))))
+"""
+
+
+def bench_replay(args) -> None:
+    requests, _ = load_capture(args.traffic)
+    requests = requests[:args.limit or None]
+    if not requests:
+        raise SystemExit(f"No captured requests in {args.traffic}")
+    span = requests[-1]["t"] - requests[0]["t"]
+    completed = [record for record in requests if not record.get("error")]
+    streamed = [record for record in completed if record["mode"] == "astreaming"]
+    print("\n" + "=" * 60)
+    print(f"Replay of {len(requests)} captured requests over {span:.1f}s vs recorded upstream "
+          f"({', '.join(f'{speed}x' if speed else 'burst' for speed in args.speed)})")
+    print("=" * 60)
+
+    args.replay = args.traffic
+    process, base_url = start_mock_server(args)
+    try:
+        env = {**_worker_env(base_url), "AGENT_MCP_CONFIG": ""}
+        options = {"limit": args.limit, "model": args.model, "mode": args.mode, "settings": json.loads(args.settings)}
+        results = [{
+            "speed": "recorded",
+            "requests": len(completed),
+            "errors": len(requests) - len(completed),
+            "throughput_rps": len(completed) / span if span else 0.0,
+            "ttft_p50_ms": percentile([recorded_ttft(record) for record in streamed], 0.50) * 1000,
+            "ttft_p95_ms": percentile([recorded_ttft(record) for record in streamed], 0.95) * 1000,
+            **{
+                f"latency_p{q}_ms": percentile([record["seconds"] for record in completed], q / 100) * 1000
+                for q in (50, 95, 99)
+            },
+            "lag_p95_ms": 0.0,
+            "cpu_ms_per_request": 0.0,
+        }]
+        for speed in args.speed:
+            output = subprocess.run(
+                [sys.executable, "-c", _REPLAY_SCRIPT, args.traffic, str(speed), json.dumps(options)],
+                env=env, cwd=_ROOT, capture_output=True, text=True, check=True,
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+        header = (f"{'speed':>9s} {'req':>5s} {'req/s':>7s} {'ttft p50':>9s} {'ttft p95':>9s} {'p50':>8s} "
+                  f"{'p95':>8s} {'p99':>8s} {'lag p95':>8s} {'cpu/req':>8s} {'err':>4s}")
+        print(header)
+        print("-" * len(header))
+        for r in results:
+            speed = r["speed"] if isinstance(r["speed"], str) else f"{r['speed']}x" if r["speed"] else "burst"
+            print(
+                f"{speed:>9s} {r['requests']:>5d} {r['throughput_rps']:>7.2f} {r['ttft_p50_ms']:>7.1f}ms "
+                f"{r['ttft_p95_ms']:>7.1f}ms {r['latency_p50_ms']:>6.1f}ms {r['latency_p95_ms']:>6.1f}ms "
+                f"{r['latency_p99_ms']:>6.1f}ms {r['lag_p95_ms']:>6.1f}ms {r['cpu_ms_per_request']:>6.2f}ms "
+                f"{r['errors']:>4d}"
+            )
+        print("\nrecorded: latencies measured in production; lag: how late requests started vs their arrival time")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": {k: v for k, v in vars(args).items() if k != "func"}, "results": results}, f, indent=2)
+            print(f"\n📊 Results written to {args.json}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+# ---------------------------------------------------------------------------
+# Coalescing of streamed text chunks
+# ---------------------------------------------------------------------------
+
+def register_agent(agent) -> None:
+    """Route ``my-custom-llm/`` models to the agent, as ``custom_provider_map`` in config.yaml does."""
+    import litellm
+
+    litellm.custom_provider_map = [{"provider": "my-custom-llm", "custom_handler": agent.my_custom_llm}]
+    litellm.utils.custom_llm_setup()
+
+
+async def coalesce_level(model: str, streams: int, rounds: int, agent_settings: dict) -> dict:
+    """
+    ``streams`` concurrent clients, each streaming ``rounds`` requests one after another.
+
+    Requests go through ``litellm.acompletion`` and every chunk is serialized
+    as the proxy's SSE event, so the per-frame cost of the proxy is counted.
+    """
+    import litellm
+
+    latencies, ttfts, stalls, frames, sizes, errors = [], [], [], [], [], 0
+
+    async def client(i: int) -> None:
+        nonlocal errors
+        for n in range(rounds):
+            start = last = time.perf_counter()
+            ttft = None
+            stall = 0.0
+            count = 0
+            try:
+                response = await litellm.acompletion(
+                    model="my-custom-llm/" + model,
+                    messages=[{"role": "user", "content": f"Tell me about city {i * rounds + n} [no-tool]"}],
+                    stream=True,
+                    api_base=os.environ["OPENAI_BASE_URL"],
+                    api_key=os.environ["OPENAI_API_KEY"],
+                    model_info={"agent_settings": agent_settings},
+                )
+                async for chunk in response:
+                    now = time.perf_counter()
+                    frame = f"data: {chunk.model_dump_json(exclude_none=True, exclude_unset=True)}\n\n"
+                    sizes.append(len(frame))
+                    count += 1
+                    if ttft is None and chunk.choices and chunk.choices[0].delta.content:
+                        ttft = now - start
+                    elif ttft is not None:
+                        stall = max(stall, now - last)
+                    last = now
+            except Exception as e:
+                errors += 1
+                logging.getLogger(__name__).warning(f"request failed: {e}")
+                continue
+            latencies.append(time.perf_counter() - start)
+            ttfts.append(ttft if ttft is not None else latencies[-1])
+            stalls.append(stall)
+            frames.append(count)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(streams)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {
+        "coalesce_chars": agent_settings.get("coalesce_chars", 0),
+        "streams": streams,
+        "requests": len(latencies),
+        "errors": errors,
+        "frames_per_sec": sum(frames) / wall if wall else 0.0,
+        "frames_per_request": sum(frames) / max(1, len(frames)),
+        "bytes_per_frame": sum(sizes) / max(1, len(sizes)),
+        "ttft_p50_ms": percentile(ttfts, 0.50) * 1000,
+        "stall_p95_ms": percentile(stalls, 0.95) * 1000,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "cpu_ms_per_request": cpu / max(1, len(latencies)) * 1000,
+    }
+
+
+def bench_coalesce(args) -> None:
+    print("\n" + "=" * 60)
+    print(f"Coalesced streaming vs mock LLM ({args.token_chars} chars per delta, {args.tokens_per_sec} deltas/s, "
+          f"coalesce_wait={args.coalesce_wait}s)")
+    print("=" * 60)
+    process, base_url = start_mock_server(args)
+    try:
+        register_agent(load_agent(base_url))
+
+        async def run_all() -> list:
+            # 最初の接続確立などを計測から外す
+            await coalesce_level(args.model, 4, 1, {})
+            return [
+                await coalesce_level(args.model, streams, args.rounds, {
+                    "coalesce_chars": chars,
+                    "coalesce_wait": args.coalesce_wait,
+                })
+                for streams in args.streams
+                for chars in args.coalesce_chars
+            ]
+
+        results = asyncio.run(run_all())
+        header = (f"{'chars':>6s} {'streams':>8s} {'frames/s':>9s} {'frames/req':>11s} {'B/frame':>8s} "
+                  f"{'ttft p50':>9s} {'stall p95':>10s} {'p50':>8s} {'p95':>8s} {'cpu/req':>8s} {'err':>4s}")
+        print(header)
+        print("-" * len(header))
+        for r in results:
+            print(
+                f"{r['coalesce_chars']:>6d} {r['streams']:>8d} {r['frames_per_sec']:>9.0f} "
+                f"{r['frames_per_request']:>11.1f} {r['bytes_per_frame']:>8.0f} {r['ttft_p50_ms']:>7.1f}ms "
+                f"{r['stall_p95_ms']:>8.1f}ms {r['latency_p50_ms']:>6.1f}ms {r['latency_p95_ms']:>6.1f}ms "
+                f"{r['cpu_ms_per_request']:>6.2f}ms {r['errors']:>4d}"
+            )
+        print("\nchars 0: coalescing off; stall: longest time between two frames of a response")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": {k: v for k, v in vars(args).items() if k != "func"}, "results": results}, f, indent=2)
+            print(f"\n📊 Results written to {args.json}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    chunks = sub.add_parser("chunks", help="micro-benchmark of the streaming chunk adapter")
+    chunks.add_argument("--chunks", type=int, default=200000)
+    chunks.add_argument("--repeat", type=int, default=5)
+    chunks.set_defaults(func=bench_chunks)
+
+    agent = sub.add_parser("agent", help="end-to-end agent benchmark against a local mock LLM server")
+    agent.add_argument("--model", default="openai/mock-gpt-5")
+    agent.add_argument("--modes", nargs="+", choices=["completion", "acompletion", "astreaming"],
+                       default=["completion", "acompletion", "astreaming"])
+    agent.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    agent.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    agent.add_argument("--latency", type=float, default=0.05)
+    agent.add_argument("--tokens-per-sec", type=float, default=500.0)
+    agent.add_argument("--tokens", type=int, default=50)
+    agent.add_argument("--tool-probability", type=float, default=0.5)
+    agent.add_argument("--tool-format", choices=["gpt-5", "no-name", "qwen3"], default="gpt-5")
+    agent.add_argument("--json", help="write results to this file (for regression gating)")
+    agent.set_defaults(func=bench_agent)
+
+    batch = sub.add_parser("batch", help="acompletion throughput with and without shared decision calls")
+    batch.add_argument("--model", default="openai/mock-gpt-5")
+    batch.add_argument("--concurrency", type=int, default=32)
+    batch.add_argument("--requests", type=int, default=256)
+    batch.add_argument("--distinct", type=int, default=7, help="number of distinct prompts in the workload")
+    batch.add_argument("--latency", type=float, default=0.05)
+    batch.add_argument("--tokens-per-sec", type=float, default=500.0)
+    batch.add_argument("--tokens", type=int, default=50)
+    batch.add_argument("--tool-probability", type=float, default=0.5)
+    batch.add_argument("--tool-format", choices=["gpt-5", "no-name", "qwen3"], default="gpt-5")
+    batch.add_argument("--json", help="write results to this file")
+    batch.set_defaults(func=bench_batch)
+
+    triage = sub.add_parser("triage", help="precision/recall of local triage against recorded turns")
+    triage.add_argument("--traffic", required=True, help="JSONL written via AGENT_TRIAGE_LOG")
+    triage.add_argument("--rules", help="JSON file with a list of triage_rules")
+    triage.add_argument("--answer-below", type=float, nargs="+", default=[0.0, 0.02, 0.05, 0.1, 0.2],
+                        help="triage_answer_below values to compare")
+    triage.add_argument("--force-above", type=float, default=0.0, help="triage_force_above (0 disables)")
+    triage.add_argument("--json", help="write results to this file")
+    triage.set_defaults(func=bench_triage)
+
+    coldstart = sub.add_parser("coldstart", help="import time and first-request latency of a fresh worker")
+    coldstart.add_argument("--model", default="openai/mock-gpt-5")
+    coldstart.add_argument("--mode", choices=["completion", "acompletion", "astreaming"], default="astreaming")
+    coldstart.add_argument("--runs", type=int, default=5, help="fresh processes per configuration (median is shown)")
+    coldstart.add_argument("--startup-gap", type=float, default=0.5,
+                           help="seconds between import and the first request (rest of the proxy startup)")
+    coldstart.add_argument("--top", type=int, default=8, help="slowest agent modules to list")
+    coldstart.add_argument("--latency", type=float, default=0.05)
+    coldstart.add_argument("--tokens-per-sec", type=float, default=500.0)
+    coldstart.add_argument("--tokens", type=int, default=50)
+    coldstart.add_argument("--tool-probability", type=float, default=0.5)
+    coldstart.add_argument("--tool-format", choices=["gpt-5", "no-name", "qwen3"], default="gpt-5")
+    coldstart.add_argument("--json", help="write results to this file (for regression gating)")
+    coldstart.set_defaults(func=bench_coldstart)
+
+    replay = sub.add_parser("replay", help="re-drive captured traffic against the agent with recorded upstream")
+    replay.add_argument("--traffic", required=True, help="JSONL written via AGENT_CAPTURE_PATH")
+    replay.add_argument("--speed", type=float, nargs="+", default=[1.0],
+                        help="arrival rate relative to the capture (2 = twice as fast, 0 = all at once)")
+    replay.add_argument("--settings", default="{}",
+                        help="JSON agent_settings applied on top of the captured ones (to compare agent changes)")
+    replay.add_argument("--model", help="model for every request (default: openai/<captured model>)")
+    replay.add_argument("--mode", choices=["acompletion", "astreaming"], help="override the captured mode")
+    replay.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    replay.add_argument("--json", help="write results to this file (for regression gating)")
+    # 印の無いリクエスト用の mock_llm.py の設定
+    replay.set_defaults(func=bench_replay, latency=0.05, tokens_per_sec=500.0, tokens=50, tool_probability=0.0,
+                        tool_format="gpt-5")
+
+    coalesce = sub.add_parser("coalesce", help="frames and CPU of many streams with and without chunk coalescing")
+    coalesce.add_argument("--model", default="openai/mock-gpt-5")
+    coalesce.add_argument("--streams", type=int, nargs="+", default=[16, 64], help="concurrent streams")
+    coalesce.add_argument("--rounds", type=int, default=2, help="requests per stream")
+    coalesce.add_argument("--coalesce-chars", type=int, nargs="+", default=[0, 16, 32, 64],
+                          help="coalesce_chars values to compare (0 disables coalescing)")
+    coalesce.add_argument("--coalesce-wait", type=float, default=0.02, help="coalesce_wait in seconds")
+    coalesce.add_argument("--latency", type=float, default=0.05)
+    coalesce.add_argument("--tokens-per-sec", type=float, default=200.0, help="deltas per second per stream")
+    coalesce.add_argument("--tokens", type=int, default=40, help="answer length in words")
+    coalesce.add_argument("--token-chars", type=int, default=2, help="characters per upstream delta")
+    coalesce.add_argument("--json", help="write results to this file (for regression gating)")
+    coalesce.set_defaults(func=bench_coalesce, tool_probability=0.0, tool_format="gpt-5")
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,427 +1,669 @@
-from re import I
-from typing import AsyncIterator, Iterator
+from typing import AsyncIterator, Optional
+import contextlib
+import dataclasses
+import hashlib
 import time
+import functools
 import json
 import logging
+import os
+import sys
 
 import litellm
 from litellm.types.utils import GenericStreamingChunk
 
-# ロガーの設定
-logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# config.yamlからファイルパスで読み込まれるため、同じディレクトリのモジュールを import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from agent_batch import decision_calls  # noqa: E402
+from agent_cache import response_cache, tool_cache  # noqa: E402
+from agent_clients import client_pool  # noqa: E402
+from agent_coalesce import coalesce  # noqa: E402
+from agent_context import context_manager, default_budget  # noqa: E402
+from agent_metrics import StreamClock, Timer, metrics, start_metrics_server  # noqa: E402
+from agent_prompt import cache_kwargs, record_usage, stable_prefix  # noqa: E402
+from agent_registry import ToolRegistry  # noqa: E402
+from agent_router import as_deployment, deployment_name, litellm_kwargs, open_stream, router  # noqa: E402
+from agent_scheduler import (  # noqa: E402
+    PRIORITY_ANSWER,
+    PRIORITY_FOLLOW_UP,
+    PRIORITY_NEW,
+    QueueTimeoutError,
+    scheduler,
+)
+from agent_runtime import EarlyToolCalls, iter_tool_calls, run_sync, run_tool_calls  # noqa: E402
+from agent_session import session_id, session_store, turn_key  # noqa: E402
+from agent_settings import resolve_settings  # noqa: E402
+from agent_speculation import SpeculativeStream, speculation  # noqa: E402
+from agent_triage import ANSWER, FORCE, forced_choice, triage  # noqa: E402
+from agent_stream import (  # noqa: E402
+    ToolCallAssembler,
+    close_stream,
+    finish_chunk,
+    progress_text,
+    text_chunk,
+    unpack_chunk,
+    usage_dict,
 )
 
+# 任意の機能のモジュールは、環境変数で有効にした場合だけ import する
+if os.environ.get("AGENT_MCP_CONFIG"):
+    from agent_mcp import mcp_tools  # noqa: E402
+else:
+    mcp_tools = None
+if os.environ.get("AGENT_CAPTURE_PATH"):
+    from agent_capture import capture, recording  # noqa: E402
+else:
+    capture = None
+if os.environ.get("AGENT_PREWARM"):
+    from agent_prewarm import start_prewarm  # noqa: E402
+else:
+    start_prewarm = None
 
-def get_current_weather(location: str, unit: str = "celsius") -> str:
-    """
-    Get the current weather in a given location.
+logger = logging.getLogger(__name__)
+# レスポンスキャッシュに保存するラウンドの形 (acompletion / astreaming 共通)
+_ROUND_KEYS = frozenset(("text", "tool_calls", "finish_reason", "usage"))
 
-    Args:
-        location: The city and state, e.g. San Francisco, CA
-        unit: The unit of temperature, either "celsius" or "fahrenheit"
 
-    Returns:
-        JSON string with weather information
+def _configure_logging() -> None:
+    """
+    エージェントのモジュール (agent*) のロガーだけを AGENT_LOG_LEVEL (既定 INFO, 空で設定しない) にする。
+    import した側 (プロキシ) のルートロガーの設定は変更しない
     """
-    # This is a mock implementation
-    weather_data = {
-        "location": location,
-        "temperature": 22,
-        "unit": unit,
-        "forecast": ["sunny", "windy"],
+    level = os.environ.get("AGENT_LOG_LEVEL", "INFO").upper()
+    if not level:
+        return
+    handler = None
+    if not logging.getLogger().handlers:
+        # ルートに出力先が無ければ、エージェントのログだけを標準エラーに出す
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    for name in list(logging.Logger.manager.loggerDict):
+        if name.startswith("agent"):
+            module_logger = logging.getLogger(name)
+            module_logger.setLevel(level)
+            if handler is not None and not module_logger.handlers:
+                module_logger.addHandler(handler)
+                module_logger.propagate = False
+
+
+_configure_logging()
+
+
+# ツールの登録: スキーマは関数のシグネチャとdocstringから自動生成され、
+# モジュールは最初の呼び出し時に import される
+registry = ToolRegistry()
+registry.register_lazy("agent_tools.weather:get_current_weather")
+# AGENT_MCP_CONFIG に書いた MCP サーバーのツールは最初のリクエストで一覧を取得して登録する (agent_mcp)
+
+
+def _cache_samples() -> list:
+    """キャッシュの統計を/metricsのgaugeとして公開する (/metricsのスレッドから呼ばれる)"""
+    samples = []
+    for name, counts in tool_cache.stats()["tools"].items():
+        for kind, value in counts.items():
+            samples.append((f"agent_tool_cache_{kind}", {"tool": name}, value))
+    for kind, value in response_cache.stats().items():
+        samples.append((f"agent_response_cache_{kind}", {}, value))
+    samples.append(("agent_sessions", {}, len(session_store)))
+    return samples
+
+
+metrics.add_collector(_cache_samples)
+start_metrics_server()
+
+# model = "ollama_chat/qwen3:0.6b"
+# model = "openai/gpt-5-nano"
+
+def _tool_call_dicts(response) -> list:
+    """非ストリーミング応答からtool_callsを辞書形式で取り出す"""
+    if not (hasattr(response, "choices") and len(response.choices) > 0):
+        return []
+    message = getattr(response.choices[0], "message", None)
+    tool_calls = getattr(message, "tool_calls", None)
+    if not tool_calls:
+        return []
+    return [
+        {
+            "id": tc.id,
+            "type": "function",
+            "function": {
+                "name": tc.function.name,
+                "arguments": tc.function.arguments,
+            }
+        }
+        for tc in tool_calls
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _model_budget(model: str) -> int:
+    return default_budget(model)
+
+
+def _compact(settings, model: str, messages: list) -> list:
+    """上流に送るメッセージをトークン上限に収まるように圧縮し、接頭辞が毎回同じ並びになるように整える (messages自体は変更しない)"""
+    budget = settings.context_budget or _model_budget(model)
+    return stable_prefix(context_manager.compact(model, messages, budget, settings.max_tool_result_chars))
+
+
+def _tools_key(tool_kwargs: dict) -> str:
+    """キャッシュ・共有する判定のキーに使うツールの引数 (tool_choice で指定したツールも区別する)"""
+    choice = tool_kwargs.get("tool_choice")
+    return registry.tools_json + (json.dumps(choice, sort_keys=True) if choice else "")
+
+
+def _decision_cache_key(settings, model: str, messages: list, tool_kwargs: dict):
+    """ツール判定の呼び出し (toolsあり) のみキャッシュ対象にする"""
+    if not (settings.response_cache and tool_kwargs):
+        return None
+    return response_cache.key(model, messages, _tools_key(tool_kwargs))
+
+
+async def _cached_round(cache_key) -> Optional[dict]:
+    """キャッシュされたラウンド。acompletion と astreaming で共通の形 (_round_payload) のものだけを使う"""
+    if not cache_key:
+        return None
+    cached = await response_cache.aget(cache_key)
+    if cached is None or not _ROUND_KEYS <= cached.keys():
+        return None
+    return cached
+
+
+def _round_payload(response) -> dict:
+    """非ストリーミング応答をキャッシュ用の形にする"""
+    choice = response.choices[0] if getattr(response, "choices", None) else None
+    message = getattr(choice, "message", None)
+    return {
+        "text": getattr(message, "content", None) or "",
+        "tool_calls": _tool_call_dicts(response),
+        "finish_reason": getattr(choice, "finish_reason", None),
+        "usage": dict(usage_dict(getattr(response, "usage", None))),
     }
-    return json.dumps(weather_data)
-
-
-# Define tools schema for function calling
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "get_current_weather",
-            "description": "Get the current weather in a given location",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "location": {
-                        "type": "string",
-                        "description": "The city and state, e.g. San Francisco, CA",
-                    },
-                    "unit": {
-                        "type": "string",
-                        "enum": ["celsius", "fahrenheit"],
-                        "description": "The unit of temperature",
-                    },
-                },
-                "required": ["location"],
+
+
+def _round_response(model: str, cached: dict) -> litellm.ModelResponse:
+    """キャッシュされたラウンドから非ストリーミング応答を組み立てる"""
+    return litellm.ModelResponse(
+        model=model,
+        choices=[{
+            "index": 0,
+            "finish_reason": cached["finish_reason"] or "stop",
+            "message": {
+                "role": "assistant",
+                "content": cached["text"] or None,
+                "tool_calls": cached["tool_calls"] or None,
             },
-        },
-    }
-]
+        }],
+        usage=cached["usage"],
+    )
 
-# Map of available functions
-available_functions = {
-    "get_current_weather": get_current_weather,
-}
 
-# model = "ollama_chat/qwen3:0.6b"
-# model = "openai/gpt-5-nano"
+def _primary_deployment(kwargs: dict, settings) -> dict:
+    """config.yaml の litellm_params の api_base / api_key をそのまま上流に渡す"""
+    deployment = {"model": kwargs.get("model", "")}
+    for key in ("api_base", "api_key"):
+        if kwargs.get(key):
+            deployment[key] = kwargs[key]
+    if settings.max_concurrency is not None:
+        deployment["max_concurrency"] = settings.max_concurrency
+    return deployment
 
-class MyCustomLLM(litellm.CustomLLM):
-    def completion(self, *args, **kwargs) -> litellm.ModelResponse:
-        model = kwargs.get("model", "")
-        messages = kwargs.get("messages", [])
-        logger.info(f"completion called with {len(messages)} messages")
-        logger.info(f"completion: kwargs keys = {list(kwargs.keys())}")
-        logger.info(f"completion: model parameter = '{model}'")
-
-        # ツール呼び出しをチェック
-        response = litellm.completion(
-            model=model,
-            messages=messages,
-            tools=tools,
-        )
 
-        # ツール呼び出しが必要な場合
-        if (hasattr(response, "choices") and
-            len(response.choices) > 0 and
-            hasattr(response.choices[0], "finish_reason") and
-            response.choices[0].finish_reason == "tool_calls" and
-            hasattr(response.choices[0].message, "tool_calls") and
-            response.choices[0].message.tool_calls):
+def _deployments(settings, primary: dict, decision: bool) -> list:
+    """上流の候補: ツール判定には decision_model を優先し、失敗・遅延時は要求されたモデルとフォールバックを使う"""
+    answer = [primary] + [as_deployment(entry) for entry in settings.fallbacks]
+    if decision and settings.decision_model:
+        return [as_deployment(settings.decision_model)] + answer
+    return answer
 
-            tool_calls = response.choices[0].message.tool_calls
-            logger.info(f"Tool calls detected in completion: {len(tool_calls)} tool(s)")
 
-            # メッセージに追加
-            messages.append({
-                "role": "assistant",
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments,
-                        }
-                    }
-                    for tc in tool_calls
-                ],
-            })
-
-            # ツールを実行
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
-                logger.info(f"Executing tool in completion: {function_name} with args: {function_args}")
-
-                if function_name in available_functions:
-                    function_to_call = available_functions[function_name]
-                    function_response = function_to_call(**function_args)
-                    logger.info(f"Tool {function_name} executed successfully in completion")
-
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": function_response,
-                    })
-
-            # 最終応答を取得
-            logger.info("Getting final response in completion")
-            final_response = litellm.completion(
-                model=model,
-                messages=messages,
-            )
-            return final_response
+def _decision_priority(iteration: int) -> int:
+    """進行中の会話 (ツール実行後の判定) を新しいリクエストより先に通す"""
+    return PRIORITY_NEW if iteration == 0 else PRIORITY_FOLLOW_UP
 
-        return response
 
-    async def acompletion(self, *args, **kwargs) -> litellm.ModelResponse:
-        model = kwargs.get("model", "")
-        messages = kwargs.get("messages", [])
-        logger.info(f"acompletion called with {len(messages)} messages")
-        logger.info(f"acompletion: kwargs keys = {list(kwargs.keys())}")
-        logger.info(f"acompletion: model parameter = '{model}'")
-
-        # ツール呼び出しをチェック
-        response = await litellm.acompletion(
-            model=model,
-            messages=messages,
-            tools=tools,
-        )
-        print(response)
+def _triage(settings, messages: list):
+    """最初のラウンドの前に、最後のユーザーメッセージからツール判定を省けるかを手元で振り分ける"""
+    if settings.triage not in ("shadow", "on"):
+        return None
+    verdict = triage.classify(
+        messages, registry, settings.triage_rules, settings.triage_answer_below, settings.triage_force_above
+    )
+    triage.count(verdict, settings.triage)
+    return verdict
 
-        # ツール呼び出しが必要な場合
-        if (hasattr(response, "choices") and
-            len(response.choices) > 0 and
-            hasattr(response.choices[0], "finish_reason") and
-            response.choices[0].finish_reason == "tool_calls" and
-            hasattr(response.choices[0].message, "tool_calls") and
-            response.choices[0].message.tool_calls):
 
-            tool_calls = response.choices[0].message.tool_calls
-            logger.info(f"Tool calls detected in acompletion: {len(tool_calls)} tool(s)")
+def _tool_kwargs(settings, iteration: int, verdict) -> dict:
+    """このラウンドで上流に渡すツールの引数"""
+    if iteration >= settings.max_iterations:
+        # 上限に達したらツール無しで最終応答を生成させる
+        return {}
+    if iteration == 0 and verdict is not None and settings.triage == "on":
+        if verdict.route == ANSWER:
+            return {}
+        if verdict.route == FORCE:
+            return {"tools": registry.tools, "tool_choice": forced_choice(verdict.tool)}
+    return {"tools": registry.tools}
 
-            # メッセージに追加
-            messages.append({
-                "role": "assistant",
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments,
-                        }
-                    }
-                    for tc in tool_calls
-                ],
-            })
-
-            # ツールを実行
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
-                logger.info(f"Executing tool in acompletion: {function_name} with args: {function_args}")
-
-                if function_name in available_functions:
-                    function_to_call = available_functions[function_name]
-                    function_response = function_to_call(**function_args)
-                    logger.info(f"Tool {function_name} executed successfully in acompletion")
-
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": function_response,
-                    })
-
-            # 最終応答を取得
-            logger.info("Getting final response in acompletion")
-            final_response = await litellm.acompletion(
-                model=model,
-                messages=messages,
-            )
-            return final_response
 
-        return response
+def _open_decision(tool_kwargs: dict) -> bool:
+    """ツールを使うかどうかをモデルに判断させるラウンドか (tool_choice で指定したラウンドは除く)"""
+    return bool(tool_kwargs) and "tool_choice" not in tool_kwargs
+
+
+def _overloaded(error: QueueTimeoutError, deployments: list) -> litellm.RateLimitError:
+    return litellm.RateLimitError(str(error), llm_provider="my-custom-llm", model=deployments[0]["model"])
 
-    async def astreaming(self, *args, **kwargs) -> AsyncIterator[GenericStreamingChunk]:
-        # OpenWebUIからのメッセージを取得
-        model = kwargs.get("model", "")
-        messages = kwargs.get("messages", [])
-        logger.info(f"astreaming called with {len(messages)} messages")
-        logger.info(f"astreaming: kwargs keys = {list(kwargs.keys())}")
-        logger.info(f"astreaming: model parameter = '{model}'")
 
-        # ストリーミングでツール呼び出しをチェックするかどうかの設定
-        use_stream_in_initial_completion = False  # True: stream=True, False: stream=False
+async def _acquire(settings, deployment: dict, priority: int):
+    return await scheduler.acquire(
+        deployment_name(deployment), deployment.get("max_concurrency"), priority, settings.queue_timeout
+    )
 
-        # まずツール呼び出しの必要性をチェック
-        logger.info(f"Checking if tool calls are needed (use_stream_in_initial_completion={use_stream_in_initial_completion})")
 
-        if use_stream_in_initial_completion:
-            # ストリーミングモード
-            initial_stream = await litellm.acompletion(
-                model=model,
+def _upstream_kwargs(settings, deployment: dict, messages: list, tool_kwargs: dict, stream: bool) -> dict:
+    """deployment の引数に、プールしたクライアントと接頭辞キャッシュのヒントを加える"""
+    kwargs = {**litellm_kwargs(deployment), **client_pool.client_kwargs(deployment, retries=not settings.fallbacks)}
+    if settings.prompt_cache_hints:
+        tools_json = registry.tools_json if tool_kwargs else ""
+        kwargs.update(cache_kwargs(deployment, messages, tools_json, stream, settings.keep_alive))
+    return kwargs
+
+
+async def _complete(settings, deployments: list, messages: list, tool_kwargs: dict, priority: int):
+    async def attempt(deployment: dict):
+        slot = await _acquire(settings, deployment, priority)
+        try:
+            return await litellm.acompletion(
+                **_upstream_kwargs(settings, deployment, messages, tool_kwargs, False), messages=messages, **tool_kwargs
+            )
+        finally:
+            slot.release()
+
+    try:
+        _, response = await router.call(deployments, attempt, settings.hedge_quantile, settings.hedge_min_delay)
+    except QueueTimeoutError as e:
+        raise _overloaded(e, deployments) from e
+    return response
+
+
+async def _open_stream(settings, deployments: list, messages: list, tool_kwargs: dict, priority: int):
+    async def attempt(deployment: dict):
+        # ストリームは読み終わるか閉じられるまでスロットを保持する
+        slot = await _acquire(settings, deployment, priority)
+        try:
+            return await open_stream(litellm.acompletion(
+                **_upstream_kwargs(settings, deployment, messages, tool_kwargs, True),
                 messages=messages,
                 stream=True,
-                tools=tools,
-            )
+                **tool_kwargs,
+            ), on_close=slot.release)
+        except BaseException:
+            slot.release()
+            raise
+
+    try:
+        _, stream = await router.call(
+            deployments, attempt, settings.hedge_quantile, settings.hedge_min_delay, discard=close_stream
+        )
+    except QueueTimeoutError as e:
+        raise _overloaded(e, deployments) from e
+    return stream
 
-            # ストリーミングレスポンスからツール呼び出しを収集
-            collected_tool_calls = []
-            collected_content = ""
-            finish_reason = None
-
-            async for chunk in initial_stream:
-                logger.info(f"Chunk: {chunk}")
-                if hasattr(chunk, "choices") and len(chunk.choices) > 0:
-                    choice = chunk.choices[0]
-
-                    # finish_reasonを記録
-                    if hasattr(choice, "finish_reason") and choice.finish_reason:
-                        finish_reason = choice.finish_reason
-
-                    # deltaからツール呼び出しとコンテンツを収集
-                    if hasattr(choice, "delta"):
-                        delta = choice.delta
-
-                        # コンテンツを収集
-                        if hasattr(delta, "content") and delta.content:
-                            collected_content += delta.content
-
-                        # ツール呼び出しを収集
-                        if hasattr(delta, "tool_calls") and delta.tool_calls:
-                            for tool_call_delta in delta.tool_calls:
-                                index = tool_call_delta.index if hasattr(tool_call_delta, "index") else 0
-
-                                # インデックスに対応するツール呼び出しを確保
-                                while len(collected_tool_calls) <= index:
-                                    collected_tool_calls.append({
-                                        "id": None,
-                                        "type": "function",
-                                        "function": {
-                                            "name": "",
-                                            "arguments": ""
-                                        }
-                                    })
-
-                                # ツール呼び出し情報を蓄積
-                                if hasattr(tool_call_delta, "id") and tool_call_delta.id:
-                                    collected_tool_calls[index]["id"] = tool_call_delta.id
-
-                                if hasattr(tool_call_delta, "type") and tool_call_delta.type:
-                                    collected_tool_calls[index]["type"] = tool_call_delta.type
-
-                                if hasattr(tool_call_delta, "function"):
-                                    func = tool_call_delta.function
-                                    if hasattr(func, "name") and func.name:
-                                        collected_tool_calls[index]["function"]["name"] += func.name
-                                    if hasattr(func, "arguments") and func.arguments:
-                                        collected_tool_calls[index]["function"]["arguments"] += func.arguments
-
-            logger.info(f"Stream collection complete. finish_reason={finish_reason}, tool_calls={len(collected_tool_calls)}")
-            logger.info(f"Collected tool calls: {collected_tool_calls}")
-        else:
-            # 非ストリーミングモード（従来の方法）
-            initial_response = await litellm.acompletion(
-                model=model,
-                messages=messages,
-                stream=False,
-                tools=tools,
-            )
-            logger.info(f"Non-streaming response: {initial_response}")
-
-            # レスポンスからツール呼び出しを取得
-            collected_tool_calls = []
-            finish_reason = None
-
-            if (hasattr(initial_response, "choices") and
-                len(initial_response.choices) > 0):
-                choice = initial_response.choices[0]
-
-                if hasattr(choice, "finish_reason"):
-                    finish_reason = choice.finish_reason
-
-                if (hasattr(choice, "message") and
-                    hasattr(choice.message, "tool_calls") and
-                    choice.message.tool_calls):
-                    # tool_callsを辞書形式に変換
-                    for tc in choice.message.tool_calls:
-                        collected_tool_calls.append({
-                            "id": tc.id,
-                            "type": "function",
-                            "function": {
-                                "name": tc.function.name,
-                                "arguments": tc.function.arguments,
-                            }
-                        })
 
-            logger.info(f"Non-streaming collection complete. finish_reason={finish_reason}, tool_calls={len(collected_tool_calls)}")
-            logger.info(f"Collected tool calls: {collected_tool_calls}")
+def _copy_response(response) -> litellm.ModelResponse:
+    return litellm.ModelResponse(**response.model_dump())
 
-        # ツール呼び出しが必要かチェック
-        if finish_reason == "tool_calls" and collected_tool_calls:
 
-            # ツール呼び出しを実行
-            logger.info(f"Tool calls detected: {len(collected_tool_calls)} tool(s) to execute")
+def _call_key(settings, model: str, deployments: list, messages: list, tool_kwargs: dict) -> tuple:
+    """同じ上流呼び出しになる判定だけが等しくなるキー (メッセージ・ツール・tool_choice・接続先と認証情報・設定)"""
+    fingerprint = json.dumps([deployments, dataclasses.asdict(settings)], sort_keys=True, default=str)
+    return (
+        response_cache.key(model, messages, _tools_key(tool_kwargs)),
+        hashlib.blake2b(fingerprint.encode(), digest_size=16).hexdigest(),
+    )
 
-            # メッセージにアシスタントの応答を追加
-            messages.append({
-                "role": "assistant",
-                "tool_calls": collected_tool_calls,
-            })
-
-            # 各ツールを実行して結果をメッセージに追加
-            for tool_call in collected_tool_calls:
-                function_name = tool_call["function"]["name"]
-                function_args = json.loads(tool_call["function"]["arguments"])
-                logger.info(f"Executing tool: {function_name} with args: {function_args}")
-
-                if function_name in available_functions:
-                    function_to_call = available_functions[function_name]
-                    function_response = function_to_call(**function_args)
-                    logger.info(f"Tool {function_name} executed successfully, response: {function_response}")
-
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call["id"],
-                        "content": function_response,
-                    })
-                else:
-                    logger.warning(f"Tool {function_name} not found in available_functions")
 
-            # ツール呼び出し結果を踏まえて最終応答を取得 (ストリーミング)
-            logger.info("Getting final response with tool results (streaming)")
-            final_response = await litellm.acompletion(
-                model=model,
-                messages=messages,
-                stream=True,
-            )
+async def _decide(settings, model: str, deployments: list, messages: list, tool_kwargs: dict, priority: int):
+    """非ストリーミングのツール判定: share_decisions が設定されていれば、進行中の同じ判定の応答を共有する"""
 
-            # ストリーミングレスポンスをyield
-            async for chunk in final_response:
-                if hasattr(chunk, "choices") and len(chunk.choices) > 0:
-                    choice = chunk.choices[0]
-                    delta = choice.delta if hasattr(choice, "delta") else None
-
-                    # usageの処理: Pydanticモデルの場合はmodel_dump()を使用
-                    usage_dict = {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0}
-                    if hasattr(chunk, "usage") and chunk.usage:
-                        if hasattr(chunk.usage, "model_dump"):
-                            usage_dict = chunk.usage.model_dump()
-                        elif hasattr(chunk.usage, "dict"):
-                            usage_dict = chunk.usage.dict()
-                        elif isinstance(chunk.usage, dict):
-                            usage_dict = chunk.usage
-
-                    generic_streaming_chunk: GenericStreamingChunk = {
-                        "finish_reason": choice.finish_reason if hasattr(choice, "finish_reason") else None,
-                        "index": choice.index if hasattr(choice, "index") else 0,
-                        "is_finished": choice.finish_reason is not None if hasattr(choice, "finish_reason") else False,
-                        "text": delta.content if delta and hasattr(delta, "content") and delta.content else "",
-                        "tool_use": None,
-                        "usage": usage_dict,
-                    }
-                    yield generic_streaming_chunk
-            logger.info("Tool-based streaming response completed")
-        else:
-            # ツール呼び出しが不要な場合は通常のストリーミング応答
-            logger.info("No tool calls needed, proceeding with normal streaming response")
-            response = await litellm.acompletion(
-                model=model,
-                messages=messages,
-                stream=True,
-            )
+    async def call():
+        response = await _complete(settings, deployments, messages, tool_kwargs, priority)
+        # 共有した呼び出し元の分は数えない
+        record_usage(model, getattr(response, "usage", None))
+        return response
+
+    if not settings.share_decisions:
+        return await call()
+    return await decision_calls.run(
+        _call_key(settings, model, deployments, messages, tool_kwargs), call, share=_copy_response
+    )
+
+
+def _capture(mode: str, kwargs: dict, messages: list):
+    """AGENT_CAPTURE_PATH が設定されていれば、このリクエストのトレースと、終了時にそれを書き出すコンテキストを返す"""
+    trace = capture.start(mode, kwargs, messages, registry) if capture is not None else None
+    if trace is None:
+        return None, contextlib.nullcontext()
+    return trace, recording(trace, messages)
+
+
+async def _turn_replay(kwargs: dict, settings, messages: list):
+    """会話IDがあれば、このターンで記録済みのツール結果を再生成・リトライ時に再利用する"""
+    if not settings.session_replay:
+        return None
+    session = session_id(kwargs)
+    if session is None:
+        return None
+    return await session_store.open(session, turn_key(messages))
+
+
+class MyCustomLLM(litellm.CustomLLM):
+    def completion(self, *args, **kwargs) -> litellm.ModelResponse:
+        # 同期版はエージェントループを重複させず、非同期版を専用のイベントループで実行する
+        return run_sync(self.acompletion(*args, **kwargs))
+
+    async def acompletion(self, *args, **kwargs) -> litellm.ModelResponse:
+        model = kwargs.get("model", "")
+        # 呼び出し元のリストは変更せず、ツールのメッセージはコピーに追加する
+        messages = list(kwargs.get("messages", []))
+        settings = resolve_settings(kwargs)
+        primary = _primary_deployment(kwargs, settings)
+        client_pool.schedule_warm_up(_deployments(settings, primary, True), retries=not settings.fallbacks)
+        if mcp_tools is not None:
+            await mcp_tools.ensure_tools(registry)
+        replay = await _turn_replay(kwargs, settings, messages)
+        verdict = _triage(settings, messages)
+        trace, recorded = _capture("acompletion", kwargs, messages)
+        logger.info(f"acompletion called with {len(messages)} messages (model='{model}')")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"acompletion: kwargs keys = {list(kwargs.keys())}")
+
+        with Timer("agent_request_seconds", mode="acompletion"), recorded:
+            # エージェントループ: ツール呼び出しが無くなるか上限に達するまで繰り返す
+            for iteration in range(settings.max_iterations + 1):
+                tool_kwargs = _tool_kwargs(settings, iteration, verdict)
+                if trace is not None:
+                    trace.begin(bool(tool_kwargs))
+                request_messages = _compact(settings, model, messages)
+                cache_key = _decision_cache_key(settings, model, request_messages, tool_kwargs)
+                cached = await _cached_round(cache_key)
+                if cached is not None:
+                    response = _round_response(model, cached)
+                else:
+                    with Timer("agent_upstream_seconds", phase="decision" if tool_kwargs else "final"):
+                        if tool_kwargs:
+                            response = await _decide(
+                                settings,
+                                model,
+                                _deployments(settings, primary, True),
+                                request_messages,
+                                tool_kwargs,
+                                _decision_priority(iteration),
+                            )
+                        else:
+                            response = await _complete(
+                                settings, _deployments(settings, primary, False), request_messages, {}, PRIORITY_ANSWER
+                            )
+                            record_usage(model, getattr(response, "usage", None))
+                    if cache_key:
+                        await response_cache.aset(cache_key, _round_payload(response))
+
+                tool_calls = _tool_call_dicts(response)
+                if iteration == 0 and verdict is not None and _open_decision(tool_kwargs):
+                    triage.observe(verdict, tool_calls)
+                if not tool_calls:
+                    if tool_kwargs and settings.decision_model:
+                        # 判定用のモデルはツール不要と判断しただけなので、回答は要求されたモデルで生成する
+                        with Timer("agent_upstream_seconds", phase="final"):
+                            response = await _complete(
+                                settings, _deployments(settings, primary, False), request_messages, {}, PRIORITY_ANSWER
+                            )
+                        record_usage(model, getattr(response, "usage", None))
+                    if trace is not None:
+                        trace.response(response, [], cached is not None)
+                    return response
+                if trace is not None:
+                    trace.response(response, tool_calls, cached is not None)
+                logger.info(f"Tool calls detected in acompletion (round {iteration + 1}): {len(tool_calls)} tool(s)")
+
+                # ラウンド内のツールは並行して実行する
+                messages.append({"role": "assistant", "tool_calls": tool_calls})
+                messages.extend(await run_tool_calls(tool_calls, registry, settings.tool_timeout, replay=replay))
+
+            return response
+
+    def astreaming(self, *args, **kwargs) -> AsyncIterator[GenericStreamingChunk]:
+        settings = resolve_settings(kwargs)
+        chunks = self._astreaming(settings, kwargs)
+        if settings.coalesce_chars > 0:
+            # 細かいテキストのチャンクをまとめてから返す (agent_coalesce)
+            return coalesce(chunks, settings.coalesce_chars, settings.coalesce_wait)
+        return chunks
+
+    async def _astreaming(self, settings, kwargs: dict) -> AsyncIterator[GenericStreamingChunk]:
+        # OpenWebUIからのメッセージを取得
+        model = kwargs.get("model", "")
+        messages = list(kwargs.get("messages", []))
+        primary = _primary_deployment(kwargs, settings)
+        client_pool.schedule_warm_up(_deployments(settings, primary, True), retries=not settings.fallbacks)
+        if mcp_tools is not None:
+            await mcp_tools.ensure_tools(registry)
+        replay = await _turn_replay(kwargs, settings, messages)
+        verdict = _triage(settings, messages)
+        trace, recorded = _capture("astreaming", kwargs, messages)
+        logger.info(f"astreaming called with {len(messages)} messages (model='{model}')")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"astreaming: kwargs keys = {list(kwargs.keys())}")
+
+        request_start = time.perf_counter()
+        clock = StreamClock(request_start)
+        with Timer("agent_request_seconds", mode="astreaming"), recorded:
+            for iteration in range(settings.max_iterations + 1):
+                # 1回のstream=Trueでテキストは即座に返しつつ、ツール呼び出しの断片を収集する
+                tool_kwargs = _tool_kwargs(settings, iteration, verdict)
+                if trace is not None:
+                    trace.begin(bool(tool_kwargs))
+                request_messages = _compact(settings, model, messages)
+                cache_key = _decision_cache_key(settings, model, request_messages, tool_kwargs)
+                cached = await _cached_round(cache_key)
+                announced = set()
+                early = None
+                if cached is not None:
+                    # キャッシュされたラウンドの結果を再生する
+                    collected_tool_calls = cached["tool_calls"]
+                    finish_reason = cached["finish_reason"]
+                    finish_index = 0
+                    usage = cached["usage"]
+                    remaining_text = cached["text"]
+                    if trace is not None:
+                        trace.end(collected_tool_calls, finish_reason, usage, text=remaining_text, cached=True)
+                    if remaining_text and collected_tool_calls:
+                        clock.tick()
+                        yield text_chunk(remaining_text)
+                else:
+                    round_start = time.perf_counter()
+                    speculative = None
+                    if _open_decision(tool_kwargs) and speculation.should_speculate(
+                        model, settings.speculation, settings.speculation_threshold
+                    ):
+                        # ツール無しの応答を並行して開始し、ツール不要と分かった時点で流す
+                        speculative = SpeculativeStream(_open_stream(
+                            settings, _deployments(settings, primary, False), request_messages, {}, PRIORITY_ANSWER
+                        ))
+                    if tool_kwargs and settings.early_tool_start:
+                        early = EarlyToolCalls(registry, settings.tool_timeout, replay)
+                    try:
+                        stream = await _open_stream(
+                            settings,
+                            _deployments(settings, primary, bool(tool_kwargs)),
+                            request_messages,
+                            tool_kwargs,
+                            _decision_priority(iteration) if tool_kwargs else PRIORITY_ANSWER,
+                        )
+                        # 回答を別のストリーム (投機した応答、または判定用とは別のモデル) から返すか
+                        answer_elsewhere = speculative is not None or bool(tool_kwargs and settings.decision_model)
+
+                        assembler = ToolCallAssembler(tool_kwargs.get("tools"))
+                        text_parts = []
+                        finish_reason = None
+                        finish_index = 0
+                        usage = None
+
+                        while True:
+                            async for chunk in stream:
+                                index, content, tool_call_deltas, chunk_finish_reason, chunk_usage = unpack_chunk(chunk)
+                                if chunk_usage:
+                                    usage = chunk_usage
+                                if index is None:
+                                    continue
+                                if trace is not None:
+                                    trace.chunk(content, tool_call_deltas)
+
+                                if tool_call_deltas:
+                                    assembler.add(tool_call_deltas)
+                                    if early is not None:
+                                        # 引数のJSONが閉じたツールは残りの生成を待たずに実行を始める
+                                        for ready in assembler.ready_calls():
+                                            early.start(ready)
+                                    if settings.tool_progress:
+                                        # ツール名が分かった時点で引数の生成を待たずに知らせる
+                                        for call_index, name in assembler.named_calls():
+                                            if call_index not in announced:
+                                                announced.add(call_index)
+                                                clock.tick()
+                                                yield text_chunk(progress_text("calling", name), index)
+                                text = assembler.feed_text(content)
+
+                                # finish チャンクはツール呼び出しの有無が確定するまで保留する
+                                if chunk_finish_reason:
+                                    finish_reason = chunk_finish_reason
+                                    finish_index = index
+
+                                if answer_elsewhere:
+                                    if assembler.has_tool_calls:
+                                        # ツールが必要: 投機した応答は破棄する
+                                        if speculative is not None:
+                                            speculation.record(model, won=False, wasted_tokens=speculative.cancel())
+                                            speculative = None
+                                        answer_elsewhere = False
+                                    elif text:
+                                        # テキストで応答し始めた: 判定用のストリームを閉じて回答用のストリームに切り替える
+                                        break
+                                    continue
+
+                                if text:
+                                    text_parts.append(text)
+                                    clock.tick()
+                                    yield text_chunk(text, index)
+                            else:
+                                if not answer_elsewhere:
+                                    break
+                                # contentのJSONで返されたツール呼び出しはストリームの終了時に確定する
+                                assembler.flush_text()
+                                if assembler.has_tool_calls:
+                                    if speculative is not None:
+                                        speculation.record(model, won=False, wasted_tokens=speculative.cancel())
+                                        speculative = None
+                                    break
+                            await close_stream(stream)
+                            if speculative is not None:
+                                speculation.record(model, won=True)
+                                stream, speculative = speculative, None
+                            else:
+                                stream = await _open_stream(
+                                    settings, _deployments(settings, primary, False), request_messages, {}, PRIORITY_ANSWER
+                                )
+                            answer_elsewhere = False
+                            assembler = ToolCallAssembler()
+                            finish_reason = None
+                            finish_index = 0
+                            usage = None
+                    except BaseException:
+                        if early is not None:
+                            early.cancel()
+                        raise
+                    finally:
+                        if speculative is not None:
+                            # ストリーム終了まで判定できなかった場合やクライアント切断時
+                            speculation.record(model, won=False, wasted_tokens=speculative.cancel())
+
+                    remaining_text = assembler.flush_text()
+                    collected_tool_calls = assembler.tool_calls()
+                    if trace is not None:
+                        trace.end(collected_tool_calls, finish_reason, usage)
+                    record_usage(model, usage)
+                    metrics.observe(
+                        "agent_upstream_seconds",
+                        time.perf_counter() - round_start,
+                        phase="decision" if tool_kwargs else "final",
+                    )
+                    if cache_key:
+                        await response_cache.aset(cache_key, {
+                            "text": "".join(text_parts) + remaining_text,
+                            "tool_calls": collected_tool_calls,
+                            "finish_reason": finish_reason,
+                            "usage": dict(usage_dict(usage)),
+                        })
 
-            async for chunk in response:
-                if hasattr(chunk, "choices") and len(chunk.choices) > 0:
-                    choice = chunk.choices[0]
-                    delta = choice.delta if hasattr(choice, "delta") else None
-
-                    # usageの処理: Pydanticモデルの場合はmodel_dump()を使用
-                    usage_dict = {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0}
-                    if hasattr(chunk, "usage") and chunk.usage:
-                        if hasattr(chunk.usage, "model_dump"):
-                            usage_dict = chunk.usage.model_dump()
-                        elif hasattr(chunk.usage, "dict"):
-                            usage_dict = chunk.usage.dict()
-                        elif isinstance(chunk.usage, dict):
-                            usage_dict = chunk.usage
-
-                    generic_streaming_chunk: GenericStreamingChunk = {
-                        "finish_reason": choice.finish_reason if hasattr(choice, "finish_reason") else None,
-                        "index": choice.index if hasattr(choice, "index") else 0,
-                        "is_finished": choice.finish_reason is not None if hasattr(choice, "finish_reason") else False,
-                        "text": delta.content if delta and hasattr(delta, "content") and delta.content else "",
-                        "tool_use": None,
-                        "usage": usage_dict,
-                    }
-                    yield generic_streaming_chunk
-            logger.info("Normal streaming response completed")
+                if _open_decision(tool_kwargs):
+                    speculation.observe(model, needed_tools=bool(collected_tool_calls))
+                    if iteration == 0 and verdict is not None:
+                        triage.observe(verdict, collected_tool_calls)
+                logger.info(f"Stream collection complete (round {iteration + 1}). finish_reason={finish_reason}, tool_calls={len(collected_tool_calls)}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Collected tool calls: {collected_tool_calls}")
+
+                if not collected_tool_calls:
+                    # ツール呼び出しが不要になったら、保留していたテキストとfinishチャンクを返して終了
+                    clock.tick()
+                    yield finish_chunk(remaining_text, finish_index, finish_reason, usage)
+                    logger.info("Streaming response completed")
+                    return
+
+                # ツールを並行して実行し、結果をメッセージに追加して次のラウンドへ
+                # クライアント切断でこのジェネレータがキャンセルされると実行中のツールもキャンセルされる
+                logger.info(f"Tool calls detected: {len(collected_tool_calls)} tool(s) to execute")
+                messages.append({
+                    "role": "assistant",
+                    "tool_calls": collected_tool_calls,
+                })
+                if not settings.tool_progress:
+                    messages.extend(
+                        await run_tool_calls(collected_tool_calls, registry, settings.tool_timeout, early, replay)
+                    )
+                    continue
+
+                # 実行の開始・完了と、長いツールの経過時間をステータス行として流す
+                for call_index, tool_call in enumerate(collected_tool_calls):
+                    if call_index not in announced:
+                        clock.tick()
+                        yield text_chunk(progress_text("calling", tool_call["function"]["name"]))
+                results = [None] * len(collected_tool_calls)
+                tools_start = time.perf_counter()
+                async for call_index, tool_message, failed in iter_tool_calls(
+                    collected_tool_calls,
+                    registry,
+                    settings.tool_timeout,
+                    settings.tool_progress_interval,
+                    early,
+                    replay,
+                ):
+                    elapsed = time.perf_counter() - tools_start
+                    if call_index is None:
+                        status = progress_text("running", elapsed=elapsed)
+                    else:
+                        results[call_index] = tool_message
+                        name = collected_tool_calls[call_index]["function"]["name"]
+                        status = progress_text("failed" if failed else "done", name, elapsed)
+                    clock.tick()
+                    yield text_chunk(status)
+                clock.tick()
+                yield text_chunk("\n")
+                messages.extend(results)
 
 
 my_custom_llm = MyCustomLLM()
+if start_prewarm is not None:
+    # AGENT_PREWARM のモデルの読み込みなど、リクエストに依らない準備をバックグラウンドで始める (agent_prewarm)
+    start_prewarm(registry, _model_budget)
@@ -0,0 +1,91 @@
+"""
+Sharing of identical non-streaming tool-decision calls for MyCustomLLM.
+
+Batch and offline jobs call ``acompletion`` in bursts, often with the same
+prompt. Chat completion endpoints have no call that answers several
+conversations at once (``litellm.batch_completion`` only runs the requests
+side by side), so nothing is gained by holding calls back to group them.
+With ``share_decisions`` set (see ``agent_settings``), a decision call that
+is identical to one already in flight waits for that call's response
+instead of sending its own:
+
+- calls are identical when their normalized messages, tools and
+  ``tool_choice`` (see ``agent_cache.ResponseCache.key``), deployments
+  (including ``api_key``) and agent settings match
+- a call with no identical call in flight is sent at once, without waiting
+- the upstream call is cancelled only when every caller sharing it is gone
+
+Unlike the response cache, nothing is kept once the call has finished.
+"""
+import asyncio
+import logging
+import weakref
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+from agent_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+metrics.describe("agent_decision_shared_total", "Tool-decision calls answered by an identical call already in flight")
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class InFlightCalls:
+    """Identical concurrent calls share one execution, per event loop."""
+
+    def __init__(self):
+        self._calls: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Hashable, _Call]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable[T]], share: Optional[Callable[[T], T]] = None) -> T:
+        """
+        Run ``call``, or wait for the identical call already running under ``key``.
+
+        Args:
+            key: Identity of the call; equal keys share one execution.
+            call: Makes the call; only invoked when ``key`` is not in flight.
+            share: Copies the result for the callers that joined a running call.
+
+        Raises:
+            Exception: Whatever the shared execution raised.
+        """
+        loop = asyncio.get_running_loop()
+        calls = self._calls.setdefault(loop, {})
+        entry = calls.get(key)
+        joined = entry is not None
+        if joined:
+            metrics.inc("agent_decision_shared_total")
+        else:
+            entry = calls[key] = _Call(loop.create_task(call()))
+            entry.task.add_done_callback(lambda _: self._forget(calls, key, entry))
+        entry.waiters += 1
+        try:
+            result = await asyncio.shield(entry.task)
+        finally:
+            entry.waiters -= 1
+            if entry.waiters == 0 and not entry.task.done():
+                # 待っている呼び出し元がいなくなった上流の呼び出しは止める
+                self._forget(calls, key, entry)
+                entry.task.cancel()
+        return share(result) if joined and share is not None else result
+
+    @staticmethod
+    def _forget(calls: dict, key: Hashable, entry: _Call) -> None:
+        if calls.get(key) is entry:
+            del calls[key]
+
+    def __len__(self) -> int:
+        return sum(len(calls) for calls in list(self._calls.values()))
+
+
+decision_calls = InFlightCalls()
@@ -0,0 +1,372 @@
+"""
+Caches used by MyCustomLLM.
+
+ToolResultCache memoizes tool results per (tool, canonicalized arguments)
+with a TTL and LRU eviction, and coalesces concurrent identical calls so
+they trigger a single execution.
+
+ResponseCache stores the outcome of tool-decision completions keyed on a
+normalized hash of (model, messages, tools), in memory or in SQLite so it
+survives proxy restarts.
+
+With ``AGENT_SHARED_STATE`` (see ``agent_shared``) both are shared by all
+proxy workers: tool results are also stored in the shared store and an
+identical call runs in one worker at a time, and decisions are stored there
+instead of in worker memory (unless ``AGENT_RESPONSE_CACHE_PATH`` is set).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+if os.environ.get("AGENT_SHARED_STATE"):
+    # 共有ストア (agent_shared) は AGENT_SHARED_STATE を設定した場合だけ import する
+    from agent_shared import shared_store
+else:
+    shared_store = None
+
+
+def canonical_arguments(arguments: Any) -> str:
+    """Serialize arguments so that equal values always produce the same key."""
+    return json.dumps(arguments, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+class ToolResultCache:
+    """
+    TTL + LRU cache for tool results with single-flight execution.
+
+    Args:
+        ttl: Default seconds a result stays valid. ``0`` disables the cache.
+        max_entries: Maximum number of cached results across all tools.
+        shared: Optional store shared with the other workers (``agent_shared``).
+    """
+
+    def __init__(self, ttl: float = 60.0, max_entries: int = 1024, shared=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+        self._in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"hits": 0, "misses": 0, "coalesced": 0, "shared_hits": 0}
+        )
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    async def get_or_run(
+        self,
+        tool_name: str,
+        arguments: Any,
+        run: Callable[[], Awaitable[str]],
+        ttl: Optional[float] = None,
+        timeout: Optional[float] = None,
+    ) -> str:
+        """
+        Return the cached result for ``tool_name(**arguments)`` or compute it with ``run``.
+
+        Concurrent callers with the same key share one execution. Exceptions are
+        propagated to every waiter and never cached. A waiter that is cancelled
+        or times out does not cancel the shared execution; the execution itself
+        is cancelled after ``timeout`` seconds, so a hung tool does not keep
+        later calls coalescing onto it.
+        """
+        key = (tool_name, canonical_arguments(arguments))
+        stats = self._stats[tool_name]
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                stats["hits"] += 1
+                return entry[1]
+            del self._entries[key]
+
+        ttl = self.ttl if ttl is None else ttl
+        loop = asyncio.get_running_loop()
+        task = self._in_flight.get(key)
+        if task is not None and task.get_loop() is loop:
+            stats["coalesced"] += 1
+        else:
+            stats["misses"] += 1
+            execution = run() if self.shared is None else self._run_shared(key, run, ttl)
+            task = loop.create_task(asyncio.wait_for(execution, timeout) if timeout else execution)
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t, ttl))
+        return await asyncio.shield(task)
+
+    async def _run_shared(self, key: Tuple[str, str], run: Callable[[], Awaitable[str]], ttl: float) -> str:
+        """Run ``run`` unless another worker has the result, and in one worker at a time."""
+        from agent_shared import LEASE_SECONDS, single_flight
+
+        shared_key = "tool:" + hashlib.sha256(f"{key[0]}\0{key[1]}".encode()).hexdigest()
+        value = await self.shared.get(shared_key)
+        if value is None:
+            async with single_flight(self.shared, "lock:" + shared_key, LEASE_SECONDS, LEASE_SECONDS) as leader:
+                if not leader:
+                    value = await self.shared.get(shared_key)
+                if value is None:
+                    result = await run()
+                    if ttl > 0:
+                        await self.shared.set(shared_key, result.encode(), ttl)
+                    return result
+        self._stats[key[0]]["shared_hits"] += 1
+        return value.decode()
+
+    def _on_done(self, key: Tuple[str, str], task: asyncio.Task, ttl: float) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if task.cancelled() or task.exception() is not None or ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, task.result())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss/coalesced counters per tool plus cache-wide size and evictions."""
+        return {
+            "entries": len(self._entries),
+            "evictions": self.evictions,
+            # /metrics のスレッドからも呼ばれるので、イベントループ側の追加と競合しないよう写してから回す
+            "tools": {name: dict(counts) for name, counts in list(self._stats.items())},
+        }
+
+
+tool_cache = ToolResultCache(
+    ttl=float(os.environ.get("AGENT_TOOL_CACHE_TTL", "60")),
+    max_entries=int(os.environ.get("AGENT_TOOL_CACHE_SIZE", "1024")),
+    shared=shared_store,
+)
+
+
+def _normalize_message(message: Any) -> Any:
+    if hasattr(message, "model_dump"):
+        message = message.model_dump()
+    if not isinstance(message, dict):
+        return message
+    normalized = {k: v for k, v in message.items() if v is not None}
+    if isinstance(normalized.get("content"), str):
+        normalized["content"] = normalized["content"].strip()
+    return normalized
+
+
+class MemoryBackend:
+    """In-process LRU backend for :class:`ResponseCache`."""
+
+    blocking = False
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """
+    On-disk backend for :class:`ResponseCache`.
+
+    Reads go through SQLite's mmap I/O; least recently used rows are evicted
+    once the table exceeds ``max_entries``. The database is opened on first
+    use, not at import.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # 呼び出し側で self._lock を保持している
+        if self._db is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed)")
+            self._db = conn
+        return self._db
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE response_cache SET accessed = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now),
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM response_cache WHERE key IN "
+                    "(SELECT key FROM response_cache ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+
+class SharedBackend:
+    """Backend for :class:`ResponseCache` on the store shared by all workers (``agent_shared``)."""
+
+    blocking = False
+
+    def __init__(self, store, prefix: str = "response:"):
+        self.store = store
+        self.prefix = prefix
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        return await self.store.get(self.prefix + key)
+
+    async def aset(self, key: str, value: bytes, ttl: float) -> None:
+        await self.store.set(self.prefix + key, value, ttl)
+
+    def __len__(self) -> int:
+        # 共有ストア全体の件数 (数えられないストアでは 0)
+        return len(self.store)
+
+
+class ResponseCache:
+    """
+    Exact-match cache for tool-decision completions.
+
+    Values are JSON-serializable dicts. ``bytes_saved`` counts the size of
+    the cached payloads that were served instead of calling upstream.
+
+    Args:
+        backend: :class:`MemoryBackend`, :class:`SQLiteBackend` or :class:`SharedBackend`.
+        ttl: Seconds an entry stays valid.
+    """
+
+    def __init__(self, backend, ttl: float = 300.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(model: str, messages: list, tools_json: str) -> str:
+        """Normalized hash of the request inputs that determine the decision."""
+        payload = json.dumps(
+            [model, [_normalize_message(m) for m in messages]],
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+            default=str,
+        )
+        digest = hashlib.sha256(payload.encode())
+        digest.update(tools_json.encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._loaded(self.backend.get(key))
+
+    def _loaded(self, value: Optional[bytes]) -> Optional[dict]:
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_saved += len(value)
+        return json.loads(value)
+
+    def set(self, key: str, value: dict) -> None:
+        self.backend.set(key, self._dumps(value), self.ttl)
+
+    @staticmethod
+    def _dumps(value: dict) -> bytes:
+        return json.dumps(value, separators=(",", ":"), default=str).encode()
+
+    async def aget(self, key: str) -> Optional[dict]:
+        if isinstance(self.backend, SharedBackend):
+            return self._loaded(await self.backend.aget(key))
+        if self.backend.blocking:
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def aset(self, key: str, value: dict) -> None:
+        if isinstance(self.backend, SharedBackend):
+            await self.backend.aset(key, self._dumps(value), self.ttl)
+        elif self.backend.blocking:
+            await asyncio.to_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+def _response_cache_backend():
+    path = os.environ.get("AGENT_RESPONSE_CACHE_PATH")
+    max_entries = int(os.environ.get("AGENT_RESPONSE_CACHE_SIZE", "1024"))
+    if path:
+        return SQLiteBackend(path, max_entries=max_entries)
+    if shared_store is not None:
+        return SharedBackend(shared_store)
+    return MemoryBackend(max_entries=max_entries)
+
+
+response_cache = ResponseCache(
+    _response_cache_backend(),
+    ttl=float(os.environ.get("AGENT_RESPONSE_CACHE_TTL", "300")),
+)
@@ -0,0 +1,318 @@
+"""
+Traffic capture for MyCustomLLM.
+
+Set ``AGENT_CAPTURE_PATH`` to append one compact JSON line per request to a
+file, so production traffic can be replayed offline with ``benchmark.py
+replay`` (which serves the recorded rounds from ``mock_llm.py --replay``):
+
+- ``request``: arrival time, mode, model, the ``agent_settings`` overrides,
+  the conversation id (hashed), the incoming messages and, for every agent
+  round, whether tools were offered, the upstream text, tool calls, finish
+  reason and usage, the timing of every upstream chunk (``[ms since the
+  previous chunk, characters]``) and how long the tools of the round took.
+  The results of the tools run by the request are stored once per call.
+- ``tools``: the ``tools`` payload, written whenever it changes.
+
+Only what replay needs is written: API keys, ``api_base``, headers and other
+metadata never are, and the deployment-valued settings (``decision_model``,
+``fallbacks``) are dropped. Every word of the messages, tool arguments (values
+only), tool results and upstream text is masked as well, keeping lengths and
+JSON structure, which is all replay needs.
+
+- ``AGENT_CAPTURE_SAMPLE``: fraction of requests to capture (default 1)
+- ``AGENT_CAPTURE_REDACT``: ``0`` keeps the text unmasked, e.g. to debug
+  prompts on a test deployment (default 1)
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, List, Optional
+
+from agent_metrics import metrics
+from agent_registry import ToolRegistry
+from agent_session import session_id
+from agent_stream import usage_dict
+
+logger = logging.getLogger(__name__)
+
+_MESSAGE_KEYS = ("role", "content", "name", "tool_calls", "tool_call_id")
+# 別のデプロイメント (api_key を含みうる) を指す設定は記録しない
+_DROPPED_SETTINGS = ("decision_model", "fallbacks")
+_WORD = re.compile(r"\w")
+
+metrics.describe("agent_captured_total", "Requests written to the AGENT_CAPTURE_PATH traffic capture")
+
+
+def _dumps(record: dict) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def mask(text: str) -> str:
+    """Replace every word character of ``text`` with ``x``."""
+    return _WORD.sub("x", text)
+
+
+def _mask_value(value: Any) -> Any:
+    if isinstance(value, str):
+        return mask(value)
+    if isinstance(value, list):
+        return [_mask_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _mask_value(item) for key, item in value.items()}
+    return value
+
+
+def mask_json(text: str) -> str:
+    """Mask the string values of a JSON document (or all of ``text`` if it is not JSON)."""
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return mask(text)
+    return json.dumps(_mask_value(value), ensure_ascii=False)
+
+
+def _mask_tool_text(text: str) -> str:
+    """:func:`mask_json` for a tool call returned as JSON in ``content``, keeping the tool name."""
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return mask(text)
+    masked = _mask_value(value)
+    if isinstance(value, dict) and "name" in value:
+        masked["name"] = value["name"]
+    return json.dumps(masked, ensure_ascii=False)
+
+
+def _tool_calls(tool_calls: List[dict], redact: bool) -> List[dict]:
+    calls = []
+    for call in tool_calls:
+        arguments = call["function"].get("arguments") or ""
+        calls.append({
+            "id": call.get("id"),
+            "type": "function",
+            "function": {
+                "name": call["function"].get("name"),
+                "arguments": mask_json(arguments) if redact and arguments else arguments,
+            },
+        })
+    return calls
+
+
+class Trace:
+    """The capture of one request, filled in by the agent loop."""
+
+    __slots__ = ("_capture", "_redact", "_start", "_round_start", "_last", "_parts", "record")
+
+    def __init__(self, capture: "Capture", record: dict):
+        self._capture = capture
+        self._redact = capture.redact
+        self._start = time.perf_counter()
+        self._round_start = self._start
+        self._last = self._start
+        self._parts: List[str] = []
+        self.record = record
+
+    def _text(self, text: str) -> str:
+        return mask(text) if self._redact else text
+
+    def begin(self, tools: bool) -> None:
+        """Start an agent round; ``tools`` is whether the round offers tools to the model."""
+        now = time.perf_counter()
+        rounds = self.record["rounds"]
+        if rounds:
+            # 前のラウンドの終わりからここまでがツールの実行時間
+            rounds[-1]["tool_seconds"] = round(now - rounds[-1].pop("_end", now), 4)
+        rounds.append({"tools": tools, "start": round(now - self._start, 4), "chunks": []})
+        self._round_start = self._last = now
+        self._parts = []
+
+    def chunk(self, content: Optional[str], tool_call_deltas: Any = None) -> None:
+        """An upstream chunk of the current round arrived."""
+        now = time.perf_counter()
+        current = self.record["rounds"][-1]
+        current["chunks"].append([round((now - self._last) * 1000, 1), len(content or "")])
+        self._last = now
+        if content:
+            self._parts.append(content)
+        if tool_call_deltas:
+            current["native"] = True
+
+    def end(
+        self,
+        tool_calls: List[dict],
+        finish_reason: Optional[str],
+        usage: Any,
+        text: Optional[str] = None,
+        cached: bool = False,
+    ) -> None:
+        """The current round's upstream calls are done (``text`` defaults to the streamed chunks)."""
+        now = time.perf_counter()
+        current = self.record["rounds"][-1]
+        text = "".join(self._parts) if text is None else text or ""
+        if self._redact and text and tool_calls and not current.get("native"):
+            # contentのJSONで返されたツール呼び出しは、再生できるように形式とツール名を残す
+            text = _mask_tool_text(text)
+        else:
+            text = self._text(text)
+        current.update({
+            "text": text,
+            "tool_calls": _tool_calls(tool_calls, self._redact),
+            "finish_reason": finish_reason,
+            "usage": dict(usage_dict(usage)),
+            "seconds": round(now - self._round_start, 4),
+            "_end": now,
+        })
+        if cached:
+            current["cached"] = True
+
+    def response(self, response: Any, tool_calls: List[dict], cached: bool = False) -> None:
+        """:meth:`end` for a non-streaming ``ModelResponse``."""
+        choice = response.choices[0] if getattr(response, "choices", None) else None
+        message = getattr(choice, "message", None)
+        self.end(
+            tool_calls,
+            getattr(choice, "finish_reason", None),
+            getattr(response, "usage", None),
+            text=getattr(message, "content", None) or "",
+            cached=cached,
+        )
+
+    def finish(self, messages: List[dict], error: Optional[BaseException] = None) -> None:
+        """Write the trace; ``messages`` is the agent's message list including the tool rounds."""
+        record = self.record
+        for current in record["rounds"]:
+            current.pop("_end", None)
+        names = {}
+        results = []
+        for message in messages[record.pop("_incoming"):]:
+            for call in message.get("tool_calls") or ():
+                names[call["id"]] = (call["function"]["name"], call["function"].get("arguments") or "")
+            if message.get("role") == "tool" and message.get("tool_call_id") in names:
+                name, arguments = names[message["tool_call_id"]]
+                content = message.get("content") or ""
+                if self._redact:
+                    arguments, content = mask_json(arguments) if arguments else "", mask_json(content)
+                results.append({"name": name, "arguments": arguments, "content": content})
+        record["results"] = results
+        record["seconds"] = round(time.perf_counter() - self._start, 4)
+        if error is not None:
+            record["error"] = type(error).__name__
+        if self._redact:
+            record["redacted"] = True
+        self._capture.write(record)
+
+
+class Capture:
+    """
+    Append-only JSONL capture of agent requests.
+
+    Args:
+        path: File to append to; empty disables the capture.
+        sample: Fraction of requests to capture.
+        redact: Mask the words of messages, tool arguments and tool results.
+    """
+
+    def __init__(self, path: str = "", sample: float = 1.0, redact: bool = True):
+        self.path = path
+        self.sample = sample
+        self.redact = redact
+        self._lock = threading.Lock()
+        self._tools_digest = None
+
+    def start(self, mode: str, kwargs: dict, messages: List[dict], registry: ToolRegistry) -> Optional[Trace]:
+        """A :class:`Trace` for this request, or None if it is not captured."""
+        if not self.path or (self.sample < 1 and random.random() >= self.sample):
+            return None
+        digest = hashlib.blake2b(registry.tools_json.encode(), digest_size=8).hexdigest()
+        if digest != self._tools_digest:
+            self._tools_digest = digest
+            self.write({"kind": "tools", "digest": digest, "tools": registry.tools})
+        litellm_params = kwargs.get("litellm_params") or {}
+        model_info = litellm_params.get("model_info") or (litellm_params.get("metadata") or {}).get("model_info") or {}
+        settings = {
+            key: value
+            for key, value in (model_info.get("agent_settings") or {}).items()
+            if key not in _DROPPED_SETTINGS
+        }
+        session = session_id(kwargs)
+        return Trace(self, {
+            "kind": "request",
+            "t": round(time.time(), 4),
+            "mode": mode,
+            "model": kwargs.get("model", ""),
+            "settings": settings,
+            "session": hashlib.blake2b(session.encode(), digest_size=8).hexdigest() if session else None,
+            "tools": digest,
+            "messages": [self._message(message) for message in messages],
+            "rounds": [],
+            "_incoming": len(messages),
+        })
+
+    def _message(self, message: dict) -> dict:
+        sanitized = {}
+        for key in _MESSAGE_KEYS:
+            value = message.get(key)
+            if value is None:
+                continue
+            if key == "content" and isinstance(value, list):
+                # マルチモーダルの部品はテキストだけを残す
+                value = [
+                    {"type": "text", "text": part.get("text", "")} if part.get("type") == "text"
+                    else {"type": part.get("type")}
+                    for part in value
+                    if isinstance(part, dict)
+                ]
+                if self.redact:
+                    value = [{**part, "text": mask(part["text"])} if "text" in part else part for part in value]
+            elif key == "content" and self.redact:
+                value = mask_json(value) if message.get("role") == "tool" else mask(str(value))
+            elif key == "tool_calls":
+                value = _tool_calls(value, self.redact)
+            sanitized[key] = value
+        return sanitized
+
+    def write(self, record: dict) -> None:
+        line = _dumps(record)
+        if record["kind"] == "request":
+            metrics.inc("agent_captured_total", mode=record["mode"])
+        try:
+            # ファイルへの追記はイベントループの外で行う
+            asyncio.get_running_loop().run_in_executor(None, self._append, line)
+        except RuntimeError:
+            self._append(line)
+
+    def _append(self, line: str) -> None:
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"Could not write the traffic capture: {e}")
+
+
+@contextlib.contextmanager
+def recording(trace: Optional[Trace], messages: List[dict]):
+    """Write ``trace`` when the request ends, recording the exception it failed with."""
+    if trace is None:
+        yield
+        return
+    try:
+        yield
+    except BaseException as e:
+        trace.finish(messages, e)
+        raise
+    trace.finish(messages)
+
+
+capture = Capture(
+    path=os.environ.get("AGENT_CAPTURE_PATH", ""),
+    sample=float(os.environ.get("AGENT_CAPTURE_SAMPLE", "1")),
+    # 会話の本文は既定で伏せ、明示的に 0 を指定した場合だけそのまま記録する
+    redact=os.environ.get("AGENT_CAPTURE_REDACT", "1").lower() not in ("0", "false", "no"),
+)
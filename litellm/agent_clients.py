@@ -0,0 +1,185 @@
+"""
+Persistent upstream HTTP clients for MyCustomLLM.
+
+Every agent turn makes two or more ``litellm.acompletion`` calls. Passing a
+long-lived client per deployment keeps their connections warm: ``openai/``
+deployments get an ``AsyncOpenAI`` client and ``ollama/`` deployments a
+litellm ``AsyncHTTPHandler``, both on one ``httpx.AsyncClient`` with an
+explicit pool size, keep-alive and HTTP/2 (for https, when ``h2`` is
+installed). Other providers use litellm's default client resolution. The
+OpenAI SDK keeps its default retries unless the agent has ``fallbacks`` to
+fail over to.
+
+Clients are bound to the event loop they were created on, so the sync
+``completion`` path (which runs on its own loop, see ``agent_runtime``) gets
+its own set. Pool settings are process-global environment variables:
+
+- ``AGENT_HTTP_MAX_CONNECTIONS`` (default 100)
+- ``AGENT_HTTP_MAX_KEEPALIVE`` (default 20)
+- ``AGENT_HTTP_KEEPALIVE_EXPIRY`` seconds (default 60)
+- ``AGENT_HTTP2``: ``auto`` (default), ``1`` or ``0``
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from agent_router import provider_name
+
+logger = logging.getLogger(__name__)
+
+_OPENAI_DEFAULT_BASE = "https://api.openai.com/v1"
+_OLLAMA_DEFAULT_BASE = "http://localhost:11434"
+
+
+class ClientPool:
+    """
+    Per-loop, per-deployment upstream clients.
+
+    Args:
+        max_connections: Connection limit of each client.
+        max_keepalive: Idle connections kept open per client.
+        keepalive_expiry: Seconds an idle connection is kept.
+        http2: ``True``, ``False`` or ``None`` (use HTTP/2 when ``h2`` is installed).
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive: int = 20,
+        keepalive_expiry: float = 60.0,
+        http2: Optional[bool] = None,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = importlib.util.find_spec("h2") is not None if http2 is None else http2
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, Any]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._warmed: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, set]" = weakref.WeakKeyDictionary()
+        self._tasks = set()
+
+    @classmethod
+    def from_env(cls) -> "ClientPool":
+        http2 = os.environ.get("AGENT_HTTP2", "auto").lower()
+        return cls(
+            max_connections=int(os.environ.get("AGENT_HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive=int(os.environ.get("AGENT_HTTP_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.environ.get("AGENT_HTTP_KEEPALIVE_EXPIRY", "60")),
+            http2=None if http2 == "auto" else http2 in ("1", "true", "yes"),
+        )
+
+    def _http_client(self, base_url: str) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            limits=self.limits,
+            http2=self.http2 and base_url.startswith("https://"),
+            timeout=httpx.Timeout(600.0, connect=5.0),
+            follow_redirects=True,
+        )
+
+    def _create(self, provider: str, api_base: Optional[str], api_key: Optional[str], retries: bool) -> Any:
+        if provider == "openai":
+            from openai import AsyncOpenAI
+
+            base_url = (
+                api_base or os.environ.get("OPENAI_BASE_URL") or os.environ.get("OPENAI_API_BASE") or _OPENAI_DEFAULT_BASE
+            )
+            # フォールバックがある場合は SDK で再試行せず、すぐ次の候補に回す
+            options = {} if retries else {"max_retries": 0}
+            return AsyncOpenAI(
+                api_key=api_key or os.environ.get("OPENAI_API_KEY") or "sk-none",
+                base_url=base_url,
+                http_client=self._http_client(base_url),
+                **options,
+            )
+        if provider in ("ollama", "ollama_chat"):
+            from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler
+
+            handler = AsyncHTTPHandler(timeout=httpx.Timeout(600.0, connect=5.0), client_alias="agent")
+            # 接続プールの設定だけを差し替え、コンストラクタが作った既定のクライアントは閉じる
+            default, handler.client = handler.client, self._http_client(api_base or _OLLAMA_DEFAULT_BASE)
+            self._spawn(default.aclose())
+            return handler
+        return None
+
+    def client_kwargs(self, deployment: dict, retries: bool = True) -> dict:
+        """
+        ``{"client": ...}`` to pass to ``litellm.acompletion`` for ``deployment`` (empty if unsupported).
+
+        Args:
+            deployment: The deployment (``model``, ``api_base``, ``api_key``).
+            retries: Keep the OpenAI SDK's retries; pass False when the router
+                has fallbacks to try instead.
+        """
+        if "client" in deployment:
+            return {}
+        provider = provider_name(deployment["model"])
+        key = (provider, deployment.get("api_base"), deployment.get("api_key"), retries or provider != "openai")
+        clients = self._clients.setdefault(asyncio.get_running_loop(), {})
+        if key not in clients:
+            try:
+                clients[key] = self._create(*key)
+            except Exception as e:
+                # クライアントを作れない場合は litellm の既定のクライアント解決に任せる
+                logger.warning(f"Using litellm's default client for {deployment['model']}: {e}")
+                clients[key] = None
+            if clients[key] is not None:
+                logger.info(f"Created pooled {provider} client for {deployment.get('api_base') or 'default api_base'}")
+        client = clients[key]
+        return {"client": client} if client is not None else {}
+
+    def schedule_warm_up(self, deployments: List[dict], retries: bool = True) -> None:
+        """Warm up the deployments not seen on this loop yet, in a background task."""
+        warmed = self._warmed.setdefault(asyncio.get_running_loop(), set())
+        new = []
+        for deployment in deployments:
+            key = (deployment["model"], deployment.get("api_base"), deployment.get("api_key"), retries)
+            if key not in warmed:
+                warmed.add(key)
+                new.append(deployment)
+        if new:
+            self._spawn(self.warm_up(new, retries))
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def warm_up(self, deployments: List[dict], retries: bool = True) -> None:
+        """Open a connection to each deployment so the next call skips the TCP/TLS handshake."""
+        await asyncio.gather(*(self._warm_up_one(deployment, retries) for deployment in deployments))
+
+    async def _warm_up_one(self, deployment: dict, retries: bool) -> None:
+        client = self.client_kwargs(deployment, retries).get("client")
+        if client is None:
+            return
+        try:
+            if hasattr(client, "models"):
+                await client.models.list()
+            else:
+                await client.client.get(deployment.get("api_base") or _OLLAMA_DEFAULT_BASE)
+        except Exception as e:
+            # 応答の内容は問わない: 接続が確立できれば十分
+            logger.debug(f"Warm-up request to {deployment['model']} failed: {e}")
+
+    async def aclose(self) -> None:
+        """Close the clients created on the running loop."""
+        clients = self._clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            if client is None:
+                continue
+            if hasattr(client, "models"):
+                await client.close()
+            else:
+                # AsyncHTTPHandler は差し替えたクライアントを自分では閉じない
+                await client.client.aclose()
+
+
+client_pool = ClientPool.from_env()
@@ -0,0 +1,135 @@
+"""
+Coalescing of streamed text chunks for MyCustomLLM.
+
+Small models emit one- or two-character deltas, so with many open streams the
+proxy spends more time framing SSE events than forwarding content. With
+``coalesce_chars`` set (see ``agent_settings``), ``astreaming`` passes its
+chunks through :func:`coalesce`, which merges consecutive text chunks into one
+frame:
+
+- a chunk that arrives ``coalesce_wait`` seconds or more after the previous
+  frame is sent at once, so the first token and slow streams are not delayed
+- otherwise text is held until ``coalesce_chars`` characters have gathered or
+  ``coalesce_wait`` has passed since the previous frame
+- the final chunk (finish reason and usage) carries any held text and is sent
+  immediately
+
+The agent generator is driven by a pump task so held text is flushed on time
+even while the agent waits on the model or on tools.
+"""
+import asyncio
+import collections
+import logging
+from typing import AsyncIterator, List, Optional
+
+from agent_metrics import metrics
+from agent_stream import text_chunk
+
+logger = logging.getLogger(__name__)
+
+metrics.describe("agent_stream_deltas_total", "Chunks produced by the agent loop for coalesced streams")
+metrics.describe("agent_stream_frames_total", "Chunks sent to the client for coalesced streams after merging")
+
+
+async def coalesce(chunks: AsyncIterator[dict], max_chars: int, max_wait: float) -> AsyncIterator[dict]:
+    """
+    Merge the text chunks of ``chunks`` (``GenericStreamingChunk`` dicts).
+
+    Args:
+        chunks: The agent's chunk generator; closed when the client goes away.
+        max_chars: Send the held text once it reaches this many characters.
+        max_wait: Longest time text is held after the previous frame (seconds).
+    """
+    loop = asyncio.get_running_loop()
+    frames = collections.deque()
+    parts: List[str] = []
+    held = 0
+    held_index = 0
+    last_frame = -max_wait
+    timer: Optional[asyncio.TimerHandle] = None
+    waiter: Optional[asyncio.Future] = None
+    done = False
+    error: Optional[BaseException] = None
+    deltas = 0
+
+    def wake() -> None:
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def flush() -> None:
+        nonlocal held, last_frame, timer
+        if timer is not None:
+            timer.cancel()
+            timer = None
+        if parts:
+            frames.append(text_chunk("".join(parts), held_index))
+            parts.clear()
+            held = 0
+            last_frame = loop.time()
+            wake()
+
+    def expire() -> None:
+        nonlocal timer
+        timer = None
+        flush()
+
+    async def pump() -> None:
+        # 送る単位はここで決め、クライアント側のジェネレータはフレームごとにだけ起こす
+        nonlocal held, held_index, last_frame, timer, done, error, deltas
+        try:
+            async for chunk in chunks:
+                deltas += 1
+                index = chunk["index"]
+                if chunk["is_finished"]:
+                    if parts and index == held_index:
+                        # 保留中のテキストは finish チャンクにまとめる
+                        chunk = {**chunk, "text": "".join(parts) + (chunk["text"] or "")}
+                        parts.clear()
+                        held = 0
+                    flush()
+                    frames.append(chunk)
+                    last_frame = loop.time()
+                    wake()
+                    continue
+                if parts and index != held_index:
+                    flush()
+                parts.append(chunk["text"])
+                held += len(chunk["text"])
+                held_index = index
+                if held >= max_chars or loop.time() - last_frame >= max_wait:
+                    flush()
+                elif timer is None:
+                    timer = loop.call_at(last_frame + max_wait, expire)
+        except BaseException as e:
+            # 送信済みのテキストを流し終えてからクライアント側で送出する
+            error = e
+        finally:
+            flush()
+            done = True
+            wake()
+
+    sent = 0
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            while frames:
+                sent += 1
+                yield frames.popleft()
+            if done:
+                if error is not None:
+                    raise error
+                return
+            waiter = loop.create_future()
+            try:
+                await waiter
+            finally:
+                waiter = None
+    finally:
+        if not task.done():
+            # クライアント切断: エージェントのジェネレータ (実行中のツールを含む) を止める
+            task.cancel()
+        await asyncio.wait({task})
+        if timer is not None:
+            timer.cancel()
+        metrics.inc("agent_stream_deltas_total", deltas)
+        metrics.inc("agent_stream_frames_total", sent)
@@ -0,0 +1,188 @@
+"""
+Conversation-history compaction for MyCustomLLM.
+
+Before each upstream call the message list is compacted to a per-model token
+budget: oversized tool results are truncated, and the oldest turns are
+replaced by a short extractive summary. Results are cached by a rolling hash
+of the message prefix, so on the next turn of the same conversation only the
+newly appended messages are counted and compacted.
+"""
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MARKER = "[Summary of earlier conversation]"
+
+
+def _message_hash(previous: bytes, message: Any) -> bytes:
+    digest = hashlib.blake2b(previous, digest_size=16)
+    digest.update(json.dumps(message, sort_keys=True, separators=(",", ":"), default=str).encode())
+    return digest.digest()
+
+
+def truncate_text(text: str, max_chars: int) -> str:
+    """Keep the head and tail of ``text`` when it is longer than ``max_chars``."""
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    return f"{text[:head]}\n...[truncated {len(text) - max_chars} chars]...\n{text[-tail:]}"
+
+
+class ContextManager:
+    """
+    Compacts message lists to a token budget.
+
+    Args:
+        token_counter: ``(model, message) -> int``. Defaults to ``litellm.token_counter``.
+        max_cached: Number of compacted prefixes (roughly: conversations) to keep.
+    """
+
+    def __init__(self, token_counter: Optional[Callable[[str, dict], int]] = None, max_cached: int = 512):
+        self._token_counter = token_counter
+        self._count_cache: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+        self._prefix_cache: "OrderedDict[Tuple[str, int, int, bytes], Tuple[List[dict], int]]" = OrderedDict()
+        self.max_cached = max_cached
+
+    def count(self, model: str, message: dict, key: bytes) -> int:
+        cache_key = (model, key)
+        tokens = self._count_cache.get(cache_key)
+        if tokens is None:
+            if self._token_counter is None:
+                import litellm
+
+                self._token_counter = lambda m, msg: litellm.token_counter(model=m, messages=[msg])
+            try:
+                tokens = self._token_counter(model, message)
+            except Exception:
+                # トークナイザが使えない場合は文字数からおおよそ見積もる
+                tokens = len(json.dumps(message, default=str)) // 4
+            self._count_cache[cache_key] = tokens
+            if len(self._count_cache) > self.max_cached * 64:
+                self._count_cache.popitem(last=False)
+        return tokens
+
+    def compact(self, model: str, messages: List[dict], budget: int, max_tool_result_chars: int) -> List[dict]:
+        """
+        Return a compacted copy of ``messages`` that fits ``budget`` tokens where possible.
+
+        ``messages`` itself is never modified. System messages and the latest
+        user turn (with everything after it) are always kept.
+        """
+        if budget <= 0 and max_tool_result_chars <= 0:
+            return messages
+
+        hashes = []
+        previous = b""
+        for message in messages:
+            previous = _message_hash(previous, message)
+            hashes.append(previous)
+
+        # 同じ会話の前回までの圧縮結果を再利用し、新しく追加されたメッセージだけ処理する
+        start, compacted, tokens = 0, [], 0
+        for i in range(len(hashes) - 1, -1, -1):
+            cached = self._prefix_cache.get((model, budget, max_tool_result_chars, hashes[i]))
+            if cached is not None:
+                start = i + 1
+                compacted, tokens = list(cached[0]), cached[1]
+                break
+
+        for message in messages[start:]:
+            if message.get("role") == "tool" and isinstance(message.get("content"), str):
+                content = truncate_text(message["content"], max_tool_result_chars)
+                if content is not message["content"]:
+                    message = {**message, "content": content}
+            compacted.append(message)
+            # 古いターンを落とすときにも同じキーで引けるよう、メッセージ自体のハッシュで数える
+            tokens += self._count(model, message)
+
+        if budget > 0 and tokens > budget:
+            compacted, tokens = self._drop_old_turns(model, compacted, tokens, budget)
+
+        if hashes:
+            cache_key = (model, budget, max_tool_result_chars, hashes[-1])
+            self._prefix_cache[cache_key] = (compacted, tokens)
+            self._prefix_cache.move_to_end(cache_key)
+            if len(self._prefix_cache) > self.max_cached:
+                self._prefix_cache.popitem(last=False)
+        return list(compacted)
+
+    def _drop_old_turns(self, model: str, messages: List[dict], tokens: int, budget: int) -> Tuple[List[dict], int]:
+        system = [m for m in messages if m.get("role") == "system" and not _is_summary(m)]
+        previous_summary = next((m for m in messages if _is_summary(m)), None)
+        rest = [m for m in messages if m.get("role") != "system"]
+
+        last_user = max((i for i, m in enumerate(rest) if m.get("role") == "user"), default=len(rest) - 1)
+        droppable, kept = rest[:last_user], rest[last_user:]
+
+        summary_tokens = 0
+        if previous_summary is not None:
+            summary_tokens = self._count(model, previous_summary)
+            tokens -= summary_tokens
+
+        dropped = []
+        summary = previous_summary
+        # 差し替える要約の分も含めて予算に収まるまで落とす
+        while droppable and tokens + summary_tokens > budget:
+            # assistantのtool_callsと対応するtoolメッセージはまとめて落とす
+            group = [droppable.pop(0)]
+            while droppable and droppable[0].get("role") == "tool":
+                group.append(droppable.pop(0))
+            for message in group:
+                tokens -= self._count(model, message)
+            dropped.extend(group)
+            summary = _summarize(dropped, previous_summary)
+            summary_tokens = self._count(model, summary)
+
+        tokens += summary_tokens
+        if not dropped:
+            return messages, tokens
+
+        logger.info(f"Compacted context: dropped {len(dropped)} message(s), ~{tokens} tokens (budget {budget})")
+        return system + [summary] + droppable + kept, tokens
+
+    def _count(self, model: str, message: dict) -> int:
+        return self.count(model, message, _message_hash(b"", message))
+
+
+def _is_summary(message: dict) -> bool:
+    content = message.get("content")
+    return message.get("role") == "system" and isinstance(content, str) and content.startswith(SUMMARY_MARKER)
+
+
+def _shorten(text: str, max_chars: int = 200) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
+def _summarize(dropped: List[dict], previous_summary: Optional[dict]) -> dict:
+    """Extractive summary of dropped turns: the user requests and the tools that were called."""
+    lines = []
+    if previous_summary is not None:
+        lines.extend(previous_summary["content"].splitlines()[1:])
+    for message in dropped:
+        role = message.get("role")
+        if role == "user" and isinstance(message.get("content"), str):
+            lines.append(f"- User asked: {_shorten(message['content'])}")
+        elif role == "assistant" and message.get("tool_calls"):
+            names = ", ".join(tc["function"]["name"] for tc in message["tool_calls"])
+            lines.append(f"- Assistant called: {names}")
+        elif role == "assistant" and isinstance(message.get("content"), str):
+            lines.append(f"- Assistant answered: {_shorten(message['content'])}")
+    return {"role": "system", "content": "\n".join([SUMMARY_MARKER] + lines[-50:])}
+
+
+def default_budget(model: str, ratio: float = 0.75) -> int:
+    """Budget from litellm's bundled model metadata (no network lookup); 0 when unknown."""
+    import litellm
+
+    info = litellm.model_cost.get(model) or litellm.model_cost.get(model.split("/", 1)[-1]) or {}
+    max_input = info.get("max_input_tokens") or info.get("max_tokens") or 0
+    return int(max_input * ratio)
+
+
+context_manager = ContextManager()
@@ -0,0 +1,532 @@
+"""
+MCP tool servers for MyCustomLLM.
+
+The tools of the MCP servers listed in the JSON file named by
+``AGENT_MCP_CONFIG`` (the usual ``mcpServers`` format) are added to the
+agent's ``ToolRegistry`` next to the in-process tools:
+
+    {
+      "mcpServers": {
+        "files": {"command": "uvx", "args": ["mcp-server-filesystem", "/data"]},
+        "search": {"url": "http://127.0.0.1:8931/mcp", "pool_size": 2}
+      }
+    }
+
+- ``command`` servers are started once and talk newline-delimited JSON-RPC
+  over stdio; ``url`` servers use the Streamable HTTP transport over one
+  keep-alive client. Either way the MCP session stays open between turns.
+- Each session multiplexes concurrent ``tools/call`` requests by JSON-RPC
+  id. While all sessions are busy, up to ``pool_size`` (default 1) sessions
+  per server are opened in the background.
+- Tool lists are fetched once, on the first request, and fetched again after
+  the server sends ``notifications/tools/list_changed``. A server that cannot
+  be reached is retried after ``AGENT_MCP_RETRY_AFTER`` seconds (default 30).
+- Tools annotated ``readOnlyHint`` may be served from
+  ``agent_cache.tool_cache`` (``idempotentHint`` alone is not enough: an
+  idempotent tool can still change state); ``"cacheable"`` in the server
+  entry overrides this. A tool whose name is taken is registered as ``<server>_<tool>``.
+
+Sessions are bound to the event loop they were opened on, like the clients
+of ``agent_clients``.
+"""
+import abc
+import asyncio
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from agent_registry import ToolRegistry
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = "2025-06-18"
+_CLIENT_INFO = {"name": "chat-litellm-agent", "version": "0.1.0"}
+_INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_-]")
+
+
+class MCPError(RuntimeError):
+    """An MCP server answered with an error or went away."""
+
+
+def _result_text(server: str, result: dict) -> str:
+    """The ``tools/call`` result as the content of a tool message."""
+    parts = [
+        item["text"] if item.get("type") == "text" else json.dumps(item, ensure_ascii=False)
+        for item in result.get("content") or []
+    ]
+    if not parts and result.get("structuredContent") is not None:
+        parts.append(json.dumps(result["structuredContent"], ensure_ascii=False))
+    text = "\n".join(parts)
+    if result.get("isError"):
+        raise MCPError(f"{server}: {text or 'tool error'}")
+    return text
+
+
+async def _sse_messages(response: httpx.Response) -> AsyncIterator[Any]:
+    data: List[str] = []
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            data.append(line[5:].lstrip(" "))
+        elif not line and data:
+            yield json.loads("\n".join(data))
+            data = []
+    if data:
+        yield json.loads("\n".join(data))
+
+
+class _Session(abc.ABC):
+    """An initialized MCP session; responses are matched to requests by id."""
+
+    def __init__(self, server: "MCPServer"):
+        self.server = server
+        self.in_flight = 0
+        self.closed = False
+        self.protocol_version: Optional[str] = None
+        self._ids = itertools.count(1)
+
+    async def start(self) -> None:
+        await self._open()
+        result = await asyncio.wait_for(
+            self.request(
+                "initialize",
+                {"protocolVersion": PROTOCOL_VERSION, "capabilities": {}, "clientInfo": _CLIENT_INFO},
+            ),
+            self.server.startup_timeout,
+        )
+        self.protocol_version = result.get("protocolVersion", PROTOCOL_VERSION)
+        await self.notify("notifications/initialized")
+
+    async def request(self, method: str, params: Optional[dict] = None) -> dict:
+        request_id = next(self._ids)
+        message = {"jsonrpc": "2.0", "id": request_id, "method": method}
+        if params is not None:
+            message["params"] = params
+        self.in_flight += 1
+        try:
+            response = await self._exchange(request_id, message)
+        except asyncio.CancelledError:
+            if not self.closed:
+                # タイムアウト等で結果を待たなくなったことをサーバーに伝える
+                asyncio.ensure_future(self._notify_quietly("notifications/cancelled", {"requestId": request_id}))
+            raise
+        finally:
+            self.in_flight -= 1
+        if "error" in response:
+            error = response["error"]
+            raise MCPError(f"{self.server.name}: {error.get('message', error) if isinstance(error, dict) else error}")
+        return response.get("result") or {}
+
+    async def notify(self, method: str, params: Optional[dict] = None) -> None:
+        message = {"jsonrpc": "2.0", "method": method}
+        if params is not None:
+            message["params"] = params
+        await self._send(message)
+
+    async def _notify_quietly(self, method: str, params: dict) -> None:
+        try:
+            await self.notify(method, params)
+        except Exception as e:
+            logger.debug(f"Could not send {method} to {self.server.name}: {e}")
+
+    def _handle(self, message: dict) -> Optional[dict]:
+        """Handle a server-initiated message; returns the reply for requests."""
+        method = message.get("method")
+        if method == "notifications/tools/list_changed":
+            self.server.tools_changed = True
+        if "id" not in message:
+            return None
+        if method == "ping":
+            return {"jsonrpc": "2.0", "id": message["id"], "result": {}}
+        return {"jsonrpc": "2.0", "id": message["id"], "error": {"code": -32601, "message": f"Unsupported: {method}"}}
+
+    @abc.abstractmethod
+    async def _open(self) -> None:
+        """Connect the transport (before ``initialize``)."""
+
+    @abc.abstractmethod
+    async def _exchange(self, request_id: int, message: dict) -> dict:
+        """Send a request and wait for the response with the same id."""
+
+    @abc.abstractmethod
+    async def _send(self, message: dict) -> None:
+        """Send a message that expects no response."""
+
+    @abc.abstractmethod
+    async def close(self) -> None:
+        """Close the transport; pending requests fail with ``MCPError``."""
+
+
+class StdioSession(_Session):
+    """A session with a server process started from ``command``."""
+
+    _process: Optional[asyncio.subprocess.Process] = None
+    _reader: Optional[asyncio.Future] = None
+
+    async def _open(self) -> None:
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._process = await asyncio.create_subprocess_exec(
+            self.server.command,
+            *self.server.args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env={**os.environ, **self.server.env} if self.server.env else None,
+            cwd=self.server.cwd,
+            limit=16 * 1024 * 1024,
+        )
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def _send(self, message: dict) -> None:
+        if self.closed:
+            raise MCPError(f"{self.server.name}: server process exited")
+        self._process.stdin.write(json.dumps(message, separators=(",", ":"), ensure_ascii=False).encode() + b"\n")
+        await self._process.stdin.drain()
+
+    async def _exchange(self, request_id: int, message: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await self._send(message)
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _read(self) -> None:
+        try:
+            async for line in self._process.stdout:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    logger.debug(f"Ignoring non-JSON output of {self.server.name}: {line[:200]!r}")
+                    continue
+                if "method" in message:
+                    reply = self._handle(message)
+                    if reply is not None:
+                        await self._send(reply)
+                    continue
+                future = self._pending.get(message.get("id"))
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except Exception as e:
+            logger.warning(f"Lost the connection to MCP server {self.server.name}: {e}")
+        finally:
+            self.closed = True
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(MCPError(f"{self.server.name}: server process exited"))
+
+    async def close(self) -> None:
+        self.closed = True
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._process is not None and self._process.returncode is None:
+            self._process.stdin.close()
+            try:
+                await asyncio.wait_for(self._process.wait(), 2.0)
+            except asyncio.TimeoutError:
+                self._process.kill()
+                await self._process.wait()
+
+
+class HTTPSession(_Session):
+    """A session with a server at ``url`` over the Streamable HTTP transport."""
+
+    async def _open(self) -> None:
+        self._session_id: Optional[str] = None
+        # ツールの実行時間は agent_runtime のタイムアウトで制限する
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0))
+
+    def _headers(self) -> dict:
+        headers = {"Accept": "application/json, text/event-stream", **self.server.headers}
+        if self._session_id:
+            headers["Mcp-Session-Id"] = self._session_id
+        if self.protocol_version:
+            headers["MCP-Protocol-Version"] = self.protocol_version
+        return headers
+
+    def _check(self, response: httpx.Response) -> None:
+        if response.status_code == 404 and self._session_id:
+            self.closed = True
+            raise MCPError(f"{self.server.name}: session expired")
+        response.raise_for_status()
+        session_id = response.headers.get("mcp-session-id")
+        if session_id:
+            self._session_id = session_id
+
+    async def _send(self, message: dict) -> None:
+        response = await self._client.post(self.server.url, json=message, headers=self._headers())
+        self._check(response)
+
+    async def _exchange(self, request_id: int, message: dict) -> dict:
+        async with self._client.stream("POST", self.server.url, json=message, headers=self._headers()) as response:
+            self._check(response)
+            if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                await response.aread()
+                return response.json()
+            async for event in _sse_messages(response):
+                if "method" in event:
+                    reply = self._handle(event)
+                    if reply is not None:
+                        await self._send(reply)
+                elif event.get("id") == request_id:
+                    return event
+        raise MCPError(f"{self.server.name}: response stream ended without a result")
+
+    async def close(self) -> None:
+        self.closed = True
+        if self._session_id:
+            try:
+                await self._client.delete(self.server.url, headers=self._headers())
+            except httpx.HTTPError as e:
+                logger.debug(f"Could not end the MCP session with {self.server.name}: {e}")
+        await self._client.aclose()
+
+
+class MCPServer:
+    """
+    One MCP server and its pool of sessions.
+
+    Args:
+        name: Name used in logs and for renamed tools.
+        command: Executable of a stdio server (with ``args``, ``env``, ``cwd``).
+        url: Endpoint of a Streamable HTTP server (with ``headers``).
+        pool_size: Sessions opened at most per event loop.
+        cacheable: Overrides the tools' ``readOnlyHint``.
+        startup_timeout: Seconds allowed for ``initialize`` and ``tools/list``.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        command: Optional[str] = None,
+        args: tuple = (),
+        env: Optional[dict] = None,
+        cwd: Optional[str] = None,
+        url: Optional[str] = None,
+        headers: Optional[dict] = None,
+        pool_size: int = 1,
+        cacheable: Optional[bool] = None,
+        startup_timeout: float = 30.0,
+    ):
+        if bool(command) == bool(url):
+            raise ValueError(f"MCP server '{name}' needs either 'command' or 'url'")
+        self.name = name
+        self.command = command
+        self.args = tuple(args)
+        self.env = dict(env or {})
+        self.cwd = cwd
+        self.url = url
+        self.headers = dict(headers or {})
+        self.pool_size = max(1, pool_size)
+        self.cacheable = cacheable
+        self.startup_timeout = startup_timeout
+        self.tools_changed = False
+        self._sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, List[_Session]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+        self._tasks = set()
+
+    @classmethod
+    def from_config(cls, name: str, entry: dict) -> "MCPServer":
+        return cls(
+            name,
+            command=entry.get("command"),
+            args=tuple(entry.get("args") or ()),
+            env=entry.get("env"),
+            cwd=entry.get("cwd"),
+            url=entry.get("url"),
+            headers=entry.get("headers"),
+            pool_size=int(entry.get("pool_size", 1)),
+            cacheable=entry.get("cacheable"),
+            startup_timeout=float(entry.get("startup_timeout", 30.0)),
+        )
+
+    def _live_sessions(self) -> List[_Session]:
+        sessions = self._sessions.setdefault(asyncio.get_running_loop(), [])
+        sessions[:] = [session for session in sessions if not session.closed]
+        return sessions
+
+    async def _open_session(self) -> _Session:
+        lock = self._locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+        async with lock:
+            sessions = self._live_sessions()
+            # 待っている間に他の呼び出しが開いたセッションに空きがあればそれを使う
+            idle = next((session for session in sessions if session.in_flight == 0), None)
+            if idle is not None or len(sessions) >= self.pool_size:
+                return idle or min(sessions, key=lambda s: s.in_flight)
+            session = StdioSession(self) if self.command else HTTPSession(self)
+            try:
+                await session.start()
+            except BaseException:
+                await session.close()
+                raise
+            sessions.append(session)
+            logger.info(f"Opened MCP session {len(sessions)}/{self.pool_size} to {self.name}")
+            return session
+
+    def _grow_in_background(self) -> None:
+        async def grow() -> None:
+            try:
+                await self._open_session()
+            except Exception as e:
+                logger.warning(f"Could not open another MCP session to {self.name}: {e}")
+
+        task = asyncio.ensure_future(grow())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def session(self) -> _Session:
+        """The least busy open session, opening the first one if needed."""
+        sessions = self._live_sessions()
+        if not sessions:
+            return await self._open_session()
+        session = min(sessions, key=lambda s: s.in_flight)
+        lock = self._locks.get(asyncio.get_running_loop())
+        if session.in_flight and len(sessions) < self.pool_size and not (lock is not None and lock.locked()):
+            # 全セッションが使用中: 今回は多重化して送り、次の呼び出しに備えてセッションを増やす
+            self._grow_in_background()
+        return session
+
+    async def list_tools(self) -> List[dict]:
+        session = await self.session()
+        tools: List[dict] = []
+        cursor = None
+        while True:
+            result = await asyncio.wait_for(
+                session.request("tools/list", {"cursor": cursor} if cursor else {}), self.startup_timeout
+            )
+            tools.extend(result.get("tools") or [])
+            cursor = result.get("nextCursor")
+            if not cursor:
+                return tools
+
+    async def call_tool(self, tool: str, arguments: dict) -> str:
+        session = await self.session()
+        return _result_text(self.name, await session.request("tools/call", {"name": tool, "arguments": arguments}))
+
+    async def aclose(self) -> None:
+        """Close the sessions opened on the running loop."""
+        for session in self._sessions.pop(asyncio.get_running_loop(), []):
+            await session.close()
+
+
+def _parameters(input_schema: Optional[dict]) -> dict:
+    parameters = dict(input_schema or {})
+    parameters.setdefault("type", "object")
+    parameters.setdefault("properties", {})
+    return parameters
+
+
+def _tool_function(server: MCPServer, tool: str):
+    async def call(**arguments: Any) -> str:
+        return await server.call_tool(tool, arguments)
+
+    call.__name__ = tool
+    return call
+
+
+class MCPToolset:
+    """
+    Registers the tools of MCP servers with a ``ToolRegistry``.
+
+    Args:
+        servers: The configured servers.
+        retry_after: Seconds before listing the tools of an unreachable server again.
+    """
+
+    def __init__(self, servers: List[MCPServer], retry_after: float = 30.0):
+        self.servers = servers
+        self.retry_after = retry_after
+        self._registered: Dict[str, List[str]] = {}
+        self._retry_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._loop_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    @classmethod
+    def from_env(cls) -> "MCPToolset":
+        path = os.environ.get("AGENT_MCP_CONFIG")
+        retry_after = float(os.environ.get("AGENT_MCP_RETRY_AFTER", "30"))
+        if not path:
+            return cls([], retry_after)
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        entries = config.get("mcpServers", config)
+        return cls([MCPServer.from_config(name, entry) for name, entry in entries.items()], retry_after)
+
+    def _pending(self) -> List[MCPServer]:
+        now = time.monotonic()
+        return [
+            server
+            for server in self.servers
+            if (server.name not in self._registered or server.tools_changed)
+            and self._retry_at.get(server.name, 0.0) <= now
+        ]
+
+    async def ensure_tools(self, registry: ToolRegistry) -> None:
+        """Register the tools of servers that were not listed yet (no-op once all are)."""
+        if not self._pending():
+            return
+        async with self._loop_locks.setdefault(asyncio.get_running_loop(), asyncio.Lock()):
+            pending = self._pending()
+            if not pending:
+                return
+            results = await asyncio.gather(*(server.list_tools() for server in pending), return_exceptions=True)
+            for server, tools in zip(pending, results):
+                if isinstance(tools, Exception):
+                    logger.warning(f"Could not list the tools of MCP server {server.name}: {tools}")
+                    self._retry_at[server.name] = time.monotonic() + self.retry_after
+                    continue
+                if isinstance(tools, BaseException):
+                    raise tools
+                server.tools_changed = False
+                self._register(registry, server, tools)
+
+    def _register(self, registry: ToolRegistry, server: MCPServer, tools: List[dict]) -> None:
+        # 同期版 completion のイベントループ (別スレッド) と同時に登録しないようにする
+        with self._lock:
+            for name in self._registered.pop(server.name, ()):
+                registry.unregister(name)
+            names = []
+            for tool in tools:
+                name = _INVALID_NAME_CHARS.sub("_", tool["name"])[:64]
+                if name in registry:
+                    name = _INVALID_NAME_CHARS.sub("_", f"{server.name}_{tool['name']}")[:64]
+                if name in registry:
+                    logger.warning(f"Skipping MCP tool {tool['name']} of {server.name}: name already registered")
+                    continue
+                annotations = tool.get("annotations") or {}
+                cacheable = server.cacheable
+                if cacheable is None:
+                    # 冪等でも読み取り専用とは限らないので、キャッシュ・再生は readOnlyHint のツールだけにする
+                    cacheable = bool(annotations.get("readOnlyHint"))
+                registry.register_remote(
+                    name,
+                    tool.get("description") or "",
+                    _parameters(tool.get("inputSchema")),
+                    _tool_function(server, tool["name"]),
+                    target=f"mcp:{server.name}/{tool['name']}",
+                    cacheable=cacheable,
+                )
+                names.append(name)
+            self._registered[server.name] = names
+        logger.info(f"Registered {len(names)} tool(s) from MCP server {server.name}")
+
+    async def aclose(self) -> None:
+        for server in self.servers:
+            await server.aclose()
+
+
+mcp_tools = MCPToolset.from_env()
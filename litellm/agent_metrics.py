@@ -0,0 +1,234 @@
+"""
+Latency metrics for the MyCustomLLM pipeline.
+
+Histograms use fixed buckets and plain list increments, so an observation
+costs a bisect and two additions; counters are a dict increment. ``render()`` produces the Prometheus text
+exposition format; set ``AGENT_METRICS_PORT`` to serve it on ``/metrics``
+from a background thread of each proxy worker. That thread only reads
+snapshots taken under the registry lock, which the event loop takes when it
+adds a series or a counter value.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# 1ms 〜 約65秒の対数スケール
+DEFAULT_BUCKETS = tuple(0.001 * 2 ** i for i in range(17))
+
+
+class Histogram:
+    """Cumulative-bucket histogram compatible with the Prometheus data model."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Approximate quantile (upper bound of the bucket containing it)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Named histograms and counters with labels, plus collectors for externally owned stats."""
+
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors: List[Callable[[], List[Tuple[str, dict, float]]]] = []
+        # render() は /metrics のスレッドで動くので、系列の追加とスナップショットを排他する
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, name: str, **labels: str) -> float:
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def add_collector(self, collector: Callable[[], List[Tuple[str, dict, float]]]) -> None:
+        """Register a callable returning ``(name, labels, value)`` gauge samples at render time."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            # バケットの値は写し取り、並べ替えや整形はロックの外で行う
+            histograms = [(key, list(h.counts), h.sum, h.buckets) for key, h in self._histograms.items()]
+            counters = list(self._counters.items())
+            collectors = list(self._collectors)
+        lines = []
+        described = set()
+        for (name, labels), counts, total, buckets in sorted(histograms, key=lambda item: item[0]):
+            # +Inf と _count は写したバケットから数え、途中の observe で累積と食い違わないようにする
+            count = sum(counts)
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels(labels, le=f'{bound:g}')} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for (name, labels), value in sorted(counters):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for collector in collectors:
+            try:
+                samples = collector()
+            except Exception:
+                logger.exception("Metrics collector failed")
+                continue
+            for name, labels, value in samples:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name}{_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...], **extra: str) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _escape(value) -> str:
+    # ツール名やモデル名に含まれうる \ " 改行はエスケープしないと出力全体が読めなくなる
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+metrics.describe("agent_request_seconds", "Total time of a MyCustomLLM request")
+metrics.describe("agent_upstream_seconds", "Duration of upstream litellm calls by phase (decision = with tools)")
+metrics.describe("agent_ttft_seconds", "Time from request start to the first streamed text chunk")
+metrics.describe("agent_inter_chunk_seconds", "Gap between consecutive streamed chunks")
+metrics.describe("agent_tool_seconds", "Tool execution time")
+metrics.describe("agent_speculation_total", "Speculative answer streams by outcome (win = released to the client)")
+metrics.describe("agent_speculation_wasted_tokens_total", "Completion tokens of cancelled speculative answer streams")
+
+
+class Timer:
+    """``with Timer("agent_tool_seconds", tool=name):`` records the block's duration."""
+
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, name: str, **labels: str):
+        self._histogram = metrics.histogram(name, **labels)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class StreamClock:
+    """Tracks TTFT and inter-chunk gaps for one streamed response."""
+
+    __slots__ = ("_start", "_last", "_ttft", "_gap")
+
+    def __init__(self, start: float):
+        self._start = start
+        self._last: Optional[float] = None
+        self._ttft = metrics.histogram("agent_ttft_seconds")
+        self._gap = metrics.histogram("agent_inter_chunk_seconds")
+
+    def tick(self) -> None:
+        now = time.perf_counter()
+        if self._last is None:
+            self._ttft.observe(now - self._start)
+        else:
+            self._gap.observe(now - self._last)
+        self._last = now
+
+
+_server: "Optional[ThreadingHTTPServer]" = None
+
+
+def start_metrics_server(port: Optional[int] = None) -> "Optional[ThreadingHTTPServer]":
+    """Serve ``/metrics`` on ``port`` (default ``AGENT_METRICS_PORT``); no-op if unset or already running."""
+    global _server
+    if _server is not None:
+        return _server
+    port = port or int(os.environ.get("AGENT_METRICS_PORT", "0"))
+    if not port:
+        return None
+    # http.server は使う場合だけ import する (プロキシの起動時間を増やさない)
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        _server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    except OSError as e:
+        # 複数ワーカーの場合は最初のワーカーだけがポートを確保できる
+        logger.warning(f"Metrics server not started on port {port}: {e}")
+        return None
+    threading.Thread(target=_server.serve_forever, name="agent-metrics", daemon=True).start()
+    logger.info(f"Serving agent metrics on :{port}/metrics")
+    return _server
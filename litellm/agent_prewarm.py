@@ -0,0 +1,116 @@
+"""
+Background pre-warming for MyCustomLLM.
+
+The first request of a proxy worker pays for work that does not depend on
+the request: loading the Ollama model into memory, litellm's model-info
+lookup for the context budget, and importing the lazily registered tool
+modules. With ``AGENT_PREWARM`` set to a comma-separated list of models
+(``litellm_params.model`` without the ``my-custom-llm/`` prefix, optionally
+followed by ``@api_base``), that work runs in a daemon thread started when
+agent.py is imported, so it overlaps with the rest of the proxy startup:
+
+    AGENT_PREWARM="ollama/qwen3:0.6b@http://0.0.0.0:11434,openai/gpt-5-nano"
+
+- ``ollama/`` and ``ollama_chat/`` models are loaded with an empty
+  ``/api/generate`` request and kept for ``AGENT_PREWARM_KEEP_ALIVE``
+  seconds or duration (default "30m", like ``agent_settings.keep_alive``)
+- the context budget of every model is looked up
+- tool modules are imported and the ``tools`` payload is built
+
+Connections are not opened here: pooled clients are bound to the event loop
+of the request and are warmed on the first request (``agent_clients``).
+"""
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Tuple, Union
+
+import httpx
+
+from agent_metrics import metrics
+from agent_registry import ToolRegistry
+from agent_router import provider_name
+
+logger = logging.getLogger(__name__)
+
+_OLLAMA_PROVIDERS = ("ollama", "ollama_chat")
+_OLLAMA_DEFAULT_BASE = "http://localhost:11434"
+# モデルの読み込みはディスクから数GBを読むことがあるため長めに待つ
+_LOAD_TIMEOUT = 300.0
+
+metrics.describe("agent_prewarm_seconds", "Time spent by each background pre-warming step")
+
+
+def prewarm_targets(value: Optional[str] = None) -> List[Tuple[str, Optional[str]]]:
+    """``(model, api_base)`` pairs from ``AGENT_PREWARM``."""
+    value = os.environ.get("AGENT_PREWARM", "") if value is None else value
+    targets = []
+    for entry in value.split(","):
+        model, _, api_base = entry.strip().partition("@")
+        if model:
+            targets.append((model, api_base or None))
+    return targets
+
+
+def load_ollama_model(model: str, api_base: Optional[str], keep_alive: Union[str, int]) -> None:
+    """Ask Ollama to load ``model`` without generating anything."""
+    base = api_base or os.environ.get("OLLAMA_API_BASE") or _OLLAMA_DEFAULT_BASE
+    response = httpx.post(
+        f"{base.rstrip('/')}/api/generate",
+        json={"model": model.split("/", 1)[1], "keep_alive": keep_alive},
+        timeout=_LOAD_TIMEOUT,
+    )
+    response.raise_for_status()
+
+
+def _step(name: str, function: Callable[[], object]) -> None:
+    start = time.perf_counter()
+    try:
+        function()
+    except Exception as e:
+        logger.warning(f"Pre-warming {name} failed: {e}")
+        return
+    elapsed = time.perf_counter() - start
+    metrics.observe("agent_prewarm_seconds", elapsed, step=name.split(" ", 1)[0])
+    logger.info(f"Pre-warmed {name} in {elapsed:.2f}s")
+
+
+def _import_tools(registry: ToolRegistry) -> None:
+    for tool in registry.tools:
+        registry.resolve(tool["function"]["name"])
+
+
+def prewarm(targets: List[Tuple[str, Optional[str]]], registry: ToolRegistry, budget: Callable[[str], int]) -> None:
+    """Run every pre-warming step for ``targets`` in the calling thread."""
+    keep_alive = os.environ.get("AGENT_PREWARM_KEEP_ALIVE", "30m")
+    if keep_alive.lstrip("-").isdigit():
+        keep_alive = int(keep_alive)
+    # Ollama の読み込みが最も遅いため先に依頼し、その間に残りを済ませる
+    loads = [
+        threading.Thread(
+            target=_step,
+            args=(f"load {model}", lambda model=model, api_base=api_base: load_ollama_model(model, api_base, keep_alive)),
+            daemon=True,
+        )
+        for model, api_base in targets
+        if provider_name(model) in _OLLAMA_PROVIDERS
+    ]
+    for thread in loads:
+        thread.start()
+    _step("tools", lambda: _import_tools(registry))
+    for model, _ in targets:
+        _step(f"budget {model}", lambda model=model: budget(model))
+    for thread in loads:
+        thread.join()
+
+
+def start_prewarm(registry: ToolRegistry, budget: Callable[[str], int]) -> Optional[threading.Thread]:
+    """Pre-warm the ``AGENT_PREWARM`` models in a daemon thread; no-op when unset."""
+    targets = prewarm_targets()
+    if not targets:
+        return None
+    thread = threading.Thread(target=prewarm, args=(targets, registry, budget), name="agent-prewarm", daemon=True)
+    thread.start()
+    logger.info(f"Pre-warming {len(targets)} model(s) in the background")
+    return thread
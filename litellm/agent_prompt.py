@@ -0,0 +1,131 @@
+"""
+Prompt-prefix caching for MyCustomLLM.
+
+Every tool-decision call starts with the same tools schema and system prompt.
+Providers only reuse the work for a repeated prefix when it is byte-identical
+(OpenAI's automatic prompt caching, Anthropic cache breakpoints) and, for
+Ollama, while the model is still loaded with its KV cache. This module:
+
+- keeps the leading static system messages ahead of the compaction summary
+  (``stable_prefix``); the tools schema itself is already serialized in a
+  fixed order by ``ToolRegistry``
+- adds provider hints to each upstream call (``cache_kwargs``):
+  ``prompt_cache_key`` for api.openai.com, a cache breakpoint on the system
+  prompt for Anthropic-style providers and ``keep_alive`` for Ollama
+- counts prompt and cached prompt tokens from the reported usage
+  (``record_usage``), so prefix reuse can be checked on ``/metrics``
+"""
+import hashlib
+import json
+import os
+from typing import Any, Mapping
+
+from agent_context import SUMMARY_MARKER
+from agent_metrics import metrics
+from agent_router import provider_name
+from agent_stream import usage_dict
+
+_OPENAI_HOST = "https://api.openai.com"
+# litellm の cache_control_injection_points を解釈するプロバイダ
+_CACHE_CONTROL_PROVIDERS = ("anthropic", "bedrock", "vertex_ai")
+_OLLAMA_PROVIDERS = ("ollama", "ollama_chat")
+
+metrics.describe("agent_prompt_tokens_total", "Prompt tokens reported by upstream calls")
+metrics.describe("agent_cached_prompt_tokens_total", "Prompt tokens the provider served from its prompt cache")
+
+
+def _is_static_system(message: dict) -> bool:
+    if message.get("role") != "system":
+        return False
+    content = message.get("content")
+    return not (isinstance(content, str) and content.startswith(SUMMARY_MARKER))
+
+
+def stable_prefix(messages: list) -> list:
+    """
+    Order the leading run of system messages as static system messages, then
+    other system messages (the compaction summary), keeping relative order.
+
+    System messages later in the conversation stay where they are, since
+    moving them would change what they apply to. Returns ``messages`` itself
+    when it is already in that order.
+    """
+    lead = 0
+    while lead < len(messages) and messages[lead].get("role") == "system":
+        lead += 1
+    head = messages[:lead]
+    ordered = [m for m in head if _is_static_system(m)] + [m for m in head if not _is_static_system(m)]
+    if all(a is b for a, b in zip(ordered, head)):
+        return messages
+    return ordered + messages[lead:]
+
+
+def prefix_key(messages: list, tools_json: str = "") -> str:
+    """Short hash of the static prefix (tools schema and leading system messages)."""
+    digest = hashlib.blake2b(tools_json.encode(), digest_size=8)
+    for message in messages:
+        if not _is_static_system(message):
+            break
+        digest.update(json.dumps(message, sort_keys=True, separators=(",", ":"), default=str).encode())
+    return digest.hexdigest()
+
+
+def _is_openai_api(deployment: dict) -> bool:
+    api_base = (
+        deployment.get("api_base")
+        or os.environ.get("OPENAI_BASE_URL")
+        or os.environ.get("OPENAI_API_BASE")
+        or _OPENAI_HOST
+    )
+    return api_base.startswith(_OPENAI_HOST)
+
+
+def cache_kwargs(deployment: dict, messages: list, tools_json: str, stream: bool, keep_alive: Any) -> dict:
+    """
+    Provider-specific ``litellm.acompletion`` kwargs that help the provider reuse the prompt prefix.
+
+    Keys already present in ``deployment`` are left to the deployment.
+
+    Args:
+        deployment: The deployment the call goes to.
+        messages: Messages of the call, already passed through ``stable_prefix``.
+        tools_json: ``ToolRegistry.tools_json`` when the call has tools, else "".
+        stream: Whether the call streams (usage then has to be requested).
+        keep_alive: Ollama ``keep_alive`` (e.g. "30m", -1); falsy leaves Ollama's default.
+    """
+    provider = provider_name(deployment["model"])
+    kwargs = {}
+    if provider == "openai":
+        if _is_openai_api(deployment):
+            # 同じ接頭辞のリクエストを同じキャッシュに振り分けてもらう
+            kwargs["extra_body"] = {"prompt_cache_key": prefix_key(messages, tools_json)}
+        if stream:
+            # ストリームでもキャッシュ済みトークン数を含む usage を返してもらう
+            kwargs["stream_options"] = {"include_usage": True}
+    elif provider in _CACHE_CONTROL_PROVIDERS:
+        if messages and _is_static_system(messages[0]):
+            # ツール定義とシステムプロンプトまでをキャッシュの区切りにする
+            kwargs["cache_control_injection_points"] = [{"location": "message", "role": "system"}]
+    elif provider in _OLLAMA_PROVIDERS and keep_alive:
+        # モデルをメモリに残し、前回のKVキャッシュを再利用できるようにする
+        kwargs["keep_alive"] = keep_alive
+    return {key: value for key, value in kwargs.items() if key not in deployment}
+
+
+def cached_tokens(usage: Any) -> int:
+    """Cached prompt tokens in ``usage`` (0 when the provider does not report them)."""
+    details = usage.get("prompt_tokens_details")
+    if isinstance(details, Mapping):
+        cached = details.get("cached_tokens")
+    else:
+        cached = getattr(details, "cached_tokens", None)
+    return cached or usage.get("cache_read_input_tokens") or 0
+
+
+def record_usage(model: str, usage: Any) -> None:
+    """Count the prompt and cached prompt tokens of one upstream call."""
+    if not usage:
+        return
+    usage = usage_dict(usage)
+    metrics.inc("agent_prompt_tokens_total", usage.get("prompt_tokens") or 0, model=model)
+    metrics.inc("agent_cached_prompt_tokens_total", cached_tokens(usage), model=model)
@@ -0,0 +1,372 @@
+"""
+Tool registry for MyCustomLLM.
+
+The JSON schema of every tool is derived once from its signature and
+Google-style docstring. Schemas are read from the source with ``ast``, so a
+tool registered with :meth:`ToolRegistry.register_lazy` is not imported
+until it is first called. Each tool also gets a precompiled argument
+validator so bad arguments can be reported back to the model.
+"""
+import ast
+import importlib
+import importlib.util
+import inspect
+import json
+import logging
+import re
+import textwrap
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_JSON_TYPES = {
+    "str": "string",
+    "int": "integer",
+    "float": "number",
+    "bool": "boolean",
+    "list": "array",
+    "List": "array",
+    "tuple": "array",
+    "dict": "object",
+    "Dict": "object",
+}
+
+_PYTHON_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "array": (list,),
+    "object": (dict,),
+    "null": (type(None),),
+}
+
+_ARG_LINE = re.compile(r"^(\w+)\s*(?:\([^)]*\))?\s*:\s*(.*)$")
+
+
+def _annotation_schema(node: Optional[ast.expr]) -> dict:
+    """Translate a parameter annotation AST node into a JSON schema fragment."""
+    if node is None:
+        return {}
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        # 文字列で書かれたアノテーション ("str" など)
+        return _annotation_schema(ast.parse(node.value, mode="eval").body)
+    if isinstance(node, ast.Name):
+        json_type = _JSON_TYPES.get(node.id)
+        return {"type": json_type} if json_type else {}
+    if isinstance(node, ast.Attribute):
+        return _annotation_schema(ast.Name(id=node.attr))
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitOr):
+        # X | None は X として扱う
+        for side in (node.left, node.right):
+            if not (isinstance(side, ast.Constant) and side.value is None):
+                return _annotation_schema(side)
+        return {}
+    if isinstance(node, ast.Subscript):
+        origin = node.value.attr if isinstance(node.value, ast.Attribute) else getattr(node.value, "id", "")
+        items = node.slice.elts if isinstance(node.slice, ast.Tuple) else [node.slice]
+        if origin == "Literal":
+            values = [item.value for item in items if isinstance(item, ast.Constant)]
+            schema = {"enum": values}
+            types = {_JSON_TYPES.get(type(v).__name__) for v in values}
+            if len(types) == 1 and None not in types:
+                schema["type"] = types.pop()
+            return schema
+        if origin in ("Optional", "Union"):
+            for item in items:
+                if not (isinstance(item, ast.Constant) and item.value is None):
+                    return _annotation_schema(item)
+            return {}
+        if origin in ("list", "List", "Sequence", "tuple", "Tuple"):
+            schema = {"type": "array"}
+            item_schema = _annotation_schema(items[0])
+            if item_schema:
+                schema["items"] = item_schema
+            return schema
+        if origin in ("dict", "Dict", "Mapping"):
+            return {"type": "object"}
+    return {}
+
+
+def _parse_docstring(docstring: Optional[str]):
+    """Split a Google-style docstring into (summary, {param: description})."""
+    if not docstring:
+        return "", {}
+    lines = inspect.cleandoc(docstring).splitlines()
+    summary_lines = []
+    for line in lines:
+        if not line.strip() or line.strip().endswith(":"):
+            break
+        summary_lines.append(line.strip())
+    params = {}
+    in_args = False
+    current = None
+    for line in lines:
+        stripped = line.strip()
+        if stripped in ("Args:", "Arguments:", "Parameters:"):
+            in_args = True
+            continue
+        if not in_args:
+            continue
+        if stripped.endswith(":") and not line.startswith(" "):
+            break  # 次のセクション (Returns: など)
+        match = _ARG_LINE.match(stripped)
+        if match and line.startswith("    ") and not line.startswith("        "):
+            current = match.group(1)
+            params[current] = match.group(2)
+        elif current and stripped:
+            params[current] += " " + stripped
+    return " ".join(summary_lines).rstrip("."), params
+
+
+def _function_schema(node: ast.FunctionDef, name: str) -> dict:
+    """Build the OpenAI ``tools`` entry for a function definition node."""
+    description, param_docs = _parse_docstring(ast.get_docstring(node))
+    args = node.args
+    positional = args.posonlyargs + args.args
+    defaults = [None] * (len(positional) - len(args.defaults)) + list(args.defaults)
+    params = list(zip(positional, defaults)) + list(zip(args.kwonlyargs, args.kw_defaults))
+
+    properties = {}
+    required = []
+    for arg, default in params:
+        if arg.arg in ("self", "cls"):
+            continue
+        schema = _annotation_schema(arg.annotation)
+        if arg.arg in param_docs:
+            schema["description"] = param_docs[arg.arg]
+        properties[arg.arg] = schema
+        if default is None:
+            required.append(arg.arg)
+
+    parameters = {
+        "type": "object",
+        "properties": properties,
+        "required": required,
+    }
+    if args.kwarg is None:
+        # **kwargs を受け取らない関数には、シグネチャに無い引数を渡せない
+        parameters["additionalProperties"] = False
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": parameters,
+        },
+    }
+
+
+def _compile_validator(parameters: dict) -> Callable[[Any], Optional[str]]:
+    """
+    Precompile an argument validator for a tool's parameters schema.
+
+    The returned function returns ``None`` for valid arguments and an error
+    message otherwise. Only the subset of JSON schema the registry generates
+    (type, enum, required, and no extra keys when ``additionalProperties`` is
+    ``false``) is checked; as in JSON schema, extra keys are allowed otherwise.
+    """
+    required = tuple(parameters.get("required", ()))
+    allow_extra = parameters.get("additionalProperties", True) is not False
+    checks = {}
+    for key, schema in parameters.get("properties", {}).items():
+        type_names = schema.get("type")
+        if isinstance(type_names, list):
+            # 外部のスキーマ (MCP など) では ["string", "null"] のような複数の型も使われる
+            types = sum((_PYTHON_TYPES.get(t, ()) for t in type_names), ()) or None
+            reject_bool = "boolean" not in type_names and bool({"integer", "number"} & set(type_names))
+        else:
+            types = _PYTHON_TYPES.get(type_names)
+            reject_bool = type_names in ("integer", "number")
+        enum = frozenset(schema["enum"]) if "enum" in schema and all(
+            not isinstance(v, (list, dict)) for v in schema["enum"]
+        ) else None
+        checks[key] = (types, enum, reject_bool, type_names)
+
+    def validate(arguments: Any) -> Optional[str]:
+        if not isinstance(arguments, dict):
+            return "Arguments must be a JSON object"
+        for key in required:
+            if key not in arguments:
+                return f"Missing required argument '{key}'"
+        for key, value in arguments.items():
+            check = checks.get(key)
+            if check is None:
+                if allow_extra:
+                    continue
+                return f"Unexpected argument '{key}'"
+            types, enum, reject_bool, type_name = check
+            if types is not None and (not isinstance(value, types) or (reject_bool and isinstance(value, bool))):
+                return f"Argument '{key}' must be of type {type_name}"
+            if enum is not None and (isinstance(value, (list, dict)) or value not in enum):
+                return f"Argument '{key}' must be one of {sorted(enum, key=str)}"
+        return None
+
+    return validate
+
+
+class ToolSpec:
+    """
+    A registered tool: its schema, validator and (possibly not yet imported) function.
+
+    ``cacheable`` marks the tool as idempotent so its results may be served from
+    the tool-result cache; ``cache_ttl`` overrides the cache's default TTL.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        schema: dict,
+        target: str,
+        function: Optional[Callable[..., Any]] = None,
+        cacheable: bool = True,
+        cache_ttl: Optional[float] = None,
+    ):
+        self.name = name
+        self.schema = schema
+        self.target = target
+        self.function = function
+        self.cacheable = cacheable
+        self.cache_ttl = cache_ttl
+        self.validate = _compile_validator(schema["function"]["parameters"])
+
+
+class ToolRegistry:
+    """
+    Registry of the tools exposed to the model.
+
+    Usage::
+
+        registry = ToolRegistry()
+        registry.register_lazy("agent_tools.weather:get_current_weather")
+
+        @registry.register(cacheable=False)
+        def send_mail(to: str, body: str) -> str:
+            ...
+    """
+
+    def __init__(self):
+        self._specs: Dict[str, ToolSpec] = {}
+        self._tools: Optional[List[dict]] = None
+        self._tools_json: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def register(
+        self,
+        function: Callable[..., Any] = None,
+        *,
+        name: Optional[str] = None,
+        cacheable: bool = True,
+        cache_ttl: Optional[float] = None,
+    ):
+        """Register an already-imported function. Usable as a decorator."""
+        if function is None:
+            return lambda f: self.register(f, name=name, cacheable=cacheable, cache_ttl=cache_ttl)
+        source = textwrap.dedent(inspect.getsource(function))
+        node = next(n for n in ast.walk(ast.parse(source)) if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)))
+        tool_name = name or function.__name__
+        target = f"{function.__module__}:{function.__qualname__}"
+        self._add(ToolSpec(tool_name, _function_schema(node, tool_name), target, function, cacheable, cache_ttl))
+        return function
+
+    def register_lazy(
+        self,
+        target: str,
+        *,
+        name: Optional[str] = None,
+        cacheable: bool = True,
+        cache_ttl: Optional[float] = None,
+    ) -> None:
+        """
+        Register ``"module:function"`` without importing the module.
+
+        The schema is built from the module source; the module is imported on
+        the first call of the tool.
+        """
+        module_name, _, attr = target.partition(":")
+        spec = importlib.util.find_spec(module_name)
+        if spec is None or spec.origin is None:
+            raise ImportError(f"Tool module '{module_name}' not found")
+        with open(spec.origin, encoding="utf-8") as f:
+            tree = ast.parse(f.read(), filename=spec.origin)
+        node = next(
+            (n for n in tree.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)) and n.name == attr),
+            None,
+        )
+        if node is None:
+            raise ImportError(f"Function '{attr}' not found in '{module_name}'")
+        tool_name = name or attr
+        self._add(ToolSpec(tool_name, _function_schema(node, tool_name), target, None, cacheable, cache_ttl))
+
+    def register_remote(
+        self,
+        name: str,
+        description: str,
+        parameters: dict,
+        function: Callable[..., Any],
+        *,
+        target: str,
+        cacheable: bool = False,
+        cache_ttl: Optional[float] = None,
+    ) -> None:
+        """Register a tool implemented elsewhere (e.g. on an MCP server) from its JSON schema."""
+        schema = {
+            "type": "function",
+            "function": {"name": name, "description": description, "parameters": parameters},
+        }
+        self._add(ToolSpec(name, schema, target, function, cacheable, cache_ttl))
+
+    def unregister(self, name: str) -> None:
+        self._specs.pop(name, None)
+        self._tools = None
+        self._tools_json = None
+
+    def _add(self, spec: ToolSpec) -> None:
+        if spec.name in self._specs:
+            raise ValueError(f"Tool '{spec.name}' is already registered")
+        self._specs[spec.name] = spec
+        self._tools = None
+        self._tools_json = None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._specs
+
+    def __len__(self) -> int:
+        return len(self._specs)
+
+    @property
+    def tools(self) -> List[dict]:
+        """The ``tools`` payload for litellm, built once and cached."""
+        if self._tools is None:
+            # 登録順によらず同じ並びにして、プロンプトの接頭辞を毎回同じバイト列にする
+            self._tools = [self._specs[name].schema for name in sorted(self._specs)]
+        return self._tools
+
+    @property
+    def tools_json(self) -> str:
+        """Canonical serialized form of :attr:`tools`, cached."""
+        if self._tools_json is None:
+            self._tools_json = json.dumps(self.tools, sort_keys=True, separators=(",", ":"))
+        return self._tools_json
+
+    def get(self, name: str) -> Optional[ToolSpec]:
+        return self._specs.get(name)
+
+    def validate(self, name: str, arguments: Any) -> Optional[str]:
+        """Return an error message if ``arguments`` do not match the tool's schema."""
+        spec = self._specs.get(name)
+        if spec is None:
+            return f"Unknown tool: {name}"
+        return spec.validate(arguments)
+
+    def resolve(self, name: str) -> Callable[..., Any]:
+        """Return the tool function, importing its module on first use."""
+        spec = self._specs[name]
+        if spec.function is None:
+            with self._lock:
+                if spec.function is None:
+                    module_name, _, attr = spec.target.partition(":")
+                    logger.info(f"Loading tool module {module_name} for {name}")
+                    spec.function = getattr(importlib.import_module(module_name), attr)
+        return spec.function
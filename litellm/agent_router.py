@@ -0,0 +1,263 @@
+"""
+Upstream routing, fallback and hedging for MyCustomLLM.
+
+A deployment is the set of ``litellm.acompletion`` kwargs that selects one
+backend (``model`` plus optionally ``api_base`` / ``api_key``). For every
+upstream call the agent passes an ordered list of candidate deployments:
+
+- the first healthy candidate is tried; on an error the next one is tried
+- a deployment that fails (or loses a hedge race) ``failure_threshold``
+  times in a row is moved to the back of the list for ``cooldown`` seconds
+- with ``hedge_quantile`` set, a second candidate is started when the first
+  has not produced its first chunk within that quantile of its recent
+  latencies; whichever answers first wins and the other is cancelled and
+  awaited (a stream it opened anyway is closed with ``discard``)
+
+See ``agent_settings`` for the per-model ``decision_model`` / ``fallbacks`` /
+``hedge_quantile`` settings.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar, Union
+
+from agent_metrics import metrics
+from agent_stream import close_stream
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+metrics.describe("agent_upstream_first_chunk_seconds", "Time to the first chunk (or full response) per deployment")
+metrics.describe("agent_route_total", "Upstream attempts per deployment by outcome")
+
+
+def as_deployment(entry: Union[str, dict]) -> dict:
+    """Normalize a ``config.yaml`` entry (model string or kwargs dict) to a deployment."""
+    return {"model": entry} if isinstance(entry, str) else dict(entry)
+
+
+def provider_name(model: str) -> str:
+    """litellm provider prefix of ``model`` ("openai" when there is none)."""
+    return model.split("/", 1)[0] if "/" in model else "openai"
+
+
+def deployment_name(deployment: dict) -> str:
+    api_base = deployment.get("api_base")
+    return f"{deployment['model']}@{api_base}" if api_base else deployment["model"]
+
+
+def litellm_kwargs(deployment: dict) -> dict:
+    """The deployment without the agent-only keys, ready for ``litellm.acompletion``."""
+    return {k: v for k, v in deployment.items() if k != "max_concurrency"}
+
+
+class PeekedStream:
+    """A stream whose first chunk has already been received; ``on_close`` runs once it ends or is closed."""
+
+    def __init__(self, first: Any, iterator: Any, stream: Any, on_close: Optional[Callable[[], None]] = None):
+        self._first = first
+        self._iterator = iterator
+        self._stream = stream
+        self._on_close = on_close
+
+    def _closed(self) -> None:
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+    async def __aiter__(self):
+        try:
+            if self._first is not None:
+                first, self._first = self._first, None
+                yield first
+            async for chunk in self._iterator:
+                yield chunk
+        finally:
+            self._closed()
+
+    async def aclose(self) -> None:
+        self._closed()
+        await close_stream(self._iterator)
+        await close_stream(self._stream)
+
+
+async def open_stream(completion: Awaitable[Any], on_close: Optional[Callable[[], None]] = None) -> PeekedStream:
+    """Await a ``stream=True`` completion and its first chunk, so the latency covers time to first token."""
+    stream = await completion
+    iterator = stream.__aiter__()
+    try:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        # 最初のチャンクを待つ間にキャンセル・失敗した場合も上流のストリームを閉じる
+        await close_stream(iterator)
+        await close_stream(stream)
+        raise
+    return PeekedStream(first, iterator, stream, on_close)
+
+
+class _Health:
+    __slots__ = ("latencies", "strikes", "cooldown_until")
+
+    def __init__(self):
+        self.latencies: deque = deque(maxlen=200)
+        self.strikes = 0
+        self.cooldown_until = 0.0
+
+
+class Router:
+    """
+    Orders candidate deployments by health and races them.
+
+    Args:
+        failure_threshold: Consecutive failures or lost hedges before a cooldown.
+        cooldown: Seconds a deployment is moved to the back of the list.
+        min_samples: Latency samples needed before hedging a deployment.
+    """
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 30.0, min_samples: int = 20):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.min_samples = min_samples
+        self._health: Dict[str, _Health] = {}
+
+    def _get(self, name: str) -> _Health:
+        health = self._health.get(name)
+        if health is None:
+            health = self._health.setdefault(name, _Health())
+        return health
+
+    def order(self, deployments: List[dict]) -> List[dict]:
+        """Configured order, with deployments in cooldown moved to the end."""
+        now = time.monotonic()
+        healthy, cooling = [], []
+        for deployment in deployments:
+            health = self._health.get(deployment_name(deployment))
+            (cooling if health is not None and health.cooldown_until > now else healthy).append(deployment)
+        return healthy + cooling
+
+    def hedge_delay(self, deployment: dict, quantile: float, minimum: float) -> Optional[float]:
+        if quantile <= 0:
+            return None
+        health = self._health.get(deployment_name(deployment))
+        if health is None or len(health.latencies) < self.min_samples:
+            return None
+        latencies = sorted(health.latencies)
+        return max(minimum, latencies[min(len(latencies) - 1, int(quantile * len(latencies)))])
+
+    def _strike(self, name: str, outcome: str) -> None:
+        metrics.inc("agent_route_total", deployment=name, outcome=outcome)
+        health = self._get(name)
+        health.strikes += 1
+        if health.strikes >= self.failure_threshold:
+            health.strikes = 0
+            health.cooldown_until = time.monotonic() + self.cooldown
+            logger.warning(f"Deployment {name} cooling down for {self.cooldown}s after repeated {outcome}s")
+
+    async def _attempt(self, deployment: dict, attempt: Callable[[dict], Awaitable[T]]) -> T:
+        name = deployment_name(deployment)
+        start = time.perf_counter()
+        try:
+            result = await attempt(deployment)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Upstream {name} failed: {e}")
+            self._strike(name, "error")
+            raise
+        elapsed = time.perf_counter() - start
+        health = self._get(name)
+        health.latencies.append(elapsed)
+        metrics.observe("agent_upstream_first_chunk_seconds", elapsed, deployment=name)
+        return result
+
+    async def call(
+        self,
+        deployments: List[dict],
+        attempt: Callable[[dict], Awaitable[T]],
+        hedge_quantile: float = 0.0,
+        hedge_min_delay: float = 0.25,
+        discard: Optional[Callable[[T], Awaitable[None]]] = None,
+    ) -> Tuple[dict, T]:
+        """
+        Run ``attempt`` against the candidates until one succeeds.
+
+        Args:
+            deployments: Candidates in order of preference.
+            attempt: Makes the upstream call for one deployment.
+            hedge_quantile: Start the next candidate when the current one is
+                slower than this quantile of its recent latencies (0 disables).
+            hedge_min_delay: Lower bound of the hedge delay in seconds.
+            discard: Releases the result of an attempt that lost the race.
+
+        Returns:
+            The winning deployment and its result.
+        """
+        candidates = self.order(deployments)
+        pending: Dict["asyncio.Future[T]", dict] = {}
+        launched: List["asyncio.Future[T]"] = []
+        last_error: Optional[BaseException] = None
+        winner: Optional["asyncio.Future[T]"] = None
+
+        def launch() -> None:
+            deployment = candidates[len(launched)]
+            task = asyncio.ensure_future(self._attempt(deployment, attempt))
+            pending[task] = deployment
+            launched.append(task)
+
+        launch()
+        try:
+            while pending:
+                delay = None
+                if len(pending) == 1 and len(launched) < len(candidates):
+                    delay = self.hedge_delay(next(iter(pending.values())), hedge_quantile, hedge_min_delay)
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 遅い: 次の候補にも同じリクエストを送り、先に返った方を使う
+                    hedged = pending[next(iter(pending))]
+                    logger.info(f"Hedging {deployment_name(hedged)} after {delay:.2f}s")
+                    metrics.inc("agent_route_total", deployment=deployment_name(hedged), outcome="hedged")
+                    launch()
+                    continue
+                for task in sorted(done, key=launched.index):
+                    deployment = pending.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        continue
+                    name = deployment_name(deployment)
+                    metrics.inc("agent_route_total", deployment=name, outcome="ok")
+                    self._get(name).strikes = 0
+                    for loser in pending.values():
+                        self._strike(deployment_name(loser), "slow")
+                    winner = task
+                    return deployment, task.result()
+                if not pending and len(launched) < len(candidates):
+                    logger.info(f"Falling back to {deployment_name(candidates[len(launched)])}")
+                    launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+            # キャンセルした候補の終了を待ち、例外を回収する (負けた後に開いたストリームは下で閉じる)
+            await asyncio.gather(*pending, return_exceptions=True)
+            if discard is not None:
+                for task in launched:
+                    if task is not winner and task.done() and not task.cancelled() and task.exception() is None:
+                        await discard(task.result())
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            name: {
+                "samples": len(health.latencies),
+                "p50": sorted(health.latencies)[len(health.latencies) // 2] if health.latencies else None,
+                "cooling_down": health.cooldown_until > now,
+            }
+            for name, health in self._health.items()
+        }
+
+
+router = Router()
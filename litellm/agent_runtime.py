@@ -0,0 +1,254 @@
+"""
+Tool execution and sync/async bridging for MyCustomLLM.
+
+All tool calls of one round run concurrently: ``async def`` tools are awaited
+directly, plain functions run on a bounded thread pool so a slow or blocking
+tool never stalls the proxy's event loop. Every call has a timeout, and
+cancelling the awaiting task (e.g. the client disconnected) cancels the
+whole round. Results of cacheable tools go through ``agent_cache.tool_cache``,
+and with a ``TurnReplay`` (``agent_session``) their results recorded for the
+same conversation turn are replayed instead of running the tool again, so a
+regenerated answer sees the same tool results as the first one.
+"""
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Coroutine, Dict, List, Optional, Tuple, TypeVar
+
+from agent_cache import tool_cache
+from agent_metrics import Timer
+from agent_registry import ToolRegistry
+from agent_session import TurnReplay
+
+logger = logging.getLogger(__name__)
+
+TOOL_EXECUTOR_WORKERS = int(os.environ.get("AGENT_TOOL_WORKERS", "8"))
+_executor = ThreadPoolExecutor(max_workers=TOOL_EXECUTOR_WORKERS, thread_name_prefix="agent-tool")
+
+# これより大きいツール引数のJSONはイベントループの外でパースする
+LARGE_ARGUMENTS_BYTES = 64 * 1024
+
+T = TypeVar("T")
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _tool_message(tool_call_id: str, content: str) -> dict:
+    return {"role": "tool", "tool_call_id": tool_call_id, "content": content}
+
+
+def _failure(tool_call_id: str, message: str) -> Tuple[dict, bool]:
+    return _tool_message(tool_call_id, json.dumps({"error": message})), True
+
+
+async def run_tool_call(
+    tool_call: dict,
+    registry: ToolRegistry,
+    timeout: float,
+    replay: Optional[TurnReplay] = None,
+) -> Tuple[dict, bool]:
+    """
+    Execute a single tool call.
+
+    Failures (unknown tool, arguments that do not match the schema, exceptions,
+    timeouts) are returned to the model as an error tool message instead of
+    failing the request.
+
+    Returns:
+        A ``role: tool`` message answering ``tool_call``, and whether the call
+        failed (a tool whose own result mentions an error has not failed).
+    """
+    function_name = tool_call["function"]["name"]
+    tool_call_id = tool_call["id"]
+
+    if function_name not in registry:
+        logger.warning(f"Tool {function_name} not found in registry")
+        return _failure(tool_call_id, f"Unknown tool: {function_name}")
+
+    loop = asyncio.get_running_loop()
+    arguments = tool_call["function"]["arguments"] or "{}"
+    try:
+        if len(arguments) > LARGE_ARGUMENTS_BYTES:
+            function_args = await loop.run_in_executor(_executor, json.loads, arguments)
+        else:
+            function_args = json.loads(arguments)
+    except ValueError as e:
+        logger.warning(f"Invalid arguments for tool {function_name}: {e}")
+        return _failure(tool_call_id, f"Arguments are not valid JSON: {e}")
+
+    error = registry.validate(function_name, function_args)
+    if error:
+        logger.warning(f"Invalid arguments for tool {function_name}: {error}")
+        return _failure(tool_call_id, error)
+
+    spec = registry.get(function_name)
+    # 副作用のあるツールは記録も再生もしない
+    if not spec.cacheable:
+        replay = None
+    if replay is not None:
+        content = await replay.get(function_name, function_args)
+        if content is not None:
+            return _tool_message(tool_call_id, content), False
+
+    logger.info(f"Executing tool: {function_name}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Tool {function_name} args: {function_args}")
+
+    async def invoke() -> str:
+        function_to_call = spec.function
+        if function_to_call is None:
+            # 初回呼び出し時のモジュール import はイベントループの外で行う
+            function_to_call = await loop.run_in_executor(_executor, registry.resolve, function_name)
+        with Timer("agent_tool_seconds", tool=function_name):
+            if inspect.iscoroutinefunction(function_to_call):
+                result = await function_to_call(**function_args)
+            else:
+                result = await loop.run_in_executor(_executor, functools.partial(function_to_call, **function_args))
+        return result if isinstance(result, str) else json.dumps(result)
+
+    try:
+        if spec.cacheable and tool_cache.enabled:
+            # 同じ引数の同時呼び出しは1回の実行にまとめ、結果をTTLの間再利用する
+            content = await asyncio.wait_for(
+                tool_cache.get_or_run(function_name, function_args, invoke, ttl=spec.cache_ttl, timeout=timeout),
+                timeout,
+            )
+        else:
+            content = await asyncio.wait_for(invoke(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Tool {function_name} timed out after {timeout}s")
+        return _failure(tool_call_id, f"Tool {function_name} timed out after {timeout}s")
+    except Exception as e:
+        logger.exception(f"Tool {function_name} failed")
+        return _failure(tool_call_id, f"Tool {function_name} failed: {e}")
+
+    logger.info(f"Tool {function_name} executed successfully")
+    if replay is not None:
+        replay.record(function_name, function_args, content)
+    return _tool_message(tool_call_id, content), False
+
+
+class EarlyToolCalls:
+    """
+    Tool calls started while the decision stream is still running.
+
+    ``start`` is called as soon as a call's arguments have closed; the round
+    later picks the running task up through ``take`` instead of starting the
+    call again. Calls whose final arguments differ from the started ones are
+    cancelled and re-run.
+    """
+
+    def __init__(self, registry: ToolRegistry, timeout: float, replay: Optional[TurnReplay] = None):
+        self._registry = registry
+        self._timeout = timeout
+        self._replay = replay
+        self._tasks: Dict[str, Tuple[str, "asyncio.Future[Tuple[dict, bool]]"]] = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def start(self, tool_call: dict) -> None:
+        logger.info(f"Starting tool {tool_call['function']['name']} while the stream continues")
+        task = asyncio.ensure_future(run_tool_call(tool_call, self._registry, self._timeout, self._replay))
+        self._tasks[tool_call["id"]] = (tool_call["function"]["arguments"], task)
+
+    def take(self, tool_call: dict) -> Optional["asyncio.Future[Tuple[dict, bool]]"]:
+        entry = self._tasks.pop(tool_call["id"], None)
+        if entry is None:
+            return None
+        arguments, task = entry
+        if arguments != tool_call["function"]["arguments"]:
+            task.cancel()
+            return None
+        return task
+
+    def cancel(self) -> None:
+        """Cancel the calls that were never taken (e.g. the client disconnected)."""
+        for _, task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+
+def _start_all(
+    tool_calls: List[dict],
+    registry: ToolRegistry,
+    timeout: float,
+    early: Optional[EarlyToolCalls],
+    replay: Optional[TurnReplay],
+) -> List["asyncio.Future[Tuple[dict, bool]]"]:
+    futures = []
+    for tool_call in tool_calls:
+        future = early.take(tool_call) if early is not None else None
+        futures.append(future or asyncio.ensure_future(run_tool_call(tool_call, registry, timeout, replay)))
+    if early is not None:
+        early.cancel()
+    return futures
+
+
+async def run_tool_calls(
+    tool_calls: List[dict],
+    registry: ToolRegistry,
+    timeout: float,
+    early: Optional[EarlyToolCalls] = None,
+    replay: Optional[TurnReplay] = None,
+) -> List[dict]:
+    """Execute one round of tool calls concurrently, returning their tool messages in order."""
+    results = await asyncio.gather(*_start_all(tool_calls, registry, timeout, early, replay))
+    return [message for message, _ in results]
+
+
+async def iter_tool_calls(
+    tool_calls: List[dict],
+    registry: ToolRegistry,
+    timeout: float,
+    heartbeat: Optional[float] = None,
+    early: Optional[EarlyToolCalls] = None,
+    replay: Optional[TurnReplay] = None,
+) -> AsyncIterator[Tuple[Optional[int], Optional[dict], bool]]:
+    """
+    Execute one round of tool calls concurrently, yielding results as they finish.
+
+    Yields:
+        ``(index, tool message, failed)`` for each call in completion order, and
+        ``(None, None, False)`` every ``heartbeat`` seconds while calls are still running.
+        Closing the iterator early cancels the calls that are still running.
+    """
+    tasks = {future: i for i, future in enumerate(_start_all(tool_calls, registry, timeout, early, replay))}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                yield None, None, False
+            for task in sorted(done, key=tasks.get):
+                yield (tasks[task], *task.result())
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _sync_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="agent-sync-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def run_sync(coroutine: Coroutine[Any, Any, T]) -> T:
+    """
+    Run ``coroutine`` to completion from synchronous code.
+
+    The sync ``completion`` path shares the async agent core by running it on
+    one long-lived background event loop, which works whether or not the
+    calling thread already has a running loop.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _sync_loop()).result()
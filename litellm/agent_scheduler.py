@@ -0,0 +1,210 @@
+"""
+Admission control for upstream calls of MyCustomLLM.
+
+Each deployment gets a limit on in-flight upstream calls (a stream holds its
+slot until it is exhausted or closed). Calls over the limit wait in a
+priority queue, so conversations that are already running finish before new
+ones start:
+
+- ``PRIORITY_ANSWER``:    final-answer calls and streams
+- ``PRIORITY_FOLLOW_UP``: tool-decision calls after a tool round
+- ``PRIORITY_NEW``:       the first tool-decision call of a request
+
+A call that waits longer than its deadline fails with ``QueueTimeoutError``
+instead of piling more load on the deployment. Limits come from the
+deployment's ``max_concurrency`` (see ``agent_settings``) or
+``AGENT_MAX_CONCURRENCY`` (default 0 = unlimited), per event loop and
+process. With ``AGENT_SHARED_STATE`` (see ``agent_shared``) a call also
+takes one of the deployment's leased slots in the shared store, so the
+limit holds across all proxy workers; the priority order applies within
+each worker. The lease is renewed while the slot is held, so a stream that
+outlives ``AGENT_SHARED_LEASE`` keeps its slot.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+import weakref
+from typing import Dict, List, Optional
+
+from agent_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+if os.environ.get("AGENT_SHARED_STATE"):
+    # 共有ストア (agent_shared) は AGENT_SHARED_STATE を設定した場合だけ import する
+    from agent_shared import shared_store
+else:
+    shared_store = None
+
+PRIORITY_ANSWER = 0
+PRIORITY_FOLLOW_UP = 1
+PRIORITY_NEW = 2
+
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("AGENT_MAX_CONCURRENCY", "0"))
+
+metrics.describe("agent_queue_seconds", "Time upstream calls waited for a deployment slot")
+metrics.describe("agent_queue_rejected_total", "Upstream calls rejected after waiting past their deadline")
+
+
+class QueueTimeoutError(RuntimeError):
+    """Raised when a call waited for a deployment slot longer than its deadline."""
+
+
+_releases = set()
+
+
+class Slot:
+    """An acquired deployment slot; ``release`` is idempotent."""
+
+    __slots__ = ("_limiter", "_lease", "_renewal")
+
+    def __init__(self, limiter: Optional["_Limiter"], lease: Optional[tuple] = None):
+        self._limiter = limiter
+        self._lease = lease
+        self._renewal = None
+        if lease is not None:
+            from agent_shared import keep_lease
+
+            # 保持している間はリースを延長し、長いストリームでも他のワーカーに取られないようにする
+            self._renewal = asyncio.ensure_future(keep_lease(*lease))
+
+    def release(self) -> None:
+        limiter, self._limiter = self._limiter, None
+        if limiter is not None:
+            limiter.release()
+        renewal, self._renewal = self._renewal, None
+        if renewal is not None:
+            renewal.cancel()
+        lease, self._lease = self._lease, None
+        if lease is not None:
+            store, key, token, _ = lease
+            try:
+                # 共有スロットの解放は待たない (間に合わなくてもリースの期限で空く)
+                task = asyncio.ensure_future(store.delete(key, token))
+            except RuntimeError:
+                return
+            _releases.add(task)
+            task.add_done_callback(_releases.discard)
+
+
+class _Limiter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters: List[list] = []
+        self._sequence = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int, timeout: float) -> None:
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._sequence), future]
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(future, timeout if timeout > 0 else None)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # スロットを受け取った直後にキャンセルされた場合は次の待ちに回す
+                self.release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # 同じティックでキャンセル・タイムアウトした待ちにはスロットを渡さない
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+
+class Scheduler:
+    """Per-deployment limiters, created on first use."""
+
+    def __init__(self, default_limit: int = DEFAULT_MAX_CONCURRENCY, shared=None, lease: Optional[float] = None):
+        self.default_limit = default_limit
+        self.shared = shared
+        self.lease = lease
+        self._limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, _Limiter]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    async def acquire(self, name: str, limit: Optional[int], priority: int, timeout: float) -> Slot:
+        """
+        Wait for a slot of deployment ``name``.
+
+        Args:
+            name: Deployment name (see ``agent_router.deployment_name``).
+            limit: Max in-flight calls; ``None`` uses the default, 0 is unlimited.
+            priority: One of the ``PRIORITY_*`` constants (lower runs first).
+            timeout: Deadline for the wait in seconds (0 waits forever).
+
+        Raises:
+            QueueTimeoutError: The slot did not free up within ``timeout``.
+        """
+        limit = self.default_limit if limit is None else limit
+        if limit <= 0:
+            return Slot(None)
+        limiters = self._limiters.setdefault(asyncio.get_running_loop(), {})
+        limiter = limiters.get(name)
+        if limiter is None:
+            limiter = limiters[name] = _Limiter(limit)
+        limiter.limit = limit
+
+        start = time.perf_counter()
+        try:
+            await limiter.acquire(priority, timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("agent_queue_rejected_total", deployment=name)
+            logger.warning(f"Rejected call to {name}: no free slot within {timeout}s ({limiter.queued} queued)")
+            raise QueueTimeoutError(
+                f"{name} is overloaded: waited {timeout}s for one of {limit} slots, {limiter.queued} call(s) queued"
+            ) from None
+        lease = None
+        if self.shared is not None:
+            try:
+                lease = await self._acquire_shared(name, limit, timeout, start)
+            except BaseException:
+                limiter.release()
+                raise
+        metrics.observe("agent_queue_seconds", time.perf_counter() - start, deployment=name, priority=str(priority))
+        return Slot(limiter, lease)
+
+    async def _acquire_shared(self, name: str, limit: int, timeout: float, start: float) -> tuple:
+        from agent_shared import LEASE_SECONDS, acquire_slot
+
+        lease = LEASE_SECONDS if self.lease is None else self.lease
+        remaining = max(0.001, timeout - (time.perf_counter() - start)) if timeout > 0 else 0
+        held = await acquire_slot(self.shared, name, limit, remaining, lease)
+        if held is None:
+            metrics.inc("agent_queue_rejected_total", deployment=name)
+            logger.warning(f"Rejected call to {name}: no free slot across workers within {timeout}s")
+            raise QueueTimeoutError(
+                f"{name} is overloaded: waited {timeout}s for one of {limit} slots shared by all workers"
+            )
+        return (self.shared, *held, lease)
+
+    def samples(self) -> list:
+        """In-flight and queued calls per deployment, as ``/metrics`` gauges."""
+        samples = []
+        for limiters in list(self._limiters.values()):
+            for name, limiter in list(limiters.items()):
+                samples.append(("agent_upstream_in_flight", {"deployment": name}, limiter.in_flight))
+                samples.append(("agent_upstream_queued", {"deployment": name}, limiter.queued))
+        return samples
+
+
+scheduler = Scheduler(shared=shared_store)
+metrics.add_collector(scheduler.samples)
@@ -0,0 +1,270 @@
+"""
+Conversation sessions for MyCustomLLM.
+
+Open WebUI only sees the final answer of an agent turn, so a retry or a
+"regenerate" re-sends the same history and the agent runs the same tools
+again. With a conversation id in the request metadata (see ``session_id``),
+tool results are recorded per turn (the history up to the last user message)
+and replayed when the same turn asks for the same tool with the same
+arguments, instead of executing the tool again. A regenerated answer thus
+sees exactly the tool results of the first attempt, even after the
+tool-result cache (``agent_cache``, shared by all conversations and bounded
+by each tool's ``cache_ttl``) has let them go; a new user message starts a
+new turn and runs the tools afresh. Only cacheable tools are recorded (see
+``ToolRegistry.register``), so side-effecting tools always run, and failed
+tool calls are never recorded, so a retry runs them again.
+
+Sessions live in memory with LRU eviction of idle sessions. Set
+``AGENT_SESSION_STORE_PATH`` to also append every result to a SQLite log, so
+sessions survive proxy restarts (a session is read from the log when it is
+not in memory yet). With ``AGENT_SHARED_STATE`` (see ``agent_shared``) the
+results are also kept in the store shared by all proxy workers, so a retry
+that lands on another worker is replayed too.
+
+- ``AGENT_SESSION_MAX``: sessions kept in memory (default 1024)
+- ``AGENT_SESSION_MAX_RESULTS``: tool results kept per session (default 256)
+- ``AGENT_SESSION_REPLAY_TTL``: seconds a recorded result can be replayed
+  for its turn (default 3600)
+- ``AGENT_SESSION_IDLE_TTL``: seconds after which an idle session is
+  forgotten (default 86400)
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+from agent_cache import canonical_arguments
+from agent_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+if os.environ.get("AGENT_SHARED_STATE"):
+    # 共有ストア (agent_shared) は AGENT_SHARED_STATE を設定した場合だけ import する
+    from agent_shared import shared_store
+else:
+    shared_store = None
+
+metrics.describe("agent_session_replayed_total", "Tool calls answered from the session instead of running the tool")
+
+# リクエストのメタデータ (Open WebUI の chat_id など) と転送ヘッダーで会話を識別する
+_METADATA_KEYS = ("session_id", "conversation_id", "chat_id")
+_HEADER_KEYS = ("x-openwebui-chat-id", "x-session-id")
+
+
+def session_id(kwargs: dict) -> Optional[str]:
+    """The conversation id of a request, from the kwargs litellm passes to the handler."""
+    litellm_params = kwargs.get("litellm_params") or {}
+    metadata = litellm_params.get("metadata") or kwargs.get("metadata") or {}
+    for key in _METADATA_KEYS:
+        if metadata.get(key):
+            return str(metadata[key])
+    headers = {str(k).lower(): v for k, v in (metadata.get("headers") or {}).items()}
+    for key in _HEADER_KEYS:
+        if headers.get(key):
+            return str(headers[key])
+    value = litellm_params.get("litellm_session_id") or kwargs.get("litellm_session_id")
+    return str(value) if value else None
+
+
+def turn_key(messages: list) -> str:
+    """Hash of the history up to and including the last user message."""
+    last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=len(messages) - 1)
+    payload = json.dumps(messages[: last_user + 1], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+class SQLiteSessionLog:
+    """Append-only SQLite log of recorded tool results, opened on first use."""
+
+    def __init__(self, path: str, retention: float):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # 呼び出し側で self._lock を保持している
+        if self._db is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_tool_results ("
+                "session TEXT NOT NULL, key TEXT NOT NULL, content TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS session_tool_results_session ON session_tool_results (session)")
+            conn.execute("DELETE FROM session_tool_results WHERE created < ?", (time.time() - self.retention,))
+            self._db = conn
+        return self._db
+
+    def load(self, session: str) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT key, content, created FROM session_tool_results WHERE session = ? ORDER BY created", (session,)
+            ).fetchall()
+
+    def append(self, session: str, key: str, content: str, created: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO session_tool_results (session, key, content, created) VALUES (?, ?, ?, ?)",
+                (session, key, content, created),
+            )
+
+
+class _Session:
+    __slots__ = ("results", "last_used")
+
+    def __init__(self):
+        # キー -> (結果, 記録した時刻 time.time())
+        self.results: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.last_used = time.monotonic()
+
+
+class SessionStore:
+    """
+    Per-conversation tool results, kept in memory with LRU eviction.
+
+    Args:
+        log: Optional :class:`SQLiteSessionLog` that persists the results.
+        max_sessions: Sessions kept in memory.
+        max_results: Tool results kept per session.
+        idle_ttl: Seconds after which an idle session is dropped.
+        replay_ttl: Seconds a recorded result can be replayed for its turn.
+        shared: Optional store shared with the other workers (``agent_shared``).
+    """
+
+    def __init__(
+        self,
+        log: Optional[SQLiteSessionLog] = None,
+        max_sessions: int = 1024,
+        max_results: int = 256,
+        idle_ttl: float = 86400.0,
+        replay_ttl: float = 3600.0,
+        shared=None,
+    ):
+        self.log = log
+        self.shared = shared
+        self._pending = set()
+        self.max_sessions = max_sessions
+        self.max_results = max_results
+        self.idle_ttl = idle_ttl
+        self.replay_ttl = replay_ttl
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self.evictions = 0
+
+    async def open(self, session: str, turn: str) -> "TurnReplay":
+        """Load ``session`` (from the log when it is not in memory) and scope replay to ``turn``."""
+        state = self._sessions.get(session)
+        if state is not None and state.last_used + self.idle_ttl <= time.monotonic():
+            del self._sessions[session]
+            state = None
+        if state is None:
+            state = _Session()
+            if self.log is not None:
+                try:
+                    for key, content, created in await asyncio.to_thread(self.log.load, session):
+                        state.results[key] = (content, created)
+                    while len(state.results) > self.max_results:
+                        state.results.popitem(last=False)
+                except Exception as e:
+                    logger.warning(f"Could not load session {session}: {e}")
+            self._sessions[session] = state
+        state.last_used = time.monotonic()
+        self._sessions.move_to_end(session)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+        return TurnReplay(self, session, state, turn)
+
+    def _record(self, session: str, state: _Session, key: str, content: str) -> None:
+        created = time.time()
+        state.results[key] = (content, created)
+        state.results.move_to_end(key)
+        while len(state.results) > self.max_results:
+            state.results.popitem(last=False)
+        if self.log is not None:
+            # 追記はイベントループの外で行い、結果を待たない
+            asyncio.get_running_loop().run_in_executor(None, self._append, session, key, content, created)
+        if self.shared is not None:
+            value = json.dumps([created, content]).encode()
+            task = asyncio.ensure_future(self.shared.set(self._shared_key(session, key), value, self.replay_ttl))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    @staticmethod
+    def _shared_key(session: str, key: str) -> str:
+        return "session:" + hashlib.blake2b(f"{session}\0{key}".encode(), digest_size=16).hexdigest()
+
+    def _append(self, session: str, key: str, content: str, created: float) -> None:
+        try:
+            self.log.append(session, key, content, created)
+        except Exception as e:
+            logger.warning(f"Could not persist a tool result of session {session}: {e}")
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "evictions": self.evictions}
+
+
+class TurnReplay:
+    """Recorded tool results of one conversation turn, handed to ``agent_runtime``."""
+
+    __slots__ = ("_store", "_session", "_state", "_turn")
+
+    def __init__(self, store: SessionStore, session: str, state: _Session, turn: str):
+        self._store = store
+        self._session = session
+        self._state = state
+        self._turn = turn
+
+    def _key(self, name: str, arguments: Any) -> str:
+        return f"{self._turn}:{name}:{canonical_arguments(arguments)}"
+
+    async def get(self, name: str, arguments: Any) -> Optional[str]:
+        """The recorded result of ``name(**arguments)`` in this turn, if it is still within the replay TTL."""
+        key = self._key(name, arguments)
+        entry = self._state.results.get(key)
+        if entry is None and self._store.shared is not None:
+            # 同じ会話の前のリクエストは別のワーカーが処理したかもしれない
+            value = await self._store.shared.get(self._store._shared_key(self._session, key))
+            if value is not None:
+                try:
+                    created, content = json.loads(value)
+                    entry = self._state.results[key] = (content, float(created))
+                except (ValueError, TypeError):
+                    entry = None
+        if entry is None or entry[1] + self._store.replay_ttl <= time.time():
+            return None
+        metrics.inc("agent_session_replayed_total", tool=name)
+        logger.info(f"Replaying recorded result of {name} for session {self._session}")
+        return entry[0]
+
+    def record(self, name: str, arguments: Any, content: str) -> None:
+        """Record the result of ``name(**arguments)`` for replay in this turn."""
+        self._store._record(self._session, self._state, self._key(name, arguments), content)
+
+
+def _session_log() -> Optional[SQLiteSessionLog]:
+    path = os.environ.get("AGENT_SESSION_STORE_PATH")
+    if not path:
+        return None
+    return SQLiteSessionLog(path, retention=float(os.environ.get("AGENT_SESSION_REPLAY_TTL", "3600")))
+
+
+session_store = SessionStore(
+    _session_log(),
+    max_sessions=int(os.environ.get("AGENT_SESSION_MAX", "1024")),
+    max_results=int(os.environ.get("AGENT_SESSION_MAX_RESULTS", "256")),
+    idle_ttl=float(os.environ.get("AGENT_SESSION_IDLE_TTL", "86400")),
+    replay_ttl=float(os.environ.get("AGENT_SESSION_REPLAY_TTL", "3600")),
+    shared=shared_store,
+)
@@ -0,0 +1,97 @@
+"""
+Per-model settings for MyCustomLLM.
+
+Settings come from the ``model_info.agent_settings`` block of a deployment in
+``config.yaml``; anything not set there falls back to the defaults below.
+
+    model_list:
+      - model_name: "my-custom-qwen3-0.6b"
+        litellm_params:
+          model: my-custom-llm/ollama/qwen3:0.6b
+        model_info:
+          agent_settings:
+            max_iterations: 3
+"""
+import logging
+from dataclasses import dataclass, fields, replace
+from typing import Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class AgentSettings:
+    # ツール呼び出しラウンドの上限。超えた場合はツール無しで最終応答を生成する
+    max_iterations: int = 5
+    # 1つのツール実行にかける最大秒数
+    tool_timeout: float = 30.0
+    # ツール判定の呼び出し結果をキャッシュする (agent_cache.response_cache)
+    response_cache: bool = False
+    # 上流に送るメッセージのトークン上限。0の場合はモデル情報から自動で決める (不明なら無制限)
+    context_budget: int = 0
+    # これより長いツール結果は先頭と末尾だけを残して切り詰める (0で無効)
+    max_tool_result_chars: int = 16000
+    # ツール判定と並行してツール無しの応答を投機的にストリームする (off / on / auto, agent_speculation)
+    speculation: str = "off"
+    # auto の場合、直近のツール不要ラウンドの割合がこの値以上なら投機する
+    speculation_threshold: float = 0.7
+    # 引数のJSONが閉じたツールをストリームの終了を待たずに実行し始める
+    early_tool_start: bool = True
+    # ツール判定に使う軽量なモデル (例: "ollama/qwen3:0.6b")。空なら要求されたモデルで判定する
+    decision_model: Union[str, dict] = ""
+    # 要求されたモデルが失敗・遅延した場合の候補 (モデル名、またはapi_base等を含むacompletionの引数)
+    fallbacks: Tuple[Union[str, dict], ...] = ()
+    # 最初のチャンクが直近の遅延のこの分位点を超えたら次の候補にも送る (0で無効, 例: 0.95)
+    hedge_quantile: float = 0.0
+    # ヘッジするまでの最短の待ち時間 (秒)
+    hedge_min_delay: float = 0.25
+    # 要求されたモデルへの同時呼び出し数の上限 (None で AGENT_MAX_CONCURRENCY, 0 で無制限)
+    # decision_model / fallbacks の dict にも max_concurrency を指定できる
+    max_concurrency: Optional[int] = None
+    # 空きを待つ最大秒数。超えたら 429 (RateLimitError) で早めに断る
+    queue_timeout: float = 30.0
+    # ツールの選択・完了をステータス行としてストリームする (agent_stream.progress_text)
+    tool_progress: bool = False
+    # ツール実行中に経過時間を知らせる間隔 (秒)
+    tool_progress_interval: float = 5.0
+    # 非ストリーミングのツール判定で、同じ内容の判定が進行中ならその応答を共有する (agent_batch)
+    # 判定を待たせてまとめることはしない
+    share_decisions: bool = False
+    # プロンプトの接頭辞キャッシュを効かせるヒントを上流に渡す (agent_prompt)
+    prompt_cache_hints: bool = True
+    # Ollama のモデルをメモリに残す時間 (例: "30m", -1 で無期限, 空で Ollama の既定)
+    keep_alive: Union[str, int] = "30m"
+    # 会話IDのあるリクエストで、同じターンの実行済みツール結果を再利用する (再生成・リトライ時, agent_session)
+    # 対象は cacheable なツールだけで、ツールの cache_ttl とは別に AGENT_SESSION_REPLAY_TTL の間そのターンで再利用する
+    session_replay: bool = True
+    # 最初のラウンドの前に最後のユーザーメッセージを手元で振り分ける (off / shadow / on, agent_triage)
+    # shadow は振り分けを記録するだけで、ツール判定は常に呼ぶ
+    triage: str = "off"
+    # 正規表現のルール。先に一致したものを使う (例: {"pattern": "天気|weather", "tool": "get_current_weather"})
+    triage_rules: Tuple[dict, ...] = ()
+    # ツールの説明との類似度がこれ未満なら、ツール判定を省いてツール無しで回答する
+    triage_answer_below: float = 0.05
+    # 類似度がこれ以上で1つのツールに絞れるなら tool_choice でそのツールを指定する (0で無効)
+    triage_force_above: float = 0.0
+    # ストリームのテキストをこの文字数までまとめて1チャンクで送る (0で無効, agent_coalesce)
+    # 最初のトークンと、間隔の空いたチャンクはまとめずにすぐ送る
+    coalesce_chars: int = 0
+    # まとめるために前のチャンクから待つ最大秒数
+    coalesce_wait: float = 0.02
+
+
+DEFAULT_SETTINGS = AgentSettings()
+_FIELD_NAMES = {f.name for f in fields(AgentSettings)}
+
+
+def resolve_settings(kwargs: dict) -> AgentSettings:
+    """Build the settings for a request from the kwargs litellm passes to the handler."""
+    litellm_params = kwargs.get("litellm_params") or {}
+    model_info = litellm_params.get("model_info") or (litellm_params.get("metadata") or {}).get("model_info") or {}
+    overrides = model_info.get("agent_settings") or {}
+    if not overrides:
+        return DEFAULT_SETTINGS
+    unknown = set(overrides) - _FIELD_NAMES
+    if unknown:
+        logger.warning(f"Ignoring unknown agent_settings keys: {sorted(unknown)}")
+    return replace(DEFAULT_SETTINGS, **{k: v for k, v in overrides.items() if k in _FIELD_NAMES})
@@ -0,0 +1,477 @@
+"""
+State shared by all proxy workers of MyCustomLLM.
+
+With several proxy workers (``--num_workers``) every worker has its own
+caches, sessions and limiters, so hit rates and concurrency limits are split
+N ways. ``AGENT_SHARED_STATE`` selects a store that all workers share:
+
+- ``mmap:///dev/shm/agent-state``: a fixed-size hash table in a memory-mapped
+  file, locked with ``flock``; one host, no server. The table size is set
+  when the file is created: ``?slots=4096&value_size=32768`` (defaults 1024
+  slots of 32 KiB; larger values are not shared).
+- ``redis://host:6379/0``: Redis, through redis-py (installed with
+  ``litellm[proxy]``). Errors are logged and the agent carries on with
+  worker-local state, so an outage does not fail requests.
+
+Both offer keys with a TTL, set-if-absent, compare-and-delete and atomic
+counters. On top of these, ``single_flight`` lets one worker do a piece of
+work while the others wait for its result, and ``acquire_slot`` takes one of
+N leased slots. Leases expire after ``AGENT_SHARED_LEASE`` seconds (default
+60), so a worker that dies cannot hold a lock or slot forever; a live holder
+renews its lease (``keep_lease``) every third of that time, so calls and
+tools that run longer than the lease keep it.
+
+Used by ``agent_cache`` (tool results and decisions), ``agent_session``
+(recorded tool results) and ``agent_scheduler`` (``max_concurrency`` per
+deployment across workers).
+"""
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import uuid
+import weakref
+from typing import AsyncIterator, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from agent_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = float(os.environ.get("AGENT_SHARED_LEASE", "60"))
+# ロックやスロットの空きを待つ間隔 (指数的に伸ばす)
+_POLL_MIN = 0.005
+_POLL_MAX = 0.1
+
+metrics.describe("agent_shared_errors_total", "Shared-state operations that failed and fell back to worker-local state")
+
+
+def new_token() -> bytes:
+    """A value that identifies one lock or slot holder."""
+    return uuid.uuid4().hex.encode()
+
+
+class MmapStore:
+    """
+    Shared key-value store in a memory-mapped file, for the workers of one host.
+
+    Open addressing over fixed-size slots; keys are stored as 128-bit hashes.
+    When the probe window of a key is full, the cached entry (written by
+    ``set``) that expires first is evicted. Entries written by ``add`` and
+    ``incr`` (locks, slots and counters) are never evicted before they
+    expire; while a window holds only those, writes fail instead. Every
+    operation holds ``flock`` on the file (and a thread lock, since ``flock``
+    does not exclude threads sharing the descriptor) for a few microseconds,
+    so the async methods run inline.
+
+    Args:
+        path: File to map, created if missing (``/dev/shm`` keeps it in memory).
+        slots: Number of entries, used only when the file is created.
+        value_size: Largest value in bytes, used only when the file is created.
+    """
+
+    _MAGIC = b"AGSTATE1"
+    _HEADER = struct.Struct("<8sII")
+    _HEADER_SIZE = 64
+    # state, 追い出し不可 (add / incr で書いた値), 値の長さ, 有効期限 (エポック秒), キーのハッシュ
+    _SLOT = struct.Struct("<BBxxId16s")
+    _EMPTY, _USED, _DELETED = 0, 1, 2
+    _MAX_PROBE = 32
+
+    def __init__(self, path: str, slots: int = 1024, value_size: int = 32768):
+        self.path = path
+        self.slots = slots
+        self.value_size = value_size
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._map: Optional[mmap.mmap] = None
+
+    def _open(self) -> None:
+        # 呼び出し側で self._lock を保持している
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(fd, self._HEADER.size, 0)
+            if len(header) == self._HEADER.size and header.startswith(self._MAGIC):
+                # 既存のファイルは作成時の大きさで使う
+                _, self.slots, self.value_size = self._HEADER.unpack(header)
+            else:
+                os.ftruncate(fd, self._HEADER_SIZE + self.slots * (self._SLOT.size + self.value_size))
+                os.pwrite(fd, self._HEADER.pack(self._MAGIC, self.slots, self.value_size), 0)
+            self._stride = self._SLOT.size + self.value_size
+            self._map = mmap.mmap(fd, self._HEADER_SIZE + self.slots * self._stride)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        logger.info(f"Shared state in {self.path}: {self.slots} slots of {self.value_size} bytes")
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._map is None:
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _find(
+        self, buf: mmap.mmap, digest: bytes, now: float, for_write: bool, evict: bool = False
+    ) -> Tuple[Optional[int], bool]:
+        """
+        (offset, live) of ``digest``, or of the slot to write it to when ``for_write``.
+
+        A live entry of another key is only overwritten with ``evict``, and
+        never when it was written by ``add`` / ``incr``; the offset is None
+        when no slot can be written.
+        """
+        start = int.from_bytes(digest[:8], "little") % self.slots
+        free = None
+        oldest = None
+        for i in range(min(self._MAX_PROBE, self.slots)):
+            offset = self._HEADER_SIZE + (start + i) % self.slots * self._stride
+            state, pinned, _, expires, slot_digest = self._SLOT.unpack_from(buf, offset)
+            if state == self._USED and slot_digest == digest:
+                return offset, expires > now
+            if state != self._USED or expires <= now:
+                if free is None:
+                    free = offset
+                if state == self._EMPTY:
+                    break
+            elif not pinned and (oldest is None or expires < oldest[0]):
+                oldest = (expires, offset)
+        if not for_write or free is not None:
+            return free, False
+        # 探索範囲が埋まっている: 他のワーカーのロックやスロットは上書きしない
+        return (oldest[1] if evict and oldest is not None else None), False
+
+    def _full(self, operation: str, key: str) -> None:
+        metrics.inc("agent_shared_errors_total", operation=operation)
+        logger.debug(f"Shared state {operation} of {key} skipped: no free slot near it in {self.path}")
+
+    def _value(self, buf: mmap.mmap, offset: int) -> bytes:
+        length = self._SLOT.unpack_from(buf, offset)[2]
+        start = offset + self._SLOT.size
+        return bytes(buf[start:start + length])
+
+    def _write(
+        self, buf: mmap.mmap, offset: int, digest: bytes, value: bytes, expires: float, pinned: bool = False
+    ) -> None:
+        start = offset + self._SLOT.size
+        buf[start:start + len(value)] = value
+        self._SLOT.pack_into(buf, offset, self._USED, pinned, len(value), expires, digest)
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    @staticmethod
+    def _expires(now: float, ttl: Optional[float]) -> float:
+        return now + ttl if ttl else math.inf
+
+    async def get(self, key: str) -> Optional[bytes]:
+        digest = self._digest(key)
+        with self._locked() as buf:
+            offset, live = self._find(buf, digest, time.time(), False)
+            return self._value(buf, offset) if live else None
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        """Store ``value``; returns False when it is larger than ``value_size`` or there is no room for it."""
+        digest = self._digest(key)
+        now = time.time()
+        with self._locked() as buf:
+            if len(value) > self.value_size:
+                return False
+            offset, _ = self._find(buf, digest, now, True, evict=True)
+            if offset is None:
+                self._full("set", key)
+                return False
+            self._write(buf, offset, digest, value, self._expires(now, ttl))
+        return True
+
+    async def add(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        """Store ``value`` only if ``key`` is absent and there is room for it; returns whether it was stored."""
+        digest = self._digest(key)
+        now = time.time()
+        with self._locked() as buf:
+            if len(value) > self.value_size:
+                return False
+            offset, live = self._find(buf, digest, now, True, evict=True)
+            if live:
+                return False
+            if offset is None:
+                self._full("add", key)
+                return False
+            self._write(buf, offset, digest, value, self._expires(now, ttl), pinned=True)
+        return True
+
+    async def delete(self, key: str, value: Optional[bytes] = None) -> bool:
+        """Delete ``key`` (only while it holds ``value``, if given); returns whether it was deleted."""
+        digest = self._digest(key)
+        with self._locked() as buf:
+            offset, live = self._find(buf, digest, time.time(), False)
+            if not live or (value is not None and self._value(buf, offset) != value):
+                return False
+            buf[offset] = self._DELETED
+        return True
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Add ``amount`` to the counter at ``key`` (created at 0 with ``ttl``) and return the new value."""
+        digest = self._digest(key)
+        now = time.time()
+        with self._locked() as buf:
+            offset, live = self._find(buf, digest, now, True, evict=True)
+            if offset is None:
+                # 保存できない場合は RedisStore の障害時と同じく amount を返す
+                self._full("incr", key)
+                return amount
+            if live:
+                value = int(self._value(buf, offset) or b"0") + amount
+                expires = self._SLOT.unpack_from(buf, offset)[3]
+            else:
+                value = amount
+                expires = self._expires(now, ttl)
+            self._write(buf, offset, digest, str(value).encode(), expires, pinned=True)
+        return value
+
+    async def expire(self, key: str, ttl: float, value: Optional[bytes] = None) -> bool:
+        """Reset the TTL of ``key`` (only while it holds ``value``, if given); returns False when it is absent."""
+        digest = self._digest(key)
+        now = time.time()
+        with self._locked() as buf:
+            offset, live = self._find(buf, digest, now, False)
+            if not live or (value is not None and self._value(buf, offset) != value):
+                return False
+            state, pinned, length, _, slot_digest = self._SLOT.unpack_from(buf, offset)
+            self._SLOT.pack_into(buf, offset, state, pinned, length, now + ttl, slot_digest)
+        return True
+
+    def __len__(self) -> int:
+        now = time.time()
+        count = 0
+        with self._locked() as buf:
+            for index in range(self.slots):
+                state, _, _, expires, _ = self._SLOT.unpack_from(buf, self._HEADER_SIZE + index * self._stride)
+                count += state == self._USED and expires > now
+        return count
+
+    async def aclose(self) -> None:
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+                self._map = None
+
+
+class RedisStore:
+    """
+    Shared key-value store on Redis, for workers on any number of hosts.
+
+    Clients are bound to the event loop they were created on, like the
+    clients of ``agent_clients``. Failed operations are counted in
+    ``agent_shared_errors_total`` and answer as if the store were empty
+    (locks and slots are granted), so the agent degrades to worker-local state.
+
+    Args:
+        url: ``redis://`` or ``rediss://`` URL.
+        prefix: Prepended to every key.
+    """
+
+    def __init__(self, url: str, prefix: str = "agent:"):
+        self.url = url
+        self.prefix = prefix
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, object]" = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            # redis-py は litellm[proxy] と一緒に入る。使う場合だけ import する
+            import redis.asyncio
+
+            client = self._clients[loop] = redis.asyncio.Redis.from_url(
+                self.url, socket_timeout=5.0, socket_connect_timeout=2.0
+            )
+        return client
+
+    async def _run(self, operation: str, default, function):
+        try:
+            return await function(self._client())
+        except Exception as e:
+            metrics.inc("agent_shared_errors_total", operation=operation)
+            logger.warning(f"Shared state {operation} failed, using worker-local state: {e}")
+            return default
+
+    @staticmethod
+    def _ms(ttl: Optional[float]) -> Optional[int]:
+        return max(1, int(ttl * 1000)) if ttl else None
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._run("get", None, lambda r: r.get(self.prefix + key))
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        return bool(await self._run("set", False, lambda r: r.set(self.prefix + key, value, px=self._ms(ttl))))
+
+    async def add(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        return bool(await self._run("add", True, lambda r: r.set(self.prefix + key, value, px=self._ms(ttl), nx=True)))
+
+    async def delete(self, key: str, value: Optional[bytes] = None) -> bool:
+        if value is None:
+            return bool(await self._run("delete", 0, lambda r: r.delete(self.prefix + key)))
+
+        async def compare_and_delete(r) -> bool:
+            from redis.exceptions import WatchError
+
+            async with r.pipeline(transaction=True) as pipe:
+                await pipe.watch(self.prefix + key)
+                if await pipe.get(self.prefix + key) != value:
+                    await pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.delete(self.prefix + key)
+                try:
+                    await pipe.execute()
+                except WatchError:
+                    return False
+            return True
+
+        return await self._run("delete", False, compare_and_delete)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        async def increment(r) -> int:
+            pipe = r.pipeline(transaction=True)
+            if ttl:
+                # 新しく作るカウンタだけに有効期限を付ける
+                pipe.set(self.prefix + key, 0, px=self._ms(ttl), nx=True)
+            pipe.incrby(self.prefix + key, amount)
+            return int((await pipe.execute())[-1])
+
+        return await self._run("incr", amount, increment)
+
+    async def expire(self, key: str, ttl: float, value: Optional[bytes] = None) -> bool:
+        if value is None:
+            return bool(await self._run("expire", False, lambda r: r.pexpire(self.prefix + key, self._ms(ttl))))
+
+        async def compare_and_expire(r) -> bool:
+            from redis.exceptions import WatchError
+
+            async with r.pipeline(transaction=True) as pipe:
+                await pipe.watch(self.prefix + key)
+                if await pipe.get(self.prefix + key) != value:
+                    await pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.pexpire(self.prefix + key, self._ms(ttl))
+                try:
+                    await pipe.execute()
+                except WatchError:
+                    return False
+            return True
+
+        return await self._run("expire", False, compare_and_expire)
+
+    def __len__(self) -> int:
+        # 件数は往復が必要なため数えない
+        return 0
+
+    async def aclose(self) -> None:
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+@contextlib.asynccontextmanager
+async def single_flight(store, key: str, lease: float = LEASE_SECONDS, wait: float = LEASE_SECONDS) -> AsyncIterator[bool]:
+    """
+    Let one caller across all workers do the work guarded by ``key``.
+
+    Yields True to the caller that took the lock (released on exit), and False
+    to the others once the holder released it or ``wait`` seconds passed; they
+    should look for the holder's result and otherwise do the work themselves.
+    """
+    token = new_token()
+    if await store.add(key, token, lease):
+        renewal = asyncio.ensure_future(keep_lease(store, key, token, lease))
+        try:
+            yield True
+        finally:
+            renewal.cancel()
+            # キャンセルされても解放は最後まで行う
+            await asyncio.shield(store.delete(key, token))
+        return
+    deadline = time.monotonic() + wait
+    delay = _POLL_MIN
+    while time.monotonic() < deadline and await store.get(key) is not None:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, _POLL_MAX)
+    yield False
+
+
+async def acquire_slot(store, name: str, limit: int, timeout: float, lease: float = LEASE_SECONDS) -> Optional[Tuple[str, bytes]]:
+    """
+    Take one of ``limit`` leased slots named ``name``, waiting up to ``timeout`` seconds (0 waits forever).
+
+    Returns the ``(key, token)`` to pass to ``store.delete`` on release, or None on timeout.
+    """
+    token = new_token()
+    deadline = time.monotonic() + timeout
+    delay = _POLL_MIN
+    while True:
+        # 空いているスロットを探す位置をずらして、ワーカー間の衝突を減らす
+        start = random.randrange(limit)
+        for i in range(limit):
+            key = f"slot:{name}:{(start + i) % limit}"
+            if await store.add(key, token, lease):
+                return key, token
+        if timeout > 0 and time.monotonic() + delay > deadline:
+            return None
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, _POLL_MAX)
+
+
+async def keep_lease(store, key: str, token: bytes, lease: float = LEASE_SECONDS) -> None:
+    """
+    Renew the lease on ``key`` every ``lease / 3`` seconds while it still holds ``token``.
+
+    Run as a task for as long as the lock or slot is held and cancel it on
+    release. Returns when the lease was lost (expired and possibly taken by
+    another holder); the holder carries on, as it would have without renewal.
+    """
+    while True:
+        await asyncio.sleep(lease / 3)
+        if not await store.expire(key, lease, token):
+            logger.warning(f"Lost the shared lease on {key}; another worker may take it")
+            return
+
+
+def store_from_url(url: str):
+    """``MmapStore`` for ``mmap://<path>``, ``RedisStore`` for ``redis://`` / ``rediss://`` URLs."""
+    parsed = urlparse(url)
+    if parsed.scheme == "mmap":
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        return MmapStore(
+            parsed.netloc + parsed.path,
+            slots=int(query.get("slots", 1024)),
+            value_size=int(query.get("value_size", 32768)),
+        )
+    if parsed.scheme in ("redis", "rediss", "unix"):
+        return RedisStore(url)
+    raise ValueError(f"Unsupported AGENT_SHARED_STATE: {url}")
+
+
+def _store_from_env():
+    url = os.environ.get("AGENT_SHARED_STATE")
+    return store_from_url(url) if url else None
+
+
+# AGENT_SHARED_STATE が未設定なら None (各ワーカーが自分の状態だけを使う)
+shared_store = _store_from_env()
@@ -0,0 +1,126 @@
+"""
+Speculative final-answer streaming for MyCustomLLM.
+
+In a decision round ``astreaming`` normally streams one completion with tools
+and forwards its text. With speculation enabled, a tool-less ``stream=True``
+completion is started at the same time and buffered. As soon as the decision
+stream shows that the model is answering in text, the decision stream is
+closed and the buffered answer is released; if it asks for a tool instead,
+the speculative stream is cancelled and its tokens are counted as waste.
+
+Per-model policy (``agent_settings.speculation``):
+
+- ``off``:  never speculate (default)
+- ``on``:   speculate in every decision round
+- ``auto``: speculate while the recent share of rounds answered without tools
+  is at least ``speculation_threshold``
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, List, Optional
+
+from agent_metrics import metrics
+from agent_stream import unpack_chunk, usage_dict
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class SpeculativeStream:
+    """
+    Start a streamed completion in the background and buffer its chunks.
+
+    Iterating yields the buffered chunks first and then the live ones, so the
+    stream can be handed to the regular chunk loop once it is released.
+    """
+
+    def __init__(self, completion: Awaitable[Any]):
+        self._chunks: List[Any] = []
+        self._queue: "asyncio.Queue[Any]" = asyncio.Queue()
+        self._task = asyncio.create_task(self._pump(completion))
+
+    async def _pump(self, completion: Awaitable[Any]) -> None:
+        try:
+            stream = await completion
+            async for chunk in stream:
+                self._chunks.append(chunk)
+                self._queue.put_nowait(chunk)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._queue.put_nowait(e)
+        self._queue.put_nowait(_DONE)
+
+    async def __aiter__(self):
+        while True:
+            item = await self._queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def cancel(self) -> int:
+        """
+        Cancel the stream.
+
+        Returns:
+            Completion tokens spent on it: the reported usage when the stream
+            already finished, otherwise the number of content chunks received.
+        """
+        self._task.cancel()
+        wasted = 0
+        for chunk in self._chunks:
+            _, content, _, _, usage = unpack_chunk(chunk)
+            if usage:
+                return usage_dict(usage).get("completion_tokens") or wasted
+            if content:
+                wasted += 1
+        return wasted
+
+
+class SpeculationPolicy:
+    """
+    Decides per model whether to speculate and records the outcomes.
+
+    Args:
+        alpha: Weight of the newest round in the moving no-tool share.
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self._answer_share: Dict[str, float] = {}
+
+    def should_speculate(self, model: str, mode: str, threshold: float) -> bool:
+        if mode == "on":
+            return True
+        if mode == "auto":
+            # 実績が無いうちは投機して様子を見る
+            return self._answer_share.get(model, 1.0) >= threshold
+        return False
+
+    def observe(self, model: str, needed_tools: bool) -> None:
+        """Record the outcome of a decision round, speculated or not."""
+        share = self._answer_share.get(model, 1.0)
+        self._answer_share[model] = share + self.alpha * ((0.0 if needed_tools else 1.0) - share)
+
+    def record(self, model: str, won: bool, wasted_tokens: int = 0) -> None:
+        metrics.inc("agent_speculation_total", model=model, outcome="win" if won else "waste")
+        if wasted_tokens:
+            metrics.inc("agent_speculation_wasted_tokens_total", wasted_tokens, model=model)
+
+    def stats(self, model: Optional[str] = None) -> dict:
+        models = [model] if model else sorted(self._answer_share)
+        return {
+            m: {
+                "wins": metrics.counter("agent_speculation_total", model=m, outcome="win"),
+                "wasted": metrics.counter("agent_speculation_total", model=m, outcome="waste"),
+                "wasted_tokens": metrics.counter("agent_speculation_wasted_tokens_total", model=m),
+                "answer_share": round(self._answer_share.get(m, 1.0), 3),
+            }
+            for m in models
+        }
+
+
+speculation = SpeculationPolicy()
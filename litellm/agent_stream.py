@@ -0,0 +1,482 @@
+"""
+Streaming helpers for MyCustomLLM.
+
+ToolCallAssembler consumes a single ``stream=True`` response and separates
+plain text (forwarded to the client immediately) from tool-call fragments
+(merged by index until the stream ends).
+
+``unpack_chunk`` / ``text_chunk`` / ``finish_chunk`` are the shared adapter
+between litellm streaming chunks and ``GenericStreamingChunk`` dicts. They
+are on the per-chunk hot path: attribute access goes straight to the
+expected fields, non-final chunks share one immutable zero usage, and usage
+is only converted to a dict for the final chunk.
+"""
+import json
+import logging
+import re
+import uuid
+from types import MappingProxyType
+from typing import Any, Iterable, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ZERO_USAGE: Mapping[str, int] = MappingProxyType({"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0})
+
+_JSON_STRUCTURE = re.compile(r'[{}\[\]"\\]')
+
+_TAG_OPEN = "<tool_call>"
+_TAG_CLOSE = "</tool_call>"
+# contentのJSONで返されるツール呼び出しの最初のキー
+_TOOL_CALL_KEYS = ("name", "function", "arguments", "parameters", "type", "id")
+_DECODER = json.JSONDecoder()
+
+
+def _get(obj: Any, name: str) -> Any:
+    """Attribute access that also works for plain dict deltas."""
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def _partial_suffix(text: str, tag: str) -> int:
+    """Length of the longest suffix of ``text`` that is a prefix of ``tag``."""
+    for size in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-size:]):
+            return size
+    return 0
+
+
+def _could_be_tool_call(text: str) -> bool:
+    """Whether ``text`` (starting with ``{`` or ``[``) can still turn out to be a tool call object."""
+    if text[0] == "[":
+        text = text[1:].lstrip()
+        if not text:
+            return True
+        if text[0] != "{":
+            return False
+    text = text[1:].lstrip()
+    if not text:
+        return True
+    if text[0] != '"':
+        return False
+    key = text[1:]
+    end = key.find('"')
+    if end < 0:
+        return any(name.startswith(key) for name in _TOOL_CALL_KEYS)
+    return key[:end] in _TOOL_CALL_KEYS
+
+
+def unpack_chunk(chunk: Any) -> Tuple[Optional[int], Optional[str], Any, Optional[str], Any]:
+    """
+    Extract the fields the agent needs from a litellm streaming chunk.
+
+    Returns:
+        ``(index, content, tool_calls, finish_reason, usage)``. ``index`` is
+        ``None`` for chunks without choices (e.g. a trailing usage-only chunk).
+        ``usage`` is only read from final chunks and returned as-is; convert
+        it with :func:`usage_dict` once.
+    """
+    try:
+        choice = chunk.choices[0]
+        delta = choice.delta
+        finish_reason = choice.finish_reason
+        # usageは最終チャンク (finish_reasonあり、またはchoices無し) にだけ載る
+        usage = getattr(chunk, "usage", None) if finish_reason else None
+        return choice.index or 0, delta.content, delta.tool_calls, finish_reason, usage
+    except (AttributeError, IndexError, KeyError, TypeError):
+        pass
+    # 辞書形式や属性が欠けたチャンク向けの遅い経路
+    usage = _get(chunk, "usage")
+    choices = _get(chunk, "choices")
+    if not choices:
+        return None, None, None, None, usage
+    choice = choices[0]
+    delta = _get(choice, "delta")
+    return (
+        _get(choice, "index") or 0,
+        _get(delta, "content"),
+        _get(delta, "tool_calls"),
+        _get(choice, "finish_reason"),
+        usage,
+    )
+
+
+def usage_dict(usage: Any) -> Mapping[str, int]:
+    """Materialize a usage object for the final chunk."""
+    if not usage:
+        return ZERO_USAGE
+    if hasattr(usage, "model_dump"):
+        return usage.model_dump()
+    if isinstance(usage, Mapping):
+        return usage
+    if hasattr(usage, "dict"):
+        return usage.dict()
+    return ZERO_USAGE
+
+
+def text_chunk(text: str, index: int = 0) -> dict:
+    """A non-final ``GenericStreamingChunk`` carrying ``text``."""
+    return {
+        "finish_reason": None,
+        "index": index,
+        "is_finished": False,
+        "text": text,
+        "tool_use": None,
+        "usage": ZERO_USAGE,
+    }
+
+
+def finish_chunk(text: str, index: int, finish_reason: Optional[str], usage: Any) -> dict:
+    """The final ``GenericStreamingChunk`` of a response, with usage materialized."""
+    return {
+        "finish_reason": finish_reason or "stop",
+        "index": index,
+        "is_finished": True,
+        "text": text,
+        "tool_use": None,
+        "usage": usage_dict(usage),
+    }
+
+
+class JsonCloseScanner:
+    """
+    Incrementally detects when a streamed JSON object or array has closed.
+
+    Only structural characters are visited, so feeding a fragment costs one
+    regex scan rather than a full parse.
+    """
+
+    __slots__ = ("depth", "in_string", "escape", "closed")
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.closed = False
+
+    def feed(self, text: str) -> bool:
+        """Feed the next fragment; returns ``True`` once the top-level value has closed."""
+        if self.closed:
+            return True
+        position = 0
+        if self.escape and text:
+            # 直前のフラグメントがバックスラッシュで終わっていた
+            self.escape = False
+            position = 1
+        while True:
+            match = _JSON_STRUCTURE.search(text, position)
+            if match is None:
+                return False
+            char = match.group()
+            position = match.end()
+            if self.in_string:
+                if char == "\\":
+                    # エスケープされた次の1文字を読み飛ばす
+                    if position >= len(text):
+                        self.escape = True
+                        return False
+                    position += 1
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    self.closed = True
+                    return True
+
+
+async def close_stream(stream: Any) -> None:
+    """Best-effort close of an upstream stream that is abandoned mid-way."""
+    aclose = getattr(stream, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception as e:
+        logger.debug(f"Closing abandoned stream failed: {e}")
+
+
+def progress_text(state: str, name: str = "", elapsed: float = 0.0) -> str:
+    """
+    A status line streamed while tools run.
+
+    Lines start with ``> 🔧``, ``> ⏳``, ``> ✅`` or ``> ❌`` so a
+    Function/Pipeline on the client side can detect them (see NOTE.md).
+    """
+    if state == "calling":
+        return f"> 🔧 calling `{name}`...\n"
+    if state == "running":
+        return f"> ⏳ still running ({elapsed:.0f}s)\n"
+    if state == "failed":
+        return f"> ❌ `{name}` failed ({elapsed:.1f}s)\n"
+    return f"> ✅ `{name}` done ({elapsed:.1f}s)\n"
+
+
+class ToolCallAssembler:
+    """
+    Assemble tool calls from a streamed chat completion.
+
+    Native ``delta.tool_calls`` fragments are merged by index. Tool calls that
+    some backends emit inside ``delta.content`` (a leading JSON object for
+    ``ollama/`` models, or ``<tool_call>...</tool_call>`` tags) are held back
+    from the text stream and parsed when complete.
+
+    Args:
+        tools: The tools schema sent with the request, used to validate names
+            found in content and to infer ``function.name`` when the stream
+            never delivers it (see NOTE.md).
+    """
+
+    def __init__(self, tools: Optional[List[dict]] = None):
+        self._tools = tools or []
+        self._tool_names = {t["function"]["name"] for t in self._tools}
+        self._slots: List[dict] = []
+        self._scanners: List[JsonCloseScanner] = []
+        self._dispatched = set()
+        self._text_calls: List[dict] = []
+        self._pending = ""
+        self._mode = "start"  # start / text / json / tag
+        self._json = JsonCloseScanner()
+
+    @property
+    def has_tool_calls(self) -> bool:
+        return bool(self._slots or self._text_calls)
+
+    def named_calls(self) -> List[Tuple[int, str]]:
+        """``(index, name)`` of the native tool calls whose name has arrived so far."""
+        return [(i, slot["function"]["name"]) for i, slot in enumerate(self._slots) if slot["function"]["name"]]
+
+    def add(self, tool_call_deltas: Iterable[Any]) -> None:
+        """Merge ``delta.tool_calls`` fragments into the per-index slots."""
+        for fragment in tool_call_deltas:
+            index = self._slot_index(fragment)
+            slot = self._slots[index]
+
+            call_id = _get(fragment, "id")
+            if call_id and not slot["id"]:
+                slot["id"] = call_id
+
+            function = _get(fragment, "function")
+            name = _get(function, "name")
+            if name:
+                current = slot["function"]["name"]
+                # 名前を毎チャンク全文で送るプロバイダと分割して送るプロバイダの両方に対応
+                if not current or name.startswith(current):
+                    slot["function"]["name"] = name
+                elif not current.endswith(name):
+                    slot["function"]["name"] = current + name
+
+            arguments = _get(function, "arguments")
+            if isinstance(arguments, dict):
+                slot["function"]["arguments"] = json.dumps(arguments)
+                self._scanners[index].closed = True
+            elif arguments:
+                slot["function"]["arguments"] += arguments
+                self._scanners[index].feed(arguments)
+
+    def ready_calls(self) -> List[dict]:
+        """
+        Native tool calls whose arguments object has closed since the last call.
+
+        Lets the caller start a tool while the model is still generating the
+        following tool calls. The returned dicts are snapshots; ``tool_calls()``
+        still reports every call once the stream has ended.
+        """
+        ready = []
+        for index, (slot, scanner) in enumerate(zip(self._slots, self._scanners)):
+            if not scanner.closed or index in self._dispatched:
+                continue
+            self._dispatched.add(index)
+            self._finalize(index, slot)
+            ready.append({"id": slot["id"], "type": "function", "function": dict(slot["function"])})
+        return ready
+
+    def _slot_index(self, fragment: Any) -> int:
+        index = _get(fragment, "index")
+        if index is None:
+            # indexが無い場合: 新しいidが来たら新しいスロット、それ以外は直前のスロットへ
+            call_id = _get(fragment, "id")
+            last = self._slots[-1] if self._slots else None
+            if last is not None and (not call_id or last["id"] in (None, call_id)):
+                return len(self._slots) - 1
+            index = len(self._slots)
+        while len(self._slots) <= index:
+            self._slots.append({
+                "id": None,
+                "type": "function",
+                "function": {"name": "", "arguments": ""},
+            })
+            self._scanners.append(JsonCloseScanner())
+        return index
+
+    def feed_text(self, text: Optional[str]) -> str:
+        """
+        Feed a ``delta.content`` fragment.
+
+        Returns:
+            The part of the text that is safe to forward to the client now.
+        """
+        if not text:
+            return ""
+        if self._mode == "text" and not self._pending and "<" not in text:
+            # 通常のテキストはそのまま返す (ホットパス)
+            return text
+        if self._mode == "json":
+            self._json.feed(text)
+        self._pending += text
+        out = []
+        while self._pending:
+            if self._mode == "json":
+                if not self._end_json():
+                    break
+                continue
+            if self._mode == "tag":
+                end = self._pending.find(_TAG_CLOSE)
+                if end < 0:
+                    break
+                body = self._pending[:end]
+                self._pending = self._pending[end + len(_TAG_CLOSE):]
+                self._mode = "text"
+                if not self._parse_text_tool_calls(body):
+                    out.append(_TAG_OPEN + body + _TAG_CLOSE)
+                continue
+            if self._mode == "start":
+                stripped = self._pending.lstrip()
+                if not stripped:
+                    break
+                if stripped[0] in "{[" and self._tool_names:
+                    # ollama/ はツール呼び出しをcontentのJSONとして返す
+                    self._mode = "json"
+                    self._json = JsonCloseScanner()
+                    self._json.feed(stripped)
+                    continue
+                self._mode = "text"
+            start = self._pending.find(_TAG_OPEN)
+            if start >= 0:
+                out.append(self._pending[:start])
+                self._pending = self._pending[start + len(_TAG_OPEN):]
+                self._mode = "tag"
+                continue
+            keep = _partial_suffix(self._pending, _TAG_OPEN)
+            cut = len(self._pending) - keep
+            out.append(self._pending[:cut])
+            self._pending = self._pending[cut:]
+            break
+        return "".join(out)
+
+    def _end_json(self) -> bool:
+        """
+        Decide on held JSON once it can no longer be, or has closed as, a tool call.
+
+        Returns:
+            ``False`` while the JSON must still be held back.
+        """
+        stripped = self._pending.lstrip()
+        if not _could_be_tool_call(stripped):
+            # Markdownのリンクや通常のJSONの回答はテキストとして流す
+            self._mode = "text"
+            return True
+        if not self._json.closed:
+            return False
+        try:
+            _, end = _DECODER.raw_decode(stripped)
+        except ValueError:
+            end = 0
+        if end and self._parse_text_tool_calls(stripped[:end]):
+            # 続けて次のツール呼び出しが来る場合に備える
+            self._pending = stripped[end:]
+            self._mode = "start"
+        else:
+            self._mode = "text"
+        return True
+
+    def flush_text(self) -> str:
+        """
+        Call once the stream has ended.
+
+        Returns:
+            Any held-back text that turned out not to be a tool call.
+        """
+        pending, self._pending = self._pending, ""
+        mode, self._mode = self._mode, "text"
+        if mode == "json" and self._parse_text_tool_calls(pending):
+            return ""
+        if mode == "tag":
+            if self._parse_text_tool_calls(pending):
+                return ""
+            return _TAG_OPEN + pending
+        return pending
+
+    def _parse_text_tool_calls(self, body: str) -> bool:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return False
+        items = data if isinstance(data, list) else [data]
+        calls = []
+        for item in items:
+            if not isinstance(item, dict):
+                return False
+            function = item.get("function") if isinstance(item.get("function"), dict) else item
+            name = function.get("name")
+            arguments = function.get("arguments", function.get("parameters", {}))
+            # モデルが name にリストや辞書を書くことがある: ハッシュできず集合の検索で例外になるのでテキスト扱いにする
+            if not isinstance(name, str) or name not in self._tool_names:
+                return False
+            if not isinstance(arguments, str):
+                arguments = json.dumps(arguments)
+            calls.append({
+                "id": f"call_{uuid.uuid4().hex[:24]}",
+                "type": "function",
+                "function": {"name": name, "arguments": arguments},
+            })
+        if not calls:
+            return False
+        self._text_calls.extend(calls)
+        return True
+
+    def tool_calls(self) -> List[dict]:
+        """Return the completed tool calls in OpenAI message format."""
+        calls = []
+        for index, slot in enumerate(self._slots):
+            function = slot["function"]
+            if not function["name"] and not function["arguments"]:
+                continue
+            self._finalize(index, slot)
+            calls.append(slot)
+        return calls + self._text_calls
+
+    def _finalize(self, index: int, slot: dict) -> None:
+        function = slot["function"]
+        if not function["arguments"]:
+            function["arguments"] = "{}"
+        if not function["name"]:
+            function["name"] = self._infer_name(function["arguments"])
+            logger.warning(f"Tool call {index} arrived without function.name, inferred '{function['name']}'")
+        if not slot["id"]:
+            slot["id"] = f"call_{uuid.uuid4().hex[:24]}"
+
+    def _infer_name(self, arguments: str) -> str:
+        """Pick the only tool whose parameters match the argument keys."""
+        try:
+            keys = set(json.loads(arguments))
+        except (ValueError, TypeError):
+            keys = set()
+        candidates = []
+        for tool in self._tools:
+            parameters = tool["function"].get("parameters", {})
+            properties = set(parameters.get("properties", {}))
+            required = set(parameters.get("required", []))
+            if required <= keys <= properties:
+                candidates.append(tool["function"]["name"])
+        if len(candidates) == 1:
+            return candidates[0]
+        if len(self._tools) == 1:
+            return self._tools[0]["function"]["name"]
+        return ""
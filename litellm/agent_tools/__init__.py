@@ -0,0 +1,7 @@
+"""
+Tool implementations for MyCustomLLM.
+
+Modules in this package are registered lazily in ``agent.py`` with
+``registry.register_lazy("agent_tools.<module>:<function>")`` and are only
+imported on the first call of one of their tools.
+"""
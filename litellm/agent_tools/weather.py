@@ -0,0 +1,23 @@
+import json
+from typing import Literal
+
+
+def get_current_weather(location: str, unit: Literal["celsius", "fahrenheit"] = "celsius") -> str:
+    """
+    Get the current weather in a given location.
+
+    Args:
+        location: The city and state, e.g. San Francisco, CA
+        unit: The unit of temperature, either "celsius" or "fahrenheit"
+
+    Returns:
+        JSON string with weather information
+    """
+    # This is a mock implementation
+    weather_data = {
+        "location": location,
+        "temperature": 22,
+        "unit": unit,
+        "forecast": ["sunny", "windy"],
+    }
+    return json.dumps(weather_data)
@@ -0,0 +1,350 @@
+"""
+Local triage of agent turns for MyCustomLLM.
+
+Every first round of a turn normally sends the full ``tools`` schema upstream
+only to learn that most messages need no tool. Triage looks at the last user
+message in-process (well under a millisecond) and routes the turn to one of:
+
+- ``answer``: the plain answer without tools, skipping the decision call
+- ``decide``: the usual tool-decision call
+- ``force``:  the decision call with ``tool_choice`` set to one tool
+
+Two stages, per model in ``agent_settings``:
+
+1. ``triage_rules``: regular expressions, the first match wins, e.g.
+   ``{"pattern": "天気|weather", "tool": "get_current_weather"}`` forces a
+   tool and ``{"pattern": "^(hi|hello|thanks)\\b", "route": "answer"}``
+   skips the decision call.
+2. A linear classifier over the tool descriptions of the ``ToolRegistry``:
+   TF-IDF weighted words (character bigrams for Japanese) of the message
+   against those of each tool's name, description and parameters. A best
+   score below ``triage_answer_below`` answers directly; at or above
+   ``triage_force_above`` (0 disables) with no close second tool, the tool
+   is forced. Anything else goes to the decision call.
+
+With ``triage: shadow`` the verdict is only recorded and the decision call
+always runs, so ``agent_triage_outcomes_total`` shows how often a skip would
+have been wrong. Set ``AGENT_TRIAGE_LOG`` to append those outcomes to a JSONL
+file, and replay it with ``benchmark.py triage`` to report precision and
+recall for other thresholds before turning triage on.
+
+Like the traffic capture (``agent_capture``), the log is redacted by default:
+it holds hashes of the message's classifier features instead of its text,
+which is enough to replay the classifier but not the ``triage_rules``. Set
+``AGENT_TRIAGE_LOG_REDACT=0`` to log the text as well, e.g. to tune rules on
+a test deployment.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from typing import Iterable, List, NamedTuple, Optional, Sequence
+
+from agent_metrics import metrics
+from agent_registry import ToolRegistry
+
+logger = logging.getLogger(__name__)
+
+ANSWER = "answer"
+DECIDE = "decide"
+FORCE = "force"
+_ROUTES = (ANSWER, DECIDE, FORCE)
+
+# 長い貼り付けでも分類が1ms未満で終わるように先頭だけを見る
+_MAX_CHARS = 2000
+# 2番目のツールのスコアがこの割合以上なら1つに絞らない
+_FORCE_MARGIN = 0.5
+_TOKEN = re.compile(r"[a-z0-9]+|[^\x00-\x7f\s\W]+")
+_STOP_WORDS = frozenset(
+    "the and for are was were you your with this that from what which who how can could would should "
+    "please tell give about into have has had not but all any get use using given e.g etc".split()
+)
+
+metrics.describe("agent_triage_total", "Agent turns routed by local triage")
+metrics.describe("agent_triage_outcomes_total", "Triage verdicts of turns that made the tool-decision call, by whether tools were called")
+
+
+class Verdict(NamedTuple):
+    route: str
+    tool: Optional[str] = None
+    score: float = 0.0
+    reason: str = ""
+    text: str = ""
+
+
+def last_user_text(messages: Sequence[dict]) -> Optional[str]:
+    """Text of the last message when it is from the user, else None (e.g. a tool result)."""
+    if not messages or messages[-1].get("role") != "user":
+        return None
+    content = messages[-1].get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return ""
+
+
+def features(text: str) -> set:
+    """Lower-cased words without stop words and a plural "s", and character bigrams of non-ASCII runs."""
+    result = set()
+    for token in _TOKEN.findall(text[:_MAX_CHARS].lower()):
+        if token.isascii():
+            if len(token) > 2 and token not in _STOP_WORDS:
+                result.add(token[:-1] if len(token) > 3 and token.endswith("s") else token)
+        elif len(token) == 1:
+            result.add(token)
+        else:
+            result.update(token[i:i + 2] for i in range(len(token) - 1))
+    return result
+
+
+def feature_hash(feature: str) -> str:
+    """Short hash of a classifier feature, as written to a redacted ``AGENT_TRIAGE_LOG``."""
+    return hashlib.blake2b(feature.encode(), digest_size=8).hexdigest()
+
+
+def _tool_text(schema: dict) -> str:
+    function = schema["function"]
+    parts = [function["name"].replace("_", " ").replace("-", " "), function.get("description", "")]
+    for name, prop in (function.get("parameters") or {}).get("properties", {}).items():
+        parts.append(name.replace("_", " "))
+        parts.append(str(prop.get("description", "")))
+        parts.extend(str(value) for value in prop.get("enum", ()))
+    return " ".join(parts)
+
+
+class ToolIndex:
+    """
+    TF-IDF vectors of the tools in one ``tools`` payload.
+
+    With ``hashed`` the vocabulary is :func:`feature_hash` of each feature, to
+    score the features of a redacted ``AGENT_TRIAGE_LOG``.
+    """
+
+    def __init__(self, tools: List[dict], hashed: bool = False):
+        docs = [(tool["function"]["name"], features(_tool_text(tool))) for tool in tools]
+        if hashed:
+            docs = [(name, {feature_hash(feature) for feature in feats}) for name, feats in docs]
+        df = {}
+        for _, feats in docs:
+            for feature in feats:
+                df[feature] = df.get(feature, 0) + 1
+        # 語彙ごとに (ツール, 重み) を引けるようにして、メッセージの語だけを見る
+        self.postings = {}
+        self.norms = {}
+        for name, feats in docs:
+            weights = {feature: math.log(1 + len(docs) / df[feature]) for feature in feats}
+            self.norms[name] = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for feature, weight in weights.items():
+                self.postings.setdefault(feature, []).append((name, weight))
+
+    def scores(self, text: str) -> dict:
+        """Cosine similarity of ``text`` to each tool it shares a feature with."""
+        return self.feature_scores(features(text))
+
+    def feature_scores(self, feats: set) -> dict:
+        """:meth:`scores` for a message given by its features."""
+        if not feats:
+            return {}
+        totals = {}
+        for feature in feats:
+            for name, weight in self.postings.get(feature, ()):
+                totals[name] = totals.get(name, 0.0) + weight
+        # メッセージ側は重み1の二値ベクトルとして扱う
+        query_norm = math.sqrt(len(feats))
+        return {name: total / (self.norms[name] * query_norm) for name, total in totals.items()}
+
+
+class _Rule(NamedTuple):
+    pattern: "re.Pattern"
+    route: str
+    tool: Optional[str]
+
+
+class Triage:
+    """Routes turns by rules, then by the tool classifier; caches compiled rules and tool indexes."""
+
+    def __init__(self, log_path: Optional[str] = None, redact: bool = True):
+        self.log_path = log_path
+        self.redact = redact
+        self._rules = {}
+        self._index_key = None
+        self._index = None
+        self._hashed_index = None
+        self._log_lock = threading.Lock()
+
+    def _compiled(self, rules: Sequence[dict]) -> List[_Rule]:
+        key = json.dumps(list(rules), sort_keys=True, default=str)
+        compiled = self._rules.get(key)
+        if compiled is None:
+            compiled = []
+            for rule in rules:
+                route = rule.get("route") or (FORCE if rule.get("tool") else DECIDE)
+                if route not in _ROUTES or (route == FORCE and not rule.get("tool")):
+                    logger.warning(f"Ignoring invalid triage rule: {rule}")
+                    continue
+                compiled.append(_Rule(re.compile(rule["pattern"], re.IGNORECASE), route, rule.get("tool")))
+            self._rules[key] = compiled
+        return compiled
+
+    def index(self, registry: ToolRegistry, hashed: bool = False) -> ToolIndex:
+        """The classifier for the registry's current tools, rebuilt when they change."""
+        tools_json = registry.tools_json
+        if self._index_key != tools_json:
+            self._index = ToolIndex(registry.tools)
+            self._hashed_index = None
+            self._index_key = tools_json
+        if hashed:
+            if self._hashed_index is None:
+                self._hashed_index = ToolIndex(registry.tools, hashed=True)
+            return self._hashed_index
+        return self._index
+
+    def classify(
+        self,
+        messages: Sequence[dict],
+        registry: ToolRegistry,
+        rules: Sequence[dict] = (),
+        answer_below: float = 0.0,
+        force_above: float = 0.0,
+    ) -> Verdict:
+        """Route the turn ending in ``messages``."""
+        text = last_user_text(messages)
+        if text is None:
+            return Verdict(DECIDE, reason="not a user message")
+        for rule in self._compiled(rules):
+            if rule.pattern.search(text, 0, _MAX_CHARS):
+                if rule.route == FORCE and rule.tool not in registry:
+                    logger.warning(f"Triage rule forces unknown tool {rule.tool}")
+                    continue
+                return Verdict(rule.route, rule.tool, 1.0, f"rule {rule.pattern.pattern}", text)
+
+        return _classified(self.index(registry).scores(text), answer_below, force_above, text)
+
+    def classify_hashed(
+        self, hashes: Iterable[str], registry: ToolRegistry, answer_below: float = 0.0, force_above: float = 0.0
+    ) -> Verdict:
+        """Route a turn of a redacted log by its feature hashes (classifier only, rules need the text)."""
+        return _classified(self.index(registry, hashed=True).feature_scores(set(hashes)), answer_below, force_above)
+
+    def count(self, verdict: Verdict, mode: str) -> None:
+        metrics.inc("agent_triage_total", route=verdict.route, mode=mode)
+
+    def observe(self, verdict: Verdict, tool_calls: List[dict]) -> None:
+        """Record what the decision call did for a turn that triage saw."""
+        called = [call["function"]["name"] for call in tool_calls]
+        metrics.inc("agent_triage_outcomes_total", route=verdict.route, needed_tools=str(bool(called)).lower())
+        if self.log_path and verdict.text:
+            # 既定ではメッセージの本文を書かず、分類に使う特徴のハッシュだけを残す
+            sample = {"features": sorted(map(feature_hash, features(verdict.text)))}
+            if not self.redact:
+                sample["text"] = verdict.text[:_MAX_CHARS]
+            line = json.dumps({
+                **sample,
+                "tools": called,
+                "route": verdict.route,
+                "tool": verdict.tool,
+                "score": round(verdict.score, 4),
+            }, ensure_ascii=False)
+            # ファイルへの追記はイベントループの外で行う
+            asyncio.get_running_loop().run_in_executor(None, self._append, line)
+
+    def _append(self, line: str) -> None:
+        try:
+            with self._log_lock, open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"Could not write the triage log: {e}")
+
+
+def _classified(scores: dict, answer_below: float, force_above: float, text: str = "") -> Verdict:
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    best, score = ranked[0] if ranked else (None, 0.0)
+    if score < answer_below:
+        return Verdict(ANSWER, None, score, "classifier", text)
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+    if force_above > 0 and score >= force_above and runner_up < score * _FORCE_MARGIN:
+        return Verdict(FORCE, best, score, "classifier", text)
+    return Verdict(DECIDE, best, score, "classifier", text)
+
+
+def forced_choice(tool: str) -> dict:
+    """``tool_choice`` that makes the model call ``tool``."""
+    return {"type": "function", "function": {"name": tool}}
+
+
+def _ratio(numerator: int, denominator: int) -> float:
+    return numerator / denominator if denominator else 0.0
+
+
+def evaluate(
+    samples: Iterable[dict],
+    registry: ToolRegistry,
+    rules: Sequence[dict] = (),
+    answer_below: float = 0.0,
+    force_above: float = 0.0,
+    triage: Optional[Triage] = None,
+) -> dict:
+    """
+    Precision and recall of triage over recorded turns.
+
+    Args:
+        samples: Dicts with ``text`` (or ``messages``) and ``tools``, the names
+            of the tools the decision call asked for, e.g. lines of ``AGENT_TRIAGE_LOG``.
+            Redacted lines carry ``features`` instead of the text and are
+            classified without ``rules``.
+        registry: The tools the turns were recorded with.
+        rules, answer_below, force_above: The triage settings to evaluate.
+
+    Returns:
+        ``skip_precision`` / ``skip_recall`` for turns routed to ``answer``
+        (positive: no tool was needed), ``force_precision`` / ``force_recall``
+        for forced tools (positive: the forced tool was called), the share of
+        decision calls saved, and the classification latency.
+    """
+    triage = triage or Triage()
+    counts = dict.fromkeys(
+        ("samples", "redacted", "no_tool", "answered", "answered_right", "forced", "forced_right", "tool"), 0
+    )
+    latencies = []
+    for sample in samples:
+        needed = set(sample.get("tools") or ())
+        redacted = "features" in sample and "text" not in sample and "messages" not in sample
+        start = time.perf_counter()
+        if redacted:
+            verdict = triage.classify_hashed(sample["features"], registry, answer_below, force_above)
+        else:
+            messages = sample.get("messages") or [{"role": "user", "content": sample.get("text", "")}]
+            verdict = triage.classify(messages, registry, rules, answer_below, force_above)
+        latencies.append(time.perf_counter() - start)
+        counts["samples"] += 1
+        counts["redacted"] += redacted
+        counts["no_tool" if not needed else "tool"] += 1
+        if verdict.route == ANSWER:
+            counts["answered"] += 1
+            counts["answered_right"] += not needed
+        elif verdict.route == FORCE:
+            counts["forced"] += 1
+            counts["forced_right"] += verdict.tool in needed
+    latencies.sort()
+    return {
+        **counts,
+        "skip_precision": _ratio(counts["answered_right"], counts["answered"]),
+        "skip_recall": _ratio(counts["answered_right"], counts["no_tool"]),
+        "force_precision": _ratio(counts["forced_right"], counts["forced"]),
+        "force_recall": _ratio(counts["forced_right"], counts["tool"]),
+        "decision_calls_saved": _ratio(counts["answered"], counts["samples"]),
+        "p50_us": latencies[len(latencies) // 2] * 1e6 if latencies else 0.0,
+        "max_us": latencies[-1] * 1e6 if latencies else 0.0,
+    }
+
+
+triage = Triage(
+    os.environ.get("AGENT_TRIAGE_LOG") or None,
+    redact=os.environ.get("AGENT_TRIAGE_LOG_REDACT", "1").lower() not in ("0", "false", "no"),
+)
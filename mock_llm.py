@@ -0,0 +1,405 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions server.
+
+Used by benchmark.py to drive the agent fully offline. Latency, token rate,
+answer length and how often the model asks for a tool are configurable, and
+tool calls can be emitted in the formats described in NOTE.md:
+
+- ``gpt-5``:   ``delta.tool_calls`` fragments (name in the first fragment)
+- ``no-name``: ``delta.tool_calls`` fragments where ``function.name`` never arrives
+- ``qwen3``:   the tool call as a JSON object in ``delta.content`` when streaming
+
+``[tool:<name>]`` or ``[no-tool]`` in the last user message overrides the
+tool-call probability for that request, and a ``tool_choice`` naming a tool
+overrides both. ``--token-chars`` splits the streamed
+answer into deltas of that many characters, like the one- or two-character
+deltas of small local models.
+
+With ``--replay`` the server answers from a traffic capture of the agent
+(``AGENT_CAPTURE_PATH``) instead: a request whose messages carry
+``[replay:<key>]`` (see ``replay_key``) gets the text or tool calls the
+upstream returned in the same round of that captured request, with the
+recorded chunk timings. ``benchmark.py replay`` adds the markers.
+
+Usage:
+    uv run python mock_llm.py --port 8010 --latency 0.2 --tokens-per-sec 200
+    uv run python mock_llm.py --port 8010 --replay capture.jsonl
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+
+REPLAY_MARKER = re.compile(r"\[replay:([0-9a-f]+)\]")
+WORDS = "the quick brown fox jumps over the lazy dog while the weather stays sunny and windy".split()
+
+
+class MockLLM:
+    def __init__(
+        self, latency=0.1, tokens_per_sec=100.0, tokens=50, tool_probability=1.0, tool_format="gpt-5", seed=0,
+        token_chars=0,
+    ):
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens = tokens
+        self.tool_probability = tool_probability
+        self.tool_format = tool_format
+        self.token_chars = token_chars
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    # ----------------------------------------------------------------- HTTP
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+
+                path = path.split("?", 1)[0].rstrip("/")
+                if method == "POST" and path.endswith("/chat/completions"):
+                    self.requests += 1
+                    await self.chat(json.loads(body or b"{}"), writer)
+                elif method == "GET" and path.endswith("/models"):
+                    self.send_json(writer, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+                elif method == "GET" and path in ("/health", ""):
+                    self.send_json(writer, {"status": "ok", "requests": self.requests})
+                else:
+                    self.send_json(writer, {"error": {"message": f"{method} {path} not found"}}, status="404 Not Found")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def send_json(writer, payload, status="200 OK") -> None:
+        data = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+            + data
+        )
+
+    # ----------------------------------------------------------------- chat
+
+    def pick_tool(self, request: dict):
+        """
+        Decide whether to answer with a tool call and which tool to call.
+
+        ``[tool:<name>]`` / ``[no-tool]`` in the last user message force the
+        decision, so tests can steer individual requests; a ``tool_choice``
+        naming a tool wins over both, as it does upstream.
+        """
+        messages = request.get("messages") or []
+        tools = request.get("tools") or []
+        if not tools or (messages and messages[-1].get("role") == "tool"):
+            return None
+        choice = request.get("tool_choice")
+        if isinstance(choice, dict):
+            name = (choice.get("function") or {}).get("name")
+            for tool in tools:
+                if tool["function"]["name"] == name:
+                    return tool
+        content = str(messages[-1].get("content") or "") if messages else ""
+        if "[no-tool]" in content:
+            return None
+        for tool in tools:
+            if f"[tool:{tool['function']['name']}]" in content:
+                return tool
+        return tools[0] if self.random.random() < self.tool_probability else None
+
+    @staticmethod
+    def tool_arguments(tool: dict) -> dict:
+        """Fill the required parameters of a tool schema with plausible values."""
+        parameters = tool["function"].get("parameters", {})
+        arguments = {}
+        for name in parameters.get("required", []):
+            schema = parameters.get("properties", {}).get(name, {})
+            if "enum" in schema:
+                arguments[name] = schema["enum"][0]
+            elif schema.get("type") in ("integer", "number"):
+                arguments[name] = 1
+            elif schema.get("type") == "boolean":
+                arguments[name] = True
+            else:
+                arguments[name] = "Tokyo"
+        return arguments
+
+    def answer_tokens(self, request: dict) -> list:
+        messages = request.get("messages") or []
+        tokens = []
+        if messages and messages[-1].get("role") == "tool":
+            # ツール結果を含めた応答 (test_focused.py と同様に "22" などを確認できるように)
+            tokens.extend(f"{messages[-1].get('content', '')} ".split(" ")[:8])
+        while len(tokens) < self.tokens:
+            tokens.append(WORDS[len(tokens) % len(WORDS)])
+        tokens = [t + " " for t in tokens[:self.tokens]]
+        if self.token_chars:
+            text = "".join(tokens)
+            return [text[i:i + self.token_chars] for i in range(0, len(text), self.token_chars)]
+        return tokens
+
+    async def chat(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        model = request.get("model", "mock")
+        stream = request.get("stream", False)
+        prompt_tokens = sum(len(str(m.get("content") or "").split()) for m in request.get("messages") or [])
+        tool = self.pick_tool(request)
+
+        await asyncio.sleep(self.latency)
+        if not stream:
+            await asyncio.sleep(self.tokens / self.tokens_per_sec if tool is None else 0)
+            message = {"role": "assistant", "content": None}
+            if tool is not None:
+                message["tool_calls"] = [{
+                    "id": f"call_{uuid.uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {"name": tool["function"]["name"], "arguments": json.dumps(self.tool_arguments(tool))},
+                }]
+                finish_reason, completion_tokens = "tool_calls", 10
+            else:
+                message["content"] = "".join(self.answer_tokens(request)).strip()
+                finish_reason, completion_tokens = "stop", self.tokens
+            self.send_json(writer, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            })
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        async def send(delta: dict, finish_reason=None, usage=None) -> None:
+            payload = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if usage is not None:
+                payload["usage"] = usage
+            data = f"data: {json.dumps(payload)}\n\n".encode()
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            await writer.drain()
+
+        interval = 1.0 / self.tokens_per_sec
+        if tool is not None:
+            name = tool["function"]["name"]
+            arguments = json.dumps(self.tool_arguments(tool))
+            if self.tool_format == "qwen3":
+                content = json.dumps({"name": name, "arguments": self.tool_arguments(tool)})
+                for i in range(0, len(content), 8):
+                    await send({"role": "assistant", "content": content[i:i + 8]})
+                    await asyncio.sleep(interval)
+            else:
+                first_name = None if self.tool_format == "no-name" else name
+                await send({"role": "assistant", "tool_calls": [{
+                    "index": 0, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                    "function": {"name": first_name, "arguments": ""},
+                }]})
+                for i in range(0, len(arguments), 8):
+                    await asyncio.sleep(interval)
+                    await send({"tool_calls": [{"index": 0, "function": {"arguments": arguments[i:i + 8]}}]})
+            finish_reason, completion_tokens = "tool_calls", 10
+        else:
+            for token in self.answer_tokens(request):
+                await send({"role": "assistant", "content": token})
+                await asyncio.sleep(interval)
+            finish_reason, completion_tokens = "stop", self.tokens
+
+        await send({}, finish_reason, {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        })
+        done = b"data: [DONE]\n\n"
+        writer.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+
+
+def replay_key(record: dict) -> str:
+    """Key of a captured request, from its incoming messages (equal requests share a key)."""
+    payload = json.dumps(record["messages"], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+
+class ReplayLLM(MockLLM):
+    """Serves the upstream rounds of captured requests; unmarked requests fall back to ``MockLLM``."""
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.traces = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line) if line.strip() else {}
+                if record.get("kind") == "request" and record.get("rounds"):
+                    self.traces.setdefault(replay_key(record), record)
+
+    def recorded_round(self, request: dict):
+        """The captured round answering ``request`` and the tool calls to return, or None."""
+        messages = request.get("messages") or []
+        trace = None
+        for message in messages:
+            content = message.get("content")
+            text = content if isinstance(content, str) else json.dumps(content) if content else ""
+            match = REPLAY_MARKER.search(text) if message.get("role") == "user" else None
+            if match:
+                trace = self.traces.get(match.group(1))
+        if trace is None:
+            return None
+        # 最後のユーザーメッセージ以降のツール呼び出しの数がラウンドの番号
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=0)
+        iteration = sum(1 for m in messages[last_user:] if m.get("role") == "assistant" and m.get("tool_calls"))
+        rounds = trace["rounds"]
+        recorded = rounds[min(iteration, len(rounds) - 1)]
+        if request.get("tools"):
+            return recorded, recorded.get("tool_calls") or []
+        if recorded.get("tool_calls"):
+            # ツール無しで呼ばれた (判定の省略・投機・上限): 記録された最終的な回答を返す
+            recorded = next((r for r in reversed(rounds) if not r.get("tool_calls")), recorded)
+        return recorded, []
+
+    async def chat(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        found = self.recorded_round(request)
+        if found is None:
+            await super().chat(request, writer)
+            return
+        recorded, tool_calls = found
+        model = request.get("model", "mock")
+        text = recorded.get("text") or ""
+        finish_reason = "tool_calls" if tool_calls else "stop"
+        usage = recorded.get("usage") or {}
+
+        if not request.get("stream", False):
+            await asyncio.sleep(recorded.get("seconds", 0))
+            message = {"role": "assistant", "content": None if tool_calls else text}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            self.send_json(writer, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        async def send(delta: dict, finish=None, chunk_usage=None) -> None:
+            payload = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            if chunk_usage is not None:
+                payload["usage"] = chunk_usage
+            data = f"data: {json.dumps(payload)}\n\n".encode()
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            await writer.drain()
+
+        # ツール呼び出しは、記録でテキストを含まなかったチャンクの時刻に断片として流す
+        # (contentのJSONで返された記録は、テキストをそのまま流せば同じ形式になる)
+        fragments = []
+        native = recorded.get("native") or not text
+        for i, call in enumerate(tool_calls if native else ()):
+            arguments = call["function"].get("arguments") or ""
+            fragments.append({"role": "assistant", "tool_calls": [{
+                "index": i, "id": call.get("id") or f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                "function": {"name": call["function"]["name"], "arguments": ""},
+            }]})
+            for start in range(0, len(arguments), 8):
+                fragments.append({"tool_calls": [{"index": i, "function": {"arguments": arguments[start:start + 8]}}]})
+        fragments.reverse()
+        chunks = recorded.get("chunks") or [[recorded.get("seconds", 0) * 1000, len(text)]]
+        position = 0
+        for gap_ms, size in chunks:
+            await asyncio.sleep(gap_ms / 1000)
+            if size and position < len(text):
+                await send({"role": "assistant", "content": text[position:position + size]})
+                position += size
+            elif fragments:
+                await send(fragments.pop())
+        if position < len(text):
+            await send({"role": "assistant", "content": text[position:]})
+        while fragments:
+            await send(fragments.pop())
+
+        await send({}, finish_reason, usage)
+        done = b"data: [DONE]\n\n"
+        writer.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+
+
+async def serve(mock: MockLLM, host: str, port: int) -> None:
+    server = await asyncio.start_server(mock.handle, host, port, backlog=1024)
+    print(f"mock LLM listening on http://{host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=100.0)
+    parser.add_argument("--tokens", type=int, default=50, help="answer length in tokens")
+    parser.add_argument("--tool-probability", type=float, default=1.0, help="chance of a tool call when tools are sent")
+    parser.add_argument("--tool-format", choices=["gpt-5", "no-name", "qwen3"], default="gpt-5")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--token-chars", type=int, default=0,
+                        help="characters per streamed delta (0 = one word per delta)")
+    parser.add_argument("--replay", help="answer marked requests from this AGENT_CAPTURE_PATH capture")
+    args = parser.parse_args()
+
+    settings = dict(
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        tokens=args.tokens,
+        tool_probability=args.tool_probability,
+        tool_format=args.tool_format,
+        seed=args.seed,
+        token_chars=args.token_chars,
+    )
+    mock = ReplayLLM(args.replay, **settings) if args.replay else MockLLM(**settings)
+    try:
+        asyncio.run(serve(mock, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Local stub MCP server for offline tests of litellm/agent_mcp.py.
+
+Speaks newline-delimited JSON-RPC over stdio, or the Streamable HTTP
+transport with ``--http`` (``tools/call`` results are sent as an SSE stream,
+everything else as plain JSON). Requests are handled concurrently, so
+responses can come back in a different order than the requests.
+
+Tools:
+
+- ``add(a, b)``: the sum of two numbers (read-only)
+- ``sleep(seconds)``: waits, then reports the process and session that served it
+- ``fail(message)``: answers with an MCP tool error
+
+Usage:
+    uv run python mock_mcp.py
+    uv run python mock_mcp.py --http --port 8931    # http://127.0.0.1:8931/mcp
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import uuid
+
+TOOLS = [
+    {
+        "name": "add",
+        "description": "Add two numbers.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {"a": {"type": "number"}, "b": {"type": "number"}},
+            "required": ["a", "b"],
+        },
+        "annotations": {"readOnlyHint": True},
+    },
+    {
+        "name": "sleep",
+        "description": "Wait for a while and report which server process handled the call.",
+        "inputSchema": {
+            "type": "object",
+            "properties": {"seconds": {"type": "number"}},
+            "required": ["seconds"],
+        },
+        "annotations": {"idempotentHint": True},
+    },
+    {
+        "name": "fail",
+        "description": "Always fails.",
+        "inputSchema": {"type": "object", "properties": {"message": {"type": ["string", "null"]}}},
+    },
+]
+
+
+class MockMCP:
+    def __init__(self):
+        self.sessions = 0
+
+    async def handle(self, message: dict, session: str):
+        """Returns the JSON-RPC response, or None for notifications."""
+        method = message.get("method")
+        params = message.get("params") or {}
+        if "id" not in message:
+            return None
+        if method == "initialize":
+            self.sessions += 1
+            result = {
+                "protocolVersion": params.get("protocolVersion", "2025-06-18"),
+                "capabilities": {"tools": {"listChanged": False}},
+                "serverInfo": {"name": "mock-mcp", "version": "0.1.0"},
+            }
+        elif method == "tools/list":
+            result = {"tools": TOOLS}
+        elif method == "tools/call":
+            result = await self.call(params.get("name"), params.get("arguments") or {}, session)
+        elif method == "ping":
+            result = {}
+        else:
+            return {"jsonrpc": "2.0", "id": message["id"], "error": {"code": -32601, "message": f"Unknown method {method}"}}
+        return {"jsonrpc": "2.0", "id": message["id"], "result": result}
+
+    async def call(self, name: str, arguments: dict, session: str) -> dict:
+        if name == "add":
+            text = str(arguments["a"] + arguments["b"])
+        elif name == "sleep":
+            await asyncio.sleep(float(arguments["seconds"]))
+            text = json.dumps({"pid": os.getpid(), "session": session, "sessions": self.sessions})
+        elif name == "fail":
+            return {"content": [{"type": "text", "text": arguments.get("message") or "failed"}], "isError": True}
+        else:
+            return {"content": [{"type": "text", "text": f"Unknown tool {name}"}], "isError": True}
+        return {"content": [{"type": "text", "text": text}], "isError": False}
+
+    # ---------------------------------------------------------------- stdio
+
+    async def serve_stdio(self) -> None:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        session = str(os.getpid())
+        tasks = set()
+
+        async def respond(message: dict) -> None:
+            response = await self.handle(message, session)
+            if response is not None:
+                sys.stdout.write(json.dumps(response) + "\n")
+                sys.stdout.flush()
+
+        async for line in reader:
+            if line.strip():
+                task = asyncio.ensure_future(respond(json.loads(line)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+    # ----------------------------------------------------------------- HTTP
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+
+                if method == "DELETE":
+                    self.send(writer, "200 OK", b"")
+                elif method != "POST" or path.split("?", 1)[0].rstrip("/") != "/mcp":
+                    self.send(writer, "404 Not Found", b"")
+                else:
+                    message = json.loads(body)
+                    session = headers.get("mcp-session-id") or uuid.uuid4().hex
+                    response = await self.handle(message, session)
+                    extra = {"Mcp-Session-Id": session} if message.get("method") == "initialize" else {}
+                    if response is None:
+                        self.send(writer, "202 Accepted", b"", extra=extra)
+                    elif message.get("method") == "tools/call":
+                        event = f"event: message\ndata: {json.dumps(response)}\n\n".encode()
+                        self.send(writer, "200 OK", event, "text/event-stream", extra)
+                    else:
+                        self.send(writer, "200 OK", json.dumps(response).encode(), "application/json", extra)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def send(writer, status: str, data: bytes, content_type: str = "application/json", extra: dict = None) -> None:
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (extra or {}).items())
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\n{headers}\r\n".encode()
+            + data
+        )
+
+    async def serve_http(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle_http, host, port, backlog=1024)
+        print(f"mock MCP listening on http://{host}:{port}/mcp", flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--http", action="store_true", help="serve Streamable HTTP instead of stdio")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8931)
+    args = parser.parse_args()
+
+    mock = MockMCP()
+    try:
+        asyncio.run(mock.serve_http(args.host, args.port) if args.http else mock.serve_stdio())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Local stand-in Redis server for offline tests of litellm/agent_shared.py.
+
+Speaks RESP2 and implements only the commands ``RedisStore`` uses (GET, SET
+with EX/PX/NX/XX, DEL, INCRBY, PEXPIRE, PTTL, WATCH, MULTI/EXEC, DBSIZE,
+FLUSHDB and the connection handshake). Commands run one at a time on one
+event loop, so each is atomic like in Redis.
+
+Usage:
+    uv run python mock_redis.py --port 6390
+    AGENT_SHARED_STATE=redis://127.0.0.1:6390/0 ...
+"""
+import argparse
+import asyncio
+import time
+
+
+class MockRedis:
+    def __init__(self):
+        self.data = {}  # key -> (value, expires_at or None)
+        self.versions = {}
+        self.commands = 0
+
+    def _live(self, key: bytes):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            self._touch(key)
+            return None
+        return entry
+
+    def _touch(self, key: bytes) -> None:
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def execute(self, args: list):
+        """The reply to one command: bytes, int, str (simple string), Exception, list or None."""
+        self.commands += 1
+        name = args[0].upper()
+        if name in (b"PING",):
+            return "PONG"
+        if name in (b"CLIENT", b"SELECT", b"HELLO"):
+            return "OK"
+        if name == b"FLUSHDB":
+            for key in list(self.data):
+                self._touch(key)
+            self.data.clear()
+            return "OK"
+        if name == b"DBSIZE":
+            return sum(1 for key in list(self.data) if self._live(key) is not None)
+        if name == b"GET":
+            entry = self._live(args[1])
+            return entry[0] if entry else None
+        if name == b"SET":
+            return self._set(args[1], args[2], [a.upper() for a in args[3:]], args[3:])
+        if name == b"DEL":
+            deleted = 0
+            for key in args[1:]:
+                if self._live(key) is not None:
+                    del self.data[key]
+                    self._touch(key)
+                    deleted += 1
+            return deleted
+        if name in (b"INCRBY", b"INCR"):
+            entry = self._live(args[1])
+            try:
+                value = int(entry[0] if entry else b"0") + (int(args[2]) if name == b"INCRBY" else 1)
+            except ValueError:
+                return ValueError("ERR value is not an integer or out of range")
+            self.data[args[1]] = (str(value).encode(), entry[1] if entry else None)
+            self._touch(args[1])
+            return value
+        if name == b"PEXPIRE":
+            entry = self._live(args[1])
+            if entry is None:
+                return 0
+            self.data[args[1]] = (entry[0], time.monotonic() + int(args[2]) / 1000)
+            self._touch(args[1])
+            return 1
+        if name == b"PTTL":
+            entry = self._live(args[1])
+            if entry is None:
+                return -2
+            return -1 if entry[1] is None else int((entry[1] - time.monotonic()) * 1000)
+        return ValueError(f"ERR unknown command '{args[0].decode()}'")
+
+    def _set(self, key: bytes, value: bytes, options: list, raw: list):
+        expires = None
+        if b"PX" in options:
+            expires = time.monotonic() + int(raw[options.index(b"PX") + 1]) / 1000
+        elif b"EX" in options:
+            expires = time.monotonic() + int(raw[options.index(b"EX") + 1])
+        exists = self._live(key) is not None
+        if (b"NX" in options and exists) or (b"XX" in options and not exists):
+            return None
+        self.data[key] = (value, expires)
+        self._touch(key)
+        return "OK"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        queued = None
+        watched = {}
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                name = args[0].upper()
+                if name == b"MULTI":
+                    queued = []
+                    reply = "OK"
+                elif name == b"DISCARD":
+                    queued, watched = None, {}
+                    reply = "OK"
+                elif name == b"WATCH":
+                    for key in args[1:]:
+                        self._live(key)
+                        watched[key] = self.versions.get(key, 0)
+                    reply = "OK"
+                elif name == b"UNWATCH":
+                    watched = {}
+                    reply = "OK"
+                elif name == b"EXEC":
+                    if any(self.versions.get(key, 0) != version for key, version in watched.items()):
+                        reply = NULL_ARRAY
+                    else:
+                        reply = [self.execute(command) for command in queued or []]
+                    queued, watched = None, {}
+                elif queued is not None:
+                    queued.append(args)
+                    reply = "QUEUED"
+                else:
+                    reply = self.execute(args)
+                writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        print(f"mock Redis listening on redis://{host}:{port}/0", flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+NULL_ARRAY = object()
+
+
+async def read_command(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.split()
+    args = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+def encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if reply is NULL_ARRAY:
+        return b"*-1\r\n"
+    if isinstance(reply, Exception):
+        return f"-{reply}\r\n".encode()
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, list):
+        return f"*{len(reply)}\r\n".encode() + b"".join(encode(item) for item in reply)
+    return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    try:
+        asyncio.run(MockRedis().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+Offline cache test: the tool-result cache expires entries after their TTL,
+evicts the least recently used one when full, and runs concurrent identical
+calls once. The response cache keys decisions on normalized inputs and
+behaves the same in memory and in SQLite, where entries survive a restart.
+
+No proxy or LLM needed:
+    uv run python test_cache.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm"))
+
+from agent_cache import MemoryBackend, ResponseCache, SQLiteBackend, ToolResultCache  # noqa: E402
+
+TOOLS_JSON = '[{"function":{"name":"get_current_weather"}}]'
+
+
+class Tool:
+    """Counts its runs; each result names the run that produced it."""
+
+    def __init__(self, delay: float = 0.0, fail: bool = False):
+        self.delay = delay
+        self.fail = fail
+        self.runs = 0
+
+    async def __call__(self) -> str:
+        self.runs += 1
+        run = self.runs
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError(f"run {run} failed")
+        return f"run {run}"
+
+
+async def test_ttl_and_lru():
+    """Entries are served until their TTL and the least recently used one is evicted first."""
+    print("\n" + "=" * 60)
+    print("Test: Tool Cache TTL and LRU Eviction")
+    print("=" * 60)
+
+    cache = ToolResultCache(ttl=0.2, max_entries=2)
+    tool = Tool()
+    results = {}
+
+    first = await cache.get_or_run("lookup", {"city": "Tokyo", "unit": "c"}, tool)
+    again = await cache.get_or_run("lookup", {"unit": "c", "city": "Tokyo"}, tool)
+    results["hit_with_reordered_arguments"] = again == first and tool.runs == 1
+
+    await cache.get_or_run("lookup", {"city": "Tokyo"}, tool, ttl=0.05)
+    await asyncio.sleep(0.1)
+    await cache.get_or_run("lookup", {"city": "Tokyo"}, tool, ttl=0.05)
+    results["per_call_ttl_expires"] = tool.runs == 3
+
+    # 容量2: Tokyo (unit c) を使い直してから Osaka を入れると、しばらく使っていない Tokyo が追い出される
+    await cache.get_or_run("lookup", {"city": "Tokyo", "unit": "c"}, tool)
+    await cache.get_or_run("lookup", {"city": "Osaka"}, tool)
+    await cache.get_or_run("lookup", {"city": "Tokyo", "unit": "c"}, tool)
+    results["recently_used_kept"] = tool.runs == 4 and cache.evictions == 1
+    await cache.get_or_run("lookup", {"city": "Tokyo"}, tool, ttl=0.05)
+    results["least_recently_used_evicted"] = tool.runs == 5 and cache.stats()["entries"] == 2
+
+    await asyncio.sleep(0.25)
+    await cache.get_or_run("lookup", {"city": "Tokyo", "unit": "c"}, tool)
+    results["default_ttl_expires"] = tool.runs == 6
+
+    print(f"📊 stats: {cache.stats()}")
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Entries expired and were evicted in LRU order!")
+        return True
+    else:
+        print("\n❌ FAILURE: The cache served stale entries or evicted the wrong one")
+        return False
+
+
+async def test_single_flight():
+    """Concurrent identical calls run once; failures reach every caller and are not cached."""
+    print("\n" + "=" * 60)
+    print("Test: Tool Cache Single-Flight Execution")
+    print("=" * 60)
+
+    cache = ToolResultCache(ttl=60.0)
+    results = {}
+
+    tool = Tool(delay=0.05)
+    answers = await asyncio.gather(*(cache.get_or_run("lookup", {"city": "Tokyo"}, tool) for _ in range(10)))
+    counts = cache.stats()["tools"]["lookup"]
+    results["one_run"] = tool.runs == 1 and set(answers) == {"run 1"}
+    results["coalesced_counted"] = counts["misses"] == 1 and counts["coalesced"] == 9
+
+    failing = Tool(delay=0.05, fail=True)
+    errors = await asyncio.gather(
+        *(cache.get_or_run("book", {"city": "Tokyo"}, failing) for _ in range(3)), return_exceptions=True
+    )
+    results["failure_shared"] = failing.runs == 1 and all(isinstance(e, RuntimeError) for e in errors)
+    failing.fail = False
+    results["failure_not_cached"] = await cache.get_or_run("book", {"city": "Tokyo"}, failing) == "run 2"
+
+    # 呼び出し元がキャンセルされても、共有している実行は他の呼び出し元のために続く
+    slow = Tool(delay=0.1)
+    first = asyncio.ensure_future(cache.get_or_run("slow", {}, slow))
+    second = asyncio.ensure_future(cache.get_or_run("slow", {}, slow))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    results["waiter_cancel_keeps_run"] = await second == "run 1" and slow.runs == 1
+
+    hung = Tool(delay=10.0)
+    try:
+        await cache.get_or_run("hung", {}, hung, timeout=0.05)
+        results["hung_run_times_out"] = False
+    except asyncio.TimeoutError:
+        hung.delay = 0.0
+        results["hung_run_times_out"] = await cache.get_or_run("hung", {}, hung, timeout=0.05) == "run 2"
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Identical calls ran once and failures were not cached!")
+        return True
+    else:
+        print("\n❌ FAILURE: Identical calls ran more than once or a failure was cached")
+        return False
+
+
+def test_response_cache_key():
+    """Formatting differences share a key; model, messages and tools do not."""
+    print("\n" + "=" * 60)
+    print("Test: Response Cache Key Normalization")
+    print("=" * 60)
+
+    messages = [{"role": "user", "content": "Weather in Tokyo?"}]
+    key = ResponseCache.key("gpt-5", messages, TOOLS_JSON)
+    results = {}
+    results["whitespace_and_none_ignored"] = key == ResponseCache.key(
+        "gpt-5", [{"content": "  Weather in Tokyo?\n", "role": "user", "name": None}], TOOLS_JSON
+    )
+    results["model_changes_key"] = key != ResponseCache.key("gpt-4o", messages, TOOLS_JSON)
+    results["messages_change_key"] = key != ResponseCache.key(
+        "gpt-5", [{"role": "user", "content": "Weather in Osaka?"}], TOOLS_JSON
+    )
+    results["tools_change_key"] = key != ResponseCache.key("gpt-5", messages, "")
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Only inputs that change the decision change the key!")
+        return True
+    else:
+        print("\n❌ FAILURE: The key depends on formatting or ignores an input")
+        return False
+
+
+async def backend_results(make_backend) -> dict:
+    """Exercise the ResponseCache on the backends ``make_backend`` builds (two share one store)."""
+    results = {}
+    cache = ResponseCache(make_backend(max_entries=2), ttl=0.2)
+    decision = {"content": None, "tool_calls": [{"function": {"name": "get_current_weather"}}]}
+
+    await cache.aset("a", decision)
+    results["roundtrip"] = await cache.aget("a") == decision and await cache.aget("missing") is None
+    results["stats"] = cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1 and cache.bytes_saved > 0
+
+    # 容量2: a を読み直してから c を入れると、読んでいない b が追い出される
+    await asyncio.sleep(0.01)
+    await cache.aset("b", {"content": "b"})
+    await asyncio.sleep(0.01)
+    await cache.aget("a")
+    await asyncio.sleep(0.01)
+    await cache.aset("c", {"content": "c"})
+    results["lru_eviction"] = await cache.aget("b") is None and await cache.aget("a") == decision
+
+    reopened = ResponseCache(make_backend(max_entries=2), ttl=0.2)
+    results["second_cache_sees_entries"] = await reopened.aget("c") == {"content": "c"}
+
+    await asyncio.sleep(0.25)
+    results["expired"] = await cache.aget("a") is None and await cache.aget("c") is None
+    return results
+
+
+async def test_response_cache_backends():
+    """The memory and SQLite backends expire and evict alike; SQLite entries outlive the backend."""
+    print("\n" + "=" * 60)
+    print("Test: Response Cache Memory and SQLite Backends")
+    print("=" * 60)
+
+    memory = MemoryBackend(max_entries=2)
+    results = {
+        f"memory_{name}": passed
+        for name, passed in (await backend_results(lambda max_entries: memory)).items()
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "responses.sqlite")
+        # 同じファイルを開き直した backend は、プロキシの再起動後と同じ状態になる
+        sqlite = await backend_results(lambda max_entries: SQLiteBackend(path, max_entries=max_entries))
+        results.update({f"sqlite_{name}": passed for name, passed in sqlite.items()})
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Both backends cached, evicted and expired the same way!")
+        return True
+    else:
+        print("\n❌ FAILURE: A response cache backend lost, kept or evicted the wrong entries")
+        return False
+
+
+async def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 24 + "Offline Cache Tests")
+    print("=" * 70)
+
+    results = {
+        "ttl_and_lru": await test_ttl_and_lru(),
+        "single_flight": await test_single_flight(),
+        "response_cache_key": test_response_cache_key(),
+        "response_cache_backends": await test_response_cache_backends(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
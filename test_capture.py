@@ -0,0 +1,167 @@
+"""
+Offline traffic capture test: by default the capture masks every word of the
+messages, tool arguments, tool results and upstream text while keeping
+lengths, JSON structure and tool names; with redaction off the text is kept.
+Credentials and other deployments are never written either way.
+
+No proxy or LLM needed:
+    uv run python test_capture.py
+"""
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm"))
+
+from agent_capture import Capture  # noqa: E402
+from agent_registry import ToolRegistry  # noqa: E402
+
+SECRETS = ("Tokyo", "sunny", "umbrella", "sk-secret", "chat-42", "internal.example")
+ARGUMENTS = json.dumps({"location": "Tokyo", "unit": "celsius"})
+RESULT = json.dumps({"location": "Tokyo", "temperature": 22, "forecast": ["sunny"]})
+ANSWER = "It is sunny in Tokyo, no umbrella needed."
+
+
+def capture_request(path: str, redact: bool) -> list:
+    """Capture one request with a native tool round, a tool call in content and a final answer."""
+    registry = ToolRegistry()
+    registry.register_lazy("agent_tools.weather:get_current_weather")
+    capture = Capture(path, redact=redact)
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Do I need an umbrella in Tokyo?"},
+    ]
+    kwargs = {
+        "model": "my-agent",
+        "api_key": "sk-secret",
+        "api_base": "https://internal.example/v1",
+        "litellm_params": {
+            "metadata": {"chat_id": "chat-42", "headers": {"authorization": "Bearer sk-secret"}},
+            "model_info": {"agent_settings": {
+                "max_iterations": 3,
+                "fallbacks": [{"model": "openai/gpt-4o", "api_key": "sk-secret"}],
+            }},
+        },
+    }
+    trace = capture.start("acompletion", kwargs, messages, registry)
+    call = {"id": "call_1", "type": "function", "function": {"name": "get_current_weather", "arguments": ARGUMENTS}}
+
+    trace.begin(True)
+    trace.chunk(None, [{"index": 0}])
+    trace.end([call], "tool_calls", {"prompt_tokens": 20, "completion_tokens": 10})
+    messages = messages + [
+        {"role": "assistant", "content": None, "tool_calls": [call]},
+        {"role": "tool", "tool_call_id": "call_1", "content": RESULT},
+    ]
+    # content に JSON で書かれたツール呼び出し (qwen3 など)
+    trace.begin(True)
+    text_call = json.dumps({"name": "get_current_weather", "arguments": {"location": "Tokyo"}})
+    trace.chunk(text_call)
+    trace.end([{**call, "id": "call_2"}], "tool_calls", None)
+    trace.begin(False)
+    for word in ANSWER.split(" "):
+        trace.chunk(word + " ")
+    trace.end([], "stop", {"prompt_tokens": 40, "completion_tokens": 12})
+    trace.finish(messages)
+
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_redacted_by_default():
+    """The default capture keeps no words but keeps what replay needs."""
+    print("\n" + "=" * 60)
+    print("Test: Capture Redacted by Default")
+    print("=" * 60)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "capture.jsonl")
+        lines = capture_request(path, redact=Capture().redact)
+        written = open(path, encoding="utf-8").read()
+    tools, request = lines
+    rounds = request["rounds"]
+
+    results = {}
+    results["no_secrets"] = not any(secret in written for secret in SECRETS)
+    results["marked_redacted"] = request.get("redacted") is True
+    results["tools_written_once"] = tools["kind"] == "tools" and request["tools"] == tools["digest"]
+    results["lengths_kept"] = len(request["messages"][1]["content"]) == len("Do I need an umbrella in Tokyo?") and (
+        len(rounds[2]["text"]) == len(ANSWER) + 1
+    )
+    arguments = json.loads(rounds[0]["tool_calls"][0]["function"]["arguments"])
+    results["json_structure_kept"] = set(arguments) == {"location", "unit"} and (
+        json.loads(request["results"][0]["content"])["temperature"] == 22
+    )
+    results["tool_names_kept"] = rounds[0]["tool_calls"][0]["function"]["name"] == "get_current_weather" and (
+        json.loads(rounds[1]["text"])["name"] == "get_current_weather"
+    )
+    results["timings_kept"] = len(rounds[2]["chunks"]) == len(ANSWER.split(" ")) and (
+        rounds[2]["usage"]["completion_tokens"] == 12
+    )
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: The capture kept the shape of the traffic but none of its words!")
+        return True
+    else:
+        print("\n❌ FAILURE: The capture leaked text or lost what replay needs")
+        return False
+
+
+def test_unredacted():
+    """With redaction off the text is kept, but credentials and other deployments still are not."""
+    print("\n" + "=" * 60)
+    print("Test: Capture Without Redaction")
+    print("=" * 60)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "capture.jsonl")
+        _, request = capture_request(path, redact=False)
+        written = open(path, encoding="utf-8").read()
+
+    results = {}
+    results["text_kept"] = request["messages"][1]["content"] == "Do I need an umbrella in Tokyo?" and (
+        request["rounds"][2]["text"].strip() == ANSWER
+    )
+    call = request["rounds"][0]["tool_calls"][0]
+    results["arguments_and_results_kept"] = call["function"]["arguments"] == ARGUMENTS and (
+        request["results"][0]["content"] == RESULT
+    )
+    results["not_marked_redacted"] = "redacted" not in request
+    results["no_credentials"] = not any(secret in written for secret in ("sk-secret", "chat-42", "internal.example"))
+    results["deployments_dropped"] = request["settings"] == {"max_iterations": 3}
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: The text was kept and the credentials were not!")
+        return True
+    else:
+        print("\n❌ FAILURE: The capture lost the text or wrote credentials")
+        return False
+
+
+def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 23 + "Offline Capture Tests")
+    print("=" * 70)
+
+    results = {
+        "redacted_by_default": test_redacted_by_default(),
+        "unredacted": test_unredacted(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Offline concurrency tests: a slow blocking tool in one request must not stall
+the stream of another request on the same worker, and coalescing merges tiny
+deltas without holding text back longer than ``coalesce_wait``.
+
+Runs against mock_llm.py, no proxy or Ollama needed:
+    uv run python test_concurrency.py
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from benchmark import load_agent, percentile, start_mock_server
+
+SLOW_TOOL_SECONDS = 1
+COALESCE_WAIT = 0.02
+
+
+def slow_blocking_tool(seconds: int) -> str:
+    """
+    Block the calling thread, like a synchronous API client waiting on a slow backend.
+
+    Args:
+        seconds: How long to block
+    """
+    time.sleep(seconds)
+    return json.dumps({"slept": seconds})
+
+
+async def stream_gaps(llm, base_url: str, content: str) -> list:
+    """Stream one answer and return the gaps between consecutive text chunks in seconds."""
+    gaps = []
+    last = None
+    async for chunk in llm.astreaming(
+        model="openai/mock-gpt-5",
+        messages=[{"role": "user", "content": content}],
+        api_base=base_url,
+        api_key="sk-mock",
+    ):
+        if not chunk["text"]:
+            continue
+        now = time.perf_counter()
+        if last is not None:
+            gaps.append(now - last)
+        last = now
+    return gaps
+
+
+async def test_stream_flat_while_slow_tool_runs():
+    """Inter-chunk latency of a plain stream stays flat while another request runs a blocking tool."""
+    print("\n" + "=" * 60)
+    print("Test: Stream Latency During a Slow Tool (Offline)")
+    print("=" * 60)
+
+    process, base_url = start_mock_server(SimpleNamespace(
+        latency=0.01,
+        tokens_per_sec=50.0,
+        tokens=60,
+        tool_probability=0.0,
+        tool_format="gpt-5",
+    ))
+    try:
+        agent = load_agent(base_url)
+        if "slow_blocking_tool" not in agent.registry:
+            agent.registry.register(slow_blocking_tool, cacheable=False)
+        llm = agent.my_custom_llm
+
+        baseline = await stream_gaps(llm, base_url, "Tell me a story [no-tool]")
+
+        tool_request = asyncio.create_task(llm.acompletion(
+            model="openai/mock-gpt-5",
+            messages=[{"role": "user", "content": "Look it up [tool:slow_blocking_tool]"}],
+            api_base=base_url,
+            api_key="sk-mock",
+        ))
+        await asyncio.sleep(0.1)  # ツールが実行中になるまで待つ
+        during = await stream_gaps(llm, base_url, "Tell me a story [no-tool]")
+        await tool_request
+    finally:
+        process.terminate()
+        process.wait()
+
+    print(f"📊 Baseline gaps: p50={percentile(baseline, 0.5) * 1000:.1f}ms max={max(baseline) * 1000:.1f}ms")
+    print(f"📊 During tool:   p50={percentile(during, 0.5) * 1000:.1f}ms max={max(during) * 1000:.1f}ms")
+
+    if max(during) < max(baseline) + 0.1 and max(during) < SLOW_TOOL_SECONDS / 2:
+        print("\n✅ SUCCESS: Stream stayed flat while the slow tool ran!")
+        return True
+    else:
+        print("\n⚠️  WARNING: Stream stalled while the slow tool ran")
+        return False
+
+
+async def stream_frames(llm, base_url: str, agent_settings: dict) -> list:
+    """Stream one answer and return ``(seconds since the request, text)`` for every chunk."""
+    frames = []
+    start = time.perf_counter()
+    async for chunk in llm.astreaming(
+        model="openai/mock-gpt-5",
+        messages=[{"role": "user", "content": "Tell me a story [no-tool]"}],
+        api_base=base_url,
+        api_key="sk-mock",
+        litellm_params={"model_info": {"agent_settings": agent_settings}},
+    ):
+        frames.append((time.perf_counter() - start, chunk["text"]))
+    return frames
+
+
+async def test_coalesced_stream():
+    """Two-character deltas are merged into fewer chunks with the same text and bounded gaps."""
+    print("\n" + "=" * 60)
+    print("Test: Coalesced Stream (Offline)")
+    print("=" * 60)
+
+    process, base_url = start_mock_server(SimpleNamespace(
+        latency=0.01,
+        tokens_per_sec=200.0,
+        tokens=60,
+        tool_probability=0.0,
+        tool_format="gpt-5",
+        token_chars=2,
+    ))
+    try:
+        agent = load_agent(base_url)
+        llm = agent.my_custom_llm
+        plain = await stream_frames(llm, base_url, {})
+        # 閾値の文字数には届かないので、まとめる単位は coalesce_wait で決まる
+        coalesced = await stream_frames(llm, base_url, {"coalesce_chars": 1000, "coalesce_wait": COALESCE_WAIT})
+    finally:
+        process.terminate()
+        process.wait()
+
+    gaps = [b[0] - a[0] for a, b in zip(coalesced, coalesced[1:])]
+    print(f"📊 Chunks: {len(plain)} plain, {len(coalesced)} coalesced")
+    print(f"📊 First chunk: {plain[0][0] * 1000:.1f}ms plain, {coalesced[0][0] * 1000:.1f}ms coalesced; "
+          f"longest coalesced gap {max(gaps) * 1000:.1f}ms")
+
+    same_text = "".join(text for _, text in plain) == "".join(text for _, text in coalesced)
+    if same_text and len(coalesced) < len(plain) / 2 and max(gaps) < COALESCE_WAIT + 0.05:
+        print("\n✅ SUCCESS: Deltas were coalesced without holding text back!")
+        return True
+    else:
+        print("\n⚠️  WARNING: Coalescing changed the text, merged too little or held text too long")
+        return False
+
+
+async def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 20 + "Offline Concurrency Tests")
+    print("=" * 70)
+
+    results = {
+        "stream_flat_while_slow_tool_runs": await test_stream_flat_while_slow_tool_runs(),
+        "coalesced_stream": await test_coalesced_stream(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
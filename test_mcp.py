@@ -0,0 +1,132 @@
+"""
+Offline MCP test: tools from a stdio and an HTTP MCP server are registered
+once, concurrent calls share one long-lived session instead of starting
+a server per call, and only tools annotated ``readOnlyHint`` are cacheable.
+
+Runs against mock_mcp.py, no proxy or LLM needed:
+    uv run python test_mcp.py
+"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm"))
+
+from agent_mcp import MCPServer, MCPToolset  # noqa: E402
+from agent_registry import ToolRegistry  # noqa: E402
+from agent_runtime import run_tool_call, run_tool_calls  # noqa: E402
+
+MOCK_MCP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_mcp.py")
+CALLS = 8
+SLEEP_SECONDS = 0.3
+
+
+def start_http_server() -> tuple:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, MOCK_MCP, "--http", "--port", str(port)], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            urllib.request.urlopen(urllib.request.Request(f"http://127.0.0.1:{port}/mcp", method="DELETE"), timeout=1)
+            return process, f"http://127.0.0.1:{port}/mcp"
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError("mock MCP server did not start")
+            time.sleep(0.05)
+
+
+def tool_call(i: int, name: str, arguments: dict) -> dict:
+    return {"id": f"call_{i}", "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+
+
+async def check_server(server: MCPServer) -> bool:
+    registry = ToolRegistry()
+    toolset = MCPToolset([server])
+    try:
+        start = time.perf_counter()
+        await toolset.ensure_tools(registry)
+        print(f"📊 Listed {len(registry)} tool(s) in {(time.perf_counter() - start) * 1000:.1f}ms")
+        await toolset.ensure_tools(registry)  # 2回目は一覧を取り直さない
+
+        rounds = []
+        for _ in range(2):
+            calls = [tool_call(i, "sleep", {"seconds": SLEEP_SECONDS}) for i in range(CALLS)]
+            start = time.perf_counter()
+            results = await run_tool_calls(calls, registry, timeout=10)
+            rounds.append(time.perf_counter() - start)
+        served = {json.loads(r["content"])["pid"] for r in results}
+        add = await run_tool_calls([tool_call(0, "add", {"a": 2, "b": 3})], registry, timeout=10)
+        fail, failed = await run_tool_call(tool_call(0, "fail", {"message": "nope"}), registry, timeout=10)
+        cacheable = {name for name in ("add", "sleep", "fail") if registry.get(name).cacheable}
+    finally:
+        await toolset.aclose()
+
+    print(f"📊 {CALLS} concurrent {SLEEP_SECONDS}s calls: round 1 {rounds[0] * 1000:.0f}ms, "
+          f"round 2 {rounds[1] * 1000:.0f}ms, served by {len(served)} process(es)")
+    print(f"📊 add -> {add[0]['content']}, fail -> {fail['content']} (failed: {failed}), cacheable: {sorted(cacheable)}")
+    return (
+        {t["function"]["name"] for t in registry.tools} == {"add", "sleep", "fail"}
+        and rounds[1] < SLEEP_SECONDS * 2
+        and len(served) == 1
+        and add[0]["content"] == "5"
+        and failed
+        # readOnlyHint のツールだけをキャッシュする (sleep は idempotentHint のみ)
+        and cacheable == {"add"}
+    )
+
+
+async def test_stdio_server():
+    """Concurrent calls to a stdio server are multiplexed over one server process."""
+    print("\n" + "=" * 60)
+    print("Test: MCP over stdio")
+    print("=" * 60)
+    passed = await check_server(MCPServer("mock", command=sys.executable, args=(MOCK_MCP,)))
+    print("\n✅ SUCCESS" if passed else "\n❌ FAILURE")
+    return passed
+
+
+async def test_http_server():
+    """Concurrent calls to an HTTP server share one MCP session."""
+    print("\n" + "=" * 60)
+    print("Test: MCP over Streamable HTTP")
+    print("=" * 60)
+    process, url = start_http_server()
+    try:
+        passed = await check_server(MCPServer("mock", url=url))
+    finally:
+        process.terminate()
+        process.wait()
+    print("\n✅ SUCCESS" if passed else "\n❌ FAILURE")
+    return passed
+
+
+async def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 24 + "Offline MCP Tests")
+    print("=" * 70)
+
+    results = {
+        "stdio_server": await test_stdio_server(),
+        "http_server": await test_http_server(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+"""
+Offline prompt-prefix test: ``stable_prefix`` puts the leading static system
+messages ahead of the compaction summary and leaves system messages later in
+the conversation where they are.
+
+No proxy or LLM needed:
+    uv run python test_prompt.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm"))
+
+from agent_context import SUMMARY_MARKER  # noqa: E402
+from agent_prompt import stable_prefix  # noqa: E402
+
+
+def test_leading_system_run_only():
+    """Only the leading run of system messages is reordered."""
+    print("\n" + "=" * 60)
+    print("Test: Stable Prefix Keeps Later System Messages in Place")
+    print("=" * 60)
+
+    system = {"role": "system", "content": "You are a helpful assistant."}
+    summary = {"role": "system", "content": f"{SUMMARY_MARKER}\n- User asked: weather in Tokyo"}
+    user = {"role": "user", "content": "And in Osaka?"}
+    reply = {"role": "assistant", "content": "Sunny."}
+    late = {"role": "system", "content": "From now on, answer in Japanese."}
+
+    results = {}
+    results["summary_after_system"] = stable_prefix([summary, system, user]) == [system, summary, user]
+    results["late_system_kept"] = stable_prefix([summary, system, user, reply, late, user]) == [
+        system, summary, user, reply, late, user
+    ]
+    ordered = [system, user, late, user]
+    results["unchanged_returns_input"] = stable_prefix(ordered) is ordered
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Only the leading system messages were reordered!")
+        return True
+    else:
+        print("\n❌ FAILURE: A system message was moved out of its place")
+        return False
+
+
+def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 23 + "Offline Prompt Tests")
+    print("=" * 70)
+
+    results = {
+        "leading_system_run_only": test_leading_system_run_only(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
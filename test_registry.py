@@ -0,0 +1,174 @@
+"""
+Offline tool registry test: schemas come from the signature and docstring,
+the precompiled validators report bad arguments, and a lazily registered
+tool is not imported until it is resolved.
+
+No proxy or LLM needed:
+    uv run python test_registry.py
+"""
+import os
+import sys
+from typing import List, Literal, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm"))
+
+from agent_registry import ToolRegistry  # noqa: E402
+
+
+def search(query: str, limit: int = 5, tags: Optional[List[str]] = None, order: Literal["asc", "desc"] = "asc") -> str:
+    """
+    Search the notes.
+
+    Args:
+        query: Words to look for,
+            matched case-insensitively
+        limit: Maximum number of notes
+        tags: Only notes with these tags
+        order: Sort order
+
+    Returns:
+        JSON list of notes
+    """
+    return "[]"
+
+
+def annotate(note: str, **extra) -> str:
+    """Annotate a note."""
+    return note
+
+
+def test_schema():
+    """The schema is built from the signature and the Google-style docstring."""
+    print("\n" + "=" * 60)
+    print("Test: Schema From Signature and Docstring")
+    print("=" * 60)
+
+    registry = ToolRegistry()
+    registry.register(search)
+    registry.register(annotate)
+    function = registry.get("search").schema["function"]
+    parameters = function["parameters"]
+    properties = parameters["properties"]
+
+    results = {}
+    results["description"] = function["description"] == "Search the notes"
+    results["required"] = parameters["required"] == ["query"]
+    results["types"] = (
+        properties["query"]["type"] == "string"
+        and properties["limit"]["type"] == "integer"
+        and properties["tags"] == {"type": "array", "items": {"type": "string"}, "description": "Only notes with these tags"}
+    )
+    results["enum"] = properties["order"]["enum"] == ["asc", "desc"] and properties["order"]["type"] == "string"
+    results["continued_description"] = properties["query"]["description"] == "Words to look for, matched case-insensitively"
+    results["no_extra_without_kwargs"] = parameters["additionalProperties"] is False
+    results["extra_with_kwargs"] = "additionalProperties" not in registry.get("annotate").schema["function"]["parameters"]
+    results["sorted_tools"] = [tool["function"]["name"] for tool in registry.tools] == ["annotate", "search"]
+    try:
+        registry.register(search)
+        results["duplicate_rejected"] = False
+    except ValueError:
+        results["duplicate_rejected"] = True
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: The schema matches the signature and docstring!")
+        return True
+    else:
+        print("\n❌ FAILURE: The generated schema is wrong")
+        return False
+
+
+def test_validator():
+    """The validator accepts good arguments and names the problem with bad ones."""
+    print("\n" + "=" * 60)
+    print("Test: Precompiled Argument Validators")
+    print("=" * 60)
+
+    registry = ToolRegistry()
+    registry.register(search)
+    registry.register(annotate)
+    cases = {
+        "valid": (("search", {"query": "tokyo", "limit": 3, "order": "desc"}), None),
+        "not_object": (("search", ["tokyo"]), "Arguments must be a JSON object"),
+        "missing": (("search", {"limit": 3}), "Missing required argument 'query'"),
+        "wrong_type": (("search", {"query": "tokyo", "limit": "3"}), "Argument 'limit' must be of type integer"),
+        "bool_not_int": (("search", {"query": "tokyo", "limit": True}), "Argument 'limit' must be of type integer"),
+        "not_in_enum": (("search", {"query": "tokyo", "order": "up"}), "Argument 'order' must be one of ['asc', 'desc']"),
+        "unexpected": (("search", {"query": "tokyo", "page": 2}), "Unexpected argument 'page'"),
+        "extra_allowed": (("annotate", {"note": "hi", "color": "red"}), None),
+        "unknown_tool": (("missing", {}), "Unknown tool: missing"),
+    }
+
+    results = {name: registry.validate(*args) == expected for name, (args, expected) in cases.items()}
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Every bad argument was reported!")
+        return True
+    else:
+        print("\n❌ FAILURE: The validator accepted bad arguments or rejected good ones")
+        return False
+
+
+def test_lazy_loading():
+    """A lazily registered tool has its schema at once but is imported on first resolve."""
+    print("\n" + "=" * 60)
+    print("Test: Lazy Tool Loading")
+    print("=" * 60)
+
+    module = "agent_tools.weather"
+    sys.modules.pop(module, None)
+    registry = ToolRegistry()
+    registry.register_lazy(f"{module}:get_current_weather", cache_ttl=30.0)
+    spec = registry.get("get_current_weather")
+
+    results = {}
+    results["schema_without_import"] = (
+        module not in sys.modules
+        and spec.schema["function"]["parameters"]["required"] == ["location"]
+        and spec.schema["function"]["parameters"]["properties"]["unit"]["enum"] == ["celsius", "fahrenheit"]
+        and spec.cache_ttl == 30.0
+    )
+    function = registry.resolve("get_current_weather")
+    results["imported_on_resolve"] = module in sys.modules and spec.function is function
+    results["runs"] = '"temperature": 22' in function(location="Tokyo")
+    try:
+        registry.register_lazy(f"{module}:missing")
+        results["missing_function_rejected"] = False
+    except ImportError:
+        results["missing_function_rejected"] = True
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: The tool module was only imported when needed!")
+        return True
+    else:
+        print("\n❌ FAILURE: The tool module was imported too early or not at all")
+        return False
+
+
+def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 23 + "Offline Registry Tests")
+    print("=" * 70)
+
+    results = {
+        "schema": test_schema(),
+        "validator": test_validator(),
+        "lazy_loading": test_lazy_loading(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
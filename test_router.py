@@ -0,0 +1,303 @@
+"""
+Offline routing tests: an upstream error falls back to the next deployment,
+a hedged race releases the slot of the losing stream and closes a stream
+that a cancelled attempt opened anyway, and with
+``decision_model`` the answer is generated by the requested model.
+
+Runs against mock_llm.py, no proxy or LLM needed:
+    uv run python test_router.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+from benchmark import _free_port, load_agent, start_mock_server, upstream_requests
+
+HEDGE_MIN_DELAY = 0.05
+
+
+def mock_args(tokens: int = 10) -> SimpleNamespace:
+    return SimpleNamespace(latency=0.01, tokens_per_sec=500.0, tokens=tokens, tool_probability=0.0, tool_format="gpt-5")
+
+
+async def test_error_fallback():
+    """A deployment that refuses connections is skipped and the fallback answers."""
+    print("\n" + "=" * 60)
+    print("Test: Fallback After an Upstream Error (Offline)")
+    print("=" * 60)
+
+    process, base_url = start_mock_server(mock_args())
+    try:
+        agent = load_agent(base_url)
+        dead_url = f"http://127.0.0.1:{_free_port()}/v1"
+        response = await agent.my_custom_llm.acompletion(
+            model="openai/mock-gpt-5",
+            messages=[{"role": "user", "content": "Say hello to the fallback [no-tool]"}],
+            api_base=dead_url,
+            api_key="sk-mock",
+            litellm_params={"model_info": {"agent_settings": {
+                "fallbacks": [{"model": "openai/mock-gpt-5", "api_base": base_url, "api_key": "sk-mock"}],
+            }}},
+        )
+        answered = await asyncio.to_thread(upstream_requests, base_url)
+    finally:
+        process.terminate()
+        process.wait()
+
+    content = response.choices[0].message.content or ""
+    errors = agent.metrics.counter("agent_route_total", deployment=f"openai/mock-gpt-5@{dead_url}", outcome="error")
+    print(f"📊 Errors on the dead deployment: {errors:g}, requests served by the fallback: {answered}")
+    print(f"🤖 Answer: {content[:60]}")
+
+    if content and errors == 1 and answered == 1:
+        print("\n✅ SUCCESS: The fallback answered!")
+        return True
+    else:
+        print("\n❌ FAILURE: The request did not fall back")
+        return False
+
+
+async def race(agent, router, scheduler, deployments: list, delays: dict, base_url: str, gate=None) -> tuple:
+    """
+    Race one streamed call over ``deployments`` through ``router``, like ``agent._open_stream``.
+
+    Each attempt holds a one-call slot of ``scheduler`` until its stream is
+    closed, waits ``delays[model]`` seconds before calling the mock server and,
+    with ``gate``, holds its opened stream until the gate is set.
+
+    Returns:
+        The winning model, its streamed text and the models whose attempt was cancelled.
+    """
+    import litellm
+    from agent_router import open_stream
+    from agent_scheduler import PRIORITY_ANSWER
+    from agent_stream import close_stream, unpack_chunk
+
+    cancelled = []
+
+    async def attempt(deployment: dict):
+        slot = await scheduler.acquire(deployment["model"], 1, PRIORITY_ANSWER, timeout=5)
+        stream = None
+        try:
+            await asyncio.sleep(delays.get(deployment["model"], 0))
+            stream = await open_stream(litellm.acompletion(
+                model=deployment["model"],
+                api_base=base_url,
+                api_key="sk-mock",
+                messages=[{"role": "user", "content": "Race [no-tool]"}],
+                stream=True,
+            ), on_close=slot.release)
+            if gate is not None:
+                await gate.wait()
+            return stream
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                cancelled.append(deployment["model"])
+            if stream is not None:
+                await close_stream(stream)
+            slot.release()
+            raise
+
+    deployment, stream = await router.call(deployments, attempt, 0.95, HEDGE_MIN_DELAY, discard=close_stream)
+    text = ""
+    async for chunk in stream:
+        text += unpack_chunk(chunk)[1] or ""
+    await close_stream(stream)
+    return deployment["model"], text, cancelled
+
+
+def slots_in_use(scheduler) -> int:
+    return sum(value for name, _, value in scheduler.samples() if name == "agent_upstream_in_flight")
+
+
+async def test_hedged_race():
+    """The hedge wins against a slow deployment, loses against a fast one, and a finished loser is closed."""
+    print("\n" + "=" * 60)
+    print("Test: Hedged Race Releases the Loser (Offline)")
+    print("=" * 60)
+
+    process, base_url = start_mock_server(mock_args())
+    try:
+        agent = load_agent(base_url)
+        from agent_router import Router
+        from agent_scheduler import Scheduler
+
+        router = Router(min_samples=1)
+        scheduler = Scheduler()
+        primary, backup = "openai/mock-primary", "openai/mock-backup"
+        deployments = [{"model": primary}, {"model": backup}]
+        # 速い応答を1回記録し、ヘッジの待ち時間を HEDGE_MIN_DELAY にする
+        await race(agent, router, scheduler, [{"model": primary}], {}, base_url)
+
+        results = {}
+        winner, text, cancelled = await race(agent, router, scheduler, deployments, {primary: 1.0}, base_url)
+        results["hedge_wins"] = winner == backup and cancelled == [primary] and bool(text) and slots_in_use(scheduler) == 0
+        print(f"📊 Slow primary: {winner} answered, {slots_in_use(scheduler)} slot(s) still held")
+
+        winner, text, cancelled = await race(agent, router, scheduler, deployments, {primary: 0.1, backup: 0.5}, base_url)
+        results["hedge_loses"] = winner == primary and cancelled == [backup] and bool(text) and slots_in_use(scheduler) == 0
+        print(f"📊 Primary faster than the hedge: {winner} answered, {slots_in_use(scheduler)} slot(s) still held")
+
+        # 両方のストリームが同じティックで開き終わる: 負けた方は discard で閉じる
+        gate = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.3, gate.set)
+        before = await asyncio.to_thread(upstream_requests, base_url)
+        winner, text, cancelled = await race(agent, router, scheduler, deployments, {primary: 0.1}, base_url, gate)
+        opened = await asyncio.to_thread(upstream_requests, base_url) - before
+        results["loser_discarded"] = (
+            winner == primary and opened == 2 and not cancelled and slots_in_use(scheduler) == 0
+        )
+        print(f"📊 Both streams opened ({opened} requests): {winner} answered, "
+              f"{slots_in_use(scheduler)} slot(s) still held")
+    finally:
+        process.terminate()
+        process.wait()
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Every losing stream gave its slot back!")
+        return True
+    else:
+        print("\n❌ FAILURE: A race picked the wrong winner or kept the loser's slot")
+        return False
+
+
+class FakeStream:
+    """An upstream stream that records whether it was closed."""
+
+    def __init__(self, first_delay: float = 0.0):
+        self.first_delay = first_delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(self.first_delay)
+        return "chunk"
+
+    async def aclose(self):
+        self.closed = True
+
+
+async def test_cancelled_loser_cleanup():
+    """A loser that opens its stream while being cancelled is closed, and a cancelled first chunk closes the stream."""
+    print("\n" + "=" * 60)
+    print("Test: Cancelled Attempts Close Their Streams (Offline)")
+    print("=" * 60)
+
+    from agent_router import Router, open_stream
+    from agent_stream import close_stream
+
+    async def completion(stream):
+        return stream
+
+    results = {}
+    # 最初のチャンクを待つ間にキャンセルされたストリームは閉じる
+    stream = FakeStream(first_delay=1.0)
+    task = asyncio.ensure_future(open_stream(completion(stream)))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    results["first_chunk_cancelled"] = stream.closed
+
+    # ヘッジに負けた候補がキャンセルの最中にストリームを開いても discard で閉じる
+    router = Router(min_samples=1)
+    late = FakeStream()
+
+    async def attempt(deployment: dict):
+        if deployment["model"] == "fast":
+            await asyncio.sleep(0.1)
+            return FakeStream()
+        try:
+            await asyncio.sleep(0.01 if router.hedge_delay(deployment, 0.95, HEDGE_MIN_DELAY) is None else 1.0)
+        except asyncio.CancelledError:
+            await asyncio.sleep(0.05)
+            return late
+        return FakeStream()
+
+    await router.call([{"model": "slow"}], attempt)
+    deployment, winner = await router.call(
+        [{"model": "slow"}, {"model": "fast"}], attempt, 0.95, HEDGE_MIN_DELAY, discard=close_stream
+    )
+    results["late_loser_closed"] = deployment["model"] == "fast" and late.closed and not winner.closed
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: No abandoned stream was left open!")
+        return True
+    else:
+        print("\n❌ FAILURE: A cancelled attempt left its stream open")
+        return False
+
+
+async def test_decision_model_answer():
+    """The decision model only decides; the text answer comes from the requested model in both modes."""
+    print("\n" + "=" * 60)
+    print("Test: Decision Model Hands the Answer Over (Offline)")
+    print("=" * 60)
+
+    answer_process, answer_url = start_mock_server(mock_args(tokens=40))
+    decision_process, decision_url = start_mock_server(mock_args(tokens=5))
+    try:
+        agent = load_agent(answer_url)
+        llm = agent.my_custom_llm
+        kwargs = dict(
+            model="openai/mock-gpt-5",
+            api_base=answer_url,
+            api_key="sk-mock",
+            litellm_params={"model_info": {"agent_settings": {
+                "decision_model": {"model": "openai/mock-decider", "api_base": decision_url, "api_key": "sk-mock"},
+            }}},
+        )
+
+        response = await llm.acompletion(messages=[{"role": "user", "content": "Tell me a story [no-tool]"}], **kwargs)
+        completed = response.choices[0].message.content or ""
+        streamed = ""
+        async for chunk in llm.astreaming(messages=[{"role": "user", "content": "Tell me a tale [no-tool]"}], **kwargs):
+            streamed += chunk["text"] or ""
+
+        decided = await asyncio.to_thread(upstream_requests, decision_url)
+        answered = await asyncio.to_thread(upstream_requests, answer_url)
+    finally:
+        for process in (answer_process, decision_process):
+            process.terminate()
+            process.wait()
+
+    print(f"📊 Requests: {decided} to the decision model, {answered} to the requested model")
+    print(f"📊 Answer words: {len(completed.split())} (acompletion), {len(streamed.split())} (astreaming)")
+
+    # 判定用のモデルは5語、要求されたモデルは40語で答える
+    if decided == 2 and answered == 2 and len(completed.split()) == 40 and len(streamed.split()) == 40:
+        print("\n✅ SUCCESS: The requested model wrote both answers!")
+        return True
+    else:
+        print("\n❌ FAILURE: The decision model's text reached the client")
+        return False
+
+
+async def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 24 + "Offline Router Tests")
+    print("=" * 70)
+
+    results = {
+        "error_fallback": await test_error_fallback(),
+        "hedged_race": await test_hedged_race(),
+        "cancelled_loser_cleanup": await test_cancelled_loser_cleanup(),
+        "decision_model_answer": await test_decision_model_answer(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,258 @@
+"""
+Offline shared-state test: counters, the tool cache's single flight and the
+deployment slot limit hold across proxy worker processes, and a full mmap
+table never hands out a slot or lock that another worker still holds.
+
+Runs every check against an mmap file, and against mock_redis.py when
+redis-py is installed; no proxy or LLM needed:
+    uv run python test_shared_state.py
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm"))
+
+from agent_cache import ToolResultCache  # noqa: E402
+from agent_scheduler import PRIORITY_NEW, QueueTimeoutError, Scheduler  # noqa: E402
+from agent_shared import new_token, store_from_url  # noqa: E402
+
+MOCK_REDIS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_redis.py")
+WORKERS = 4
+INCREMENTS = 500
+CALLS_PER_WORKER = 6
+SLOT_LIMIT = 2
+TOOL_SECONDS = 0.3
+LEASE = 0.3
+
+
+def run_workers(target, url: str) -> list:
+    """Run ``target(url, worker)`` in WORKERS processes at once and return their results."""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(WORKERS) as pool:
+        return pool.starmap(target, [(url, i) for i in range(WORKERS)])
+
+
+def count_worker(url: str, worker: int) -> int:
+    async def run() -> int:
+        store = store_from_url(url)
+        last = 0
+        for _ in range(INCREMENTS):
+            last = await store.incr("test:counter")
+        await store.aclose()
+        return last
+
+    return asyncio.run(run())
+
+
+def cache_worker(url: str, worker: int) -> list:
+    async def run() -> list:
+        store = store_from_url(url)
+        cache = ToolResultCache(ttl=60, shared=store)
+
+        async def slow_tool() -> str:
+            await store.incr("test:tool_runs")
+            await asyncio.sleep(TOOL_SECONDS)
+            return "sunny"
+
+        results = await asyncio.gather(
+            *(cache.get_or_run("get_weather", {"city": "Tokyo"}, slow_tool) for _ in range(CALLS_PER_WORKER))
+        )
+        await store.aclose()
+        return results
+
+    return asyncio.run(run())
+
+
+def slot_worker(url: str, worker: int) -> None:
+    async def run() -> None:
+        store = store_from_url(url)
+        scheduler = Scheduler(shared=store)
+
+        async def call() -> None:
+            slot = await scheduler.acquire("mock", SLOT_LIMIT, PRIORITY_NEW, timeout=30)
+            try:
+                if await store.incr("test:running") > SLOT_LIMIT:
+                    await store.incr("test:over_limit")
+                await store.incr("test:calls")
+                await asyncio.sleep(0.05)
+                await store.incr("test:running", -1)
+            finally:
+                slot.release()
+                await asyncio.sleep(0)
+
+        await asyncio.gather(*(call() for _ in range(CALLS_PER_WORKER)))
+        await asyncio.sleep(0.05)  # 共有スロットの解放を待つ
+        await store.aclose()
+
+    asyncio.run(run())
+
+
+async def read_int(url: str, key: str) -> int:
+    store = store_from_url(url)
+    try:
+        return int(await store.get(key) or 0)
+    finally:
+        await store.aclose()
+
+
+async def held_past_lease(url: str) -> tuple:
+    """Hold a shared slot for several leases; return whether another worker could take it meanwhile and after."""
+    store = store_from_url(url)
+    holder = Scheduler(shared=store, lease=LEASE)
+    other = Scheduler(shared=store, lease=LEASE)
+
+    async def other_gets_slot() -> bool:
+        try:
+            slot = await other.acquire("lease", 1, PRIORITY_NEW, timeout=0.1)
+        except QueueTimeoutError:
+            return False
+        slot.release()
+        await asyncio.sleep(0.01)  # 共有スロットの解放を待つ
+        return True
+
+    try:
+        slot = await holder.acquire("lease", 1, PRIORITY_NEW, timeout=1)
+        await asyncio.sleep(LEASE * 3)  # リースより長いストリーム
+        stolen = await other_gets_slot()
+        slot.release()
+        await asyncio.sleep(0.01)
+        return stolen, await other_gets_slot()
+    finally:
+        await store.aclose()
+
+
+async def check_store(url: str) -> bool:
+    results = {}
+
+    start = time.perf_counter()
+    run_workers(count_worker, url)
+    counter = await read_int(url, "test:counter")
+    print(f"📊 Counter after {WORKERS}x{INCREMENTS} increments: {counter} "
+          f"({(time.perf_counter() - start) * 1000:.0f}ms incl. process start)")
+    results["counter"] = counter == WORKERS * INCREMENTS
+
+    start = time.perf_counter()
+    answers = run_workers(cache_worker, url)
+    runs = await read_int(url, "test:tool_runs")
+    elapsed = time.perf_counter() - start
+    print(f"📊 {WORKERS * CALLS_PER_WORKER} cached calls in {WORKERS} workers ran the tool {runs} time(s) "
+          f"in {elapsed * 1000:.0f}ms")
+    results["single_flight"] = runs == 1 and all(a == "sunny" for worker in answers for a in worker)
+
+    start = time.perf_counter()
+    run_workers(slot_worker, url)
+    calls = await read_int(url, "test:calls")
+    over = await read_int(url, "test:over_limit")
+    print(f"📊 {calls} calls with {SLOT_LIMIT} shared slots: {over} ran over the limit "
+          f"in {(time.perf_counter() - start) * 1000:.0f}ms")
+    results["slot_limit"] = calls == WORKERS * CALLS_PER_WORKER and over == 0
+
+    stolen, freed = await held_past_lease(url)
+    print(f"📊 Slot held for {LEASE * 3:.1f}s on a {LEASE:.1f}s lease: taken by another worker while held: {stolen}, "
+          f"free after release: {freed}")
+    results["lease_renewal"] = not stolen and freed
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    return all(results.values())
+
+
+async def full_probe_window(directory: str) -> dict:
+    """Fill a small mmap table with live leases; writes must fail instead of taking them over."""
+    # 4 スロットしかないので、どのキーの探索範囲もテーブル全体になる
+    store = store_from_url(f"mmap://{directory}/full-state?slots=4&value_size=64")
+    try:
+        results = {}
+        await store.set("response:old", b"cached", 60)
+        leases = {f"slot:mock:{i}": new_token() for i in range(4)}
+        # キャッシュの値は追い出してよいが、リースは1つも欠けずに入る
+        results["leases_evict_cache"] = all([await store.add(key, token, 60) for key, token in leases.items()])
+        results["add_refused"] = not await store.add("lock:tool", new_token(), 60)
+        results["set_refused"] = not await store.set("response:new", b"cached", 60)
+        results["leases_kept"] = all([await store.get(key) == token for key, token in leases.items()])
+        await store.delete("slot:mock:0", leases["slot:mock:0"])
+        results["add_after_release"] = await store.add("lock:tool", new_token(), 60)
+        return results
+    finally:
+        await store.aclose()
+
+
+def start_redis_server() -> tuple:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, MOCK_REDIS, "--port", str(port)], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, f"redis://127.0.0.1:{port}/0"
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError("mock Redis server did not start")
+            time.sleep(0.05)
+
+
+async def test_mmap_store():
+    """Workers on one host share state through an mmap file."""
+    print("\n" + "=" * 60)
+    print("Test: Shared State over mmap")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as directory:
+        passed = await check_store(f"mmap://{directory}/agent-state?slots=256&value_size=1024")
+        full = await full_probe_window(directory)
+    print(f"📊 Writes to a table full of live leases: {', '.join(f'{k}={v}' for k, v in full.items())}")
+    passed = passed and all(full.values())
+    print("\n✅ SUCCESS" if passed else "\n❌ FAILURE")
+    return passed
+
+
+async def test_redis_store():
+    """Workers on any host share state through Redis."""
+    print("\n" + "=" * 60)
+    print("Test: Shared State over Redis")
+    print("=" * 60)
+    try:
+        import redis.asyncio  # noqa: F401
+    except ImportError:
+        print("⏭️  redis-py is not installed, skipping")
+        return None
+    process, url = start_redis_server()
+    try:
+        passed = await check_store(url)
+    finally:
+        process.terminate()
+        process.wait()
+    print("\n✅ SUCCESS" if passed else "\n❌ FAILURE")
+    return passed
+
+
+async def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 22 + "Offline Shared State Tests")
+    print("=" * 70)
+
+    results = {
+        "mmap_store": await test_mmap_store(),
+        "redis_store": await test_redis_store(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "⏭️  SKIPPED" if passed is None else "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
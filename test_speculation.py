@@ -0,0 +1,145 @@
+"""
+Offline speculation tests: with ``speculation: on`` a round answered without
+tools streams the buffered speculative answer, with the same text as without
+speculation, and a round that calls a tool cancels the speculative stream and
+counts it as waste.
+
+Runs against mock_llm.py, no proxy or LLM needed:
+    uv run python test_speculation.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+from benchmark import load_agent, start_mock_server, upstream_requests
+
+MODEL = "openai/mock-gpt-5"
+
+
+async def stream_text(llm, base_url: str, content: str, speculation: str) -> str:
+    """Stream one answer and return its text."""
+    text = ""
+    async for chunk in llm.astreaming(
+        model=MODEL,
+        messages=[{"role": "user", "content": content}],
+        api_base=base_url,
+        api_key="sk-mock",
+        litellm_params={"model_info": {"agent_settings": {"speculation": speculation}}},
+    ):
+        text += chunk["text"] or ""
+    return text
+
+
+async def run_round(agent, base_url: str, content: str) -> dict:
+    """Stream ``content`` without and with speculation; return the texts, upstream requests and outcomes."""
+    llm = agent.my_custom_llm
+
+    def outcomes() -> dict:
+        return agent.speculation.stats(MODEL)[MODEL]
+
+    before = await asyncio.to_thread(upstream_requests, base_url)
+    plain = await stream_text(llm, base_url, content, "off")
+    middle = await asyncio.to_thread(upstream_requests, base_url)
+    start = outcomes()
+    speculated = await stream_text(llm, base_url, content, "on")
+    end = outcomes()
+    after = await asyncio.to_thread(upstream_requests, base_url)
+    return {
+        "plain": plain,
+        "speculated": speculated,
+        "plain_requests": middle - before,
+        "speculated_requests": after - middle,
+        "wins": end["wins"] - start["wins"],
+        "wasted": end["wasted"] - start["wasted"],
+    }
+
+
+async def test_answer_released():
+    """Without a tool call the speculative answer is released, with the text of the non-speculative stream."""
+    print("\n" + "=" * 60)
+    print("Test: Speculative Answer Released (Offline)")
+    print("=" * 60)
+
+    process, base_url = start_mock_server(SimpleNamespace(
+        latency=0.05,
+        tokens_per_sec=200.0,
+        tokens=30,
+        tool_probability=0.0,
+        tool_format="gpt-5",
+    ))
+    try:
+        agent = load_agent(base_url)
+        result = await run_round(agent, base_url, "Tell me a story [no-tool]")
+    finally:
+        process.terminate()
+        process.wait()
+
+    print(f"📊 Upstream requests: {result['plain_requests']} plain, {result['speculated_requests']} speculated; "
+          f"wins {result['wins']:g}, wasted {result['wasted']:g}")
+    print(f"🤖 Speculated answer: {result['speculated'][:60]}")
+
+    if (result["speculated"] and result["speculated"] == result["plain"]
+            and result["speculated_requests"] == 2 and result["wins"] == 1 and result["wasted"] == 0):
+        print("\n✅ SUCCESS: The buffered answer was streamed unchanged!")
+        return True
+    else:
+        print("\n❌ FAILURE: The speculative answer was lost or differs from the plain stream")
+        return False
+
+
+async def test_tool_round_cancels():
+    """A tool call cancels the speculative stream and counts it as waste; the answer is unchanged."""
+    print("\n" + "=" * 60)
+    print("Test: Speculation Cancelled by a Tool Call (Offline)")
+    print("=" * 60)
+
+    process, base_url = start_mock_server(SimpleNamespace(
+        latency=0.05,
+        tokens_per_sec=200.0,
+        tokens=30,
+        tool_probability=0.0,
+        tool_format="gpt-5",
+    ))
+    try:
+        agent = load_agent(base_url)
+        result = await run_round(agent, base_url, "What's the weather in Tokyo? [tool:get_current_weather]")
+    finally:
+        process.terminate()
+        process.wait()
+
+    print(f"📊 Upstream requests: {result['plain_requests']} plain, {result['speculated_requests']} speculated; "
+          f"wins {result['wins']:g}, wasted {result['wasted']:g}")
+    print(f"🤖 Answer: {result['speculated'][:60]}")
+
+    # 1ラウンド目はツールを呼ぶので投機は無駄になり、ツール結果を受けた2ラウンド目の投機は採用される
+    if ("22" in result["speculated"] and result["speculated"] == result["plain"]
+            and result["speculated_requests"] == result["plain_requests"] + 2
+            and result["wins"] == 1 and result["wasted"] == 1):
+        print("\n✅ SUCCESS: The speculative stream was cancelled and counted as waste!")
+        return True
+    else:
+        print("\n❌ FAILURE: The speculative stream leaked into the answer or was not counted")
+        return False
+
+
+async def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 21 + "Offline Speculation Tests")
+    print("=" * 70)
+
+    results = {
+        "answer_released": await test_answer_released(),
+        "tool_round_cancels": await test_tool_round_cancels(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,201 @@
+"""
+Offline stream parsing test: a tool call written into the content with a
+non-string ``name`` (a list or an object) is streamed as text instead of
+raising or being dispatched, and a streamed tool call is started as soon as
+its arguments close, before the stream has ended.
+
+No proxy or LLM needed:
+    uv run python test_stream.py
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "litellm"))
+
+from agent_registry import ToolRegistry  # noqa: E402
+from agent_runtime import EarlyToolCalls, run_tool_calls  # noqa: E402
+from agent_stream import JsonCloseScanner, ToolCallAssembler  # noqa: E402
+
+TOOL_SECONDS = 0.2
+FRAGMENT_SECONDS = 0.05
+runs = []
+finished = {}
+
+TOOLS = [{"type": "function", "function": {"name": "get_current_weather", "parameters": {"type": "object"}}}]
+
+
+def parse(content: str) -> tuple:
+    """Feed ``content`` in small fragments; return the streamed text and the parsed tool calls."""
+    assembler = ToolCallAssembler(TOOLS)
+    text = ""
+    for i in range(0, len(content), 7):
+        text += assembler.feed_text(content[i:i + 7])
+    text += assembler.flush_text()
+    return text, assembler.tool_calls()
+
+
+def test_non_string_name_is_text():
+    """JSON and ``<tool_call>`` content whose name is not a string stays text."""
+    print("\n" + "=" * 60)
+    print("Test: Non-String Tool Name Streamed as Text")
+    print("=" * 60)
+
+    cases = {
+        "json_list": '{"name": ["get_current_weather"], "arguments": {"location": "Tokyo"}}',
+        "json_object": '{"name": {"value": "get_current_weather"}, "arguments": {}}',
+        "tag_list": '<tool_call>{"name": ["get_current_weather"], "arguments": {}}</tool_call>',
+    }
+    results = {}
+    for name, content in cases.items():
+        try:
+            text, calls = parse(content)
+            results[name] = text == content and not calls
+        except Exception as e:
+            print(f"   {name}: raised {type(e).__name__}: {e}")
+            results[name] = False
+
+    # 文字列の name は従来どおりツール呼び出しになる
+    text, calls = parse('{"name": "get_current_weather", "arguments": {"location": "Tokyo"}}')
+    results["string_name"] = not text and [c["function"]["name"] for c in calls] == ["get_current_weather"]
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Only string names became tool calls!")
+        return True
+    else:
+        print("\n❌ FAILURE: A non-string name raised or was dispatched")
+        return False
+
+
+async def slow_lookup(city: str) -> str:
+    """Look up a city slowly."""
+    runs.append(city)
+    await asyncio.sleep(TOOL_SECONDS)
+    finished[city] = time.perf_counter()
+    return json.dumps({"city": city})
+
+
+def fragments(index: int, call_id: str, arguments: str, size: int = 5) -> list:
+    """``delta.tool_calls`` fragments of one call: the name first, then the arguments in pieces."""
+    first = {"index": index, "id": call_id, "function": {"name": "slow_lookup", "arguments": ""}}
+    return [first] + [
+        {"index": index, "function": {"arguments": arguments[i:i + size]}} for i in range(0, len(arguments), size)
+    ]
+
+
+def test_json_close_scanner():
+    """The scanner closes on the matching brace only, across fragments, strings and escapes."""
+    print("\n" + "=" * 60)
+    print("Test: Incremental JSON Close Detection")
+    print("=" * 60)
+
+    def closes_at(text: str, size: int):
+        scanner = JsonCloseScanner()
+        for i in range(0, len(text), size):
+            if scanner.feed(text[i:i + size]):
+                return i + size
+        return None
+
+    value = json.dumps({"q": "a } b", "nested": {"list": [1, {"x": '\\" }'}]}, "quote": 'say "hi"'})
+    results = {}
+    # どの長さで分割しても、最後の } で初めて閉じる
+    results["closes_on_last_brace"] = all(
+        closes_at(value, size) is not None and closes_at(value, size) >= len(value) for size in range(1, 12)
+    )
+    results["open_not_closed"] = closes_at(value[:-1], 4) is None
+    results["brace_in_string_ignored"] = closes_at('{"text": "}}}"', 3) is None
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: The arguments closed exactly at their last brace!")
+        return True
+    else:
+        print("\n❌ FAILURE: The scanner closed too early or never")
+        return False
+
+
+async def early_round(change_first: bool = False) -> tuple:
+    """Stream two calls, starting each when its arguments close; return when the stream ended, and the results."""
+    registry = ToolRegistry()
+    registry.register(slow_lookup, cacheable=False)
+    assembler = ToolCallAssembler(registry.tools)
+    early = EarlyToolCalls(registry, timeout=5.0)
+    started = []
+    start = time.perf_counter()
+    # 1つ目の呼び出しが閉じたあとも、モデルは2つ目をしばらく生成し続ける
+    for fragment in fragments(0, "call_a", '{"city": "Tokyo"}') + fragments(1, "call_b", '{"city": "Osaka"}'):
+        assembler.add([fragment])
+        for call in assembler.ready_calls():
+            started.append((call["id"], round(time.perf_counter() - start, 2)))
+            early.start(call)
+        await asyncio.sleep(FRAGMENT_SECONDS)
+    stream_end = time.perf_counter()
+    calls = assembler.tool_calls()
+    if change_first:
+        calls[0]["function"]["arguments"] = '{"city": "Kyoto"}'
+    messages = await run_tool_calls(calls, registry, timeout=5.0, early=early)
+    return stream_end, started, messages
+
+
+def test_early_tool_start():
+    """A call starts when its arguments close and the round reuses it instead of running it again."""
+    print("\n" + "=" * 60)
+    print("Test: Early Tool Start While Streaming")
+    print("=" * 60)
+
+    results = {}
+    runs.clear()
+    stream_end, started, messages = asyncio.run(early_round())
+    print(f"📊 started {started}, runs {runs}")
+    results["started_when_closed"] = [call_id for call_id, _ in started] == ["call_a", "call_b"] and (
+        started[0][1] < started[1][1]
+    )
+    results["each_run_once"] = runs == ["Tokyo", "Osaka"]
+    results["results_in_order"] = [json.loads(m["content"])["city"] for m in messages] == ["Tokyo", "Osaka"]
+    # 2つ目の呼び出しを生成している間 (TOOL_SECONDS より長い) に、1つ目のツールは終わっている
+    results["overlapped_with_stream"] = finished["Tokyo"] < stream_end
+
+    runs.clear()
+    _, _, messages = asyncio.run(early_round(change_first=True))
+    results["changed_arguments_rerun"] = sorted(runs) == ["Kyoto", "Osaka", "Tokyo"] and (
+        json.loads(messages[0]["content"])["city"] == "Kyoto"
+    )
+
+    for name, passed in results.items():
+        print(f"   {name}: {'ok' if passed else 'FAILED'}")
+    if all(results.values()):
+        print("\n✅ SUCCESS: Tools started before the stream ended and ran once!")
+        return True
+    else:
+        print("\n❌ FAILURE: Tools waited for the stream or ran twice")
+        return False
+
+
+def main():
+    """Run all tests."""
+    print("\n" + "=" * 70)
+    print(" " * 20 + "Offline Stream Parsing Tests")
+    print("=" * 70)
+
+    results = {
+        "non_string_name_is_text": test_non_string_name_is_text(),
+        "json_close_scanner": test_json_close_scanner(),
+        "early_tool_start": test_early_tool_start(),
+    }
+
+    print("\n" + "=" * 70)
+    print("Test Summary")
+    print("=" * 70)
+    for test_name, passed in results.items():
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{test_name.replace('_', ' ').title():40s}: {status}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()